@@ -1,3 +1,17 @@
 from .reynard import Reynard
+from .fleet import ReynardFleet, ReynardFleetRobot
+from .clock import WallClock, VirtualClock
+from .state import ReynardState
+from .trajectory import Trajectory
+from .kinematics import forward_kinematics, inverse_kinematics, link_positions
+from .obstacles import ObstacleMap
+from .recorder import StateRecorder, StateLog
+from .history import StateHistory
+from .messages import MessageLog
+from .metrics import MetricsRegistry
+from .profiler import SamplingProfiler
+from .runtime import LoopProfile
 
-all = ["Reynard"]
+all = ["Reynard", "ReynardFleet", "ReynardFleetRobot", "WallClock", "VirtualClock", "ReynardState", "Trajectory",
+       "forward_kinematics", "inverse_kinematics", "link_positions", "ObstacleMap", "StateRecorder",
+       "StateLog", "StateHistory", "MessageLog", "MetricsRegistry", "SamplingProfiler", "LoopProfile"]
@@ -1,161 +1,443 @@
-import socket
-import time
-import threading
-import select
-import weakref
+import asyncio
 from contextlib import suppress
 import shlex
-import queue
+import time
+
+import numpy as np
+
+from .trajectory import Trajectory
+
+_commands = frozenset(["TELEPORT", "SAY", "SETARM", "DRIVE", "DRIVEARM", "STATE", "COLORGET", "COLORSET", "MESSAGE",
+                       "SUBSCRIBE", "UNSUBSCRIBE", "BATCH", "END", "TRAJ", "TRAJSTATUS", "TRAJCANCEL",
+                       "TOOLPOSE", "MOVETOOL", "HISTORY"])
+
+# Number of position values in each waypoint of the TRAJ command
+_traj_modes = {"BASE": 2, "ARM": 3, "BOTH": 5}
+
+
+def _tokenize(l):
+    # shlex is only needed for lines containing quotes or escapes. Other lines, such as the numeric DRIVE, SETARM
+    # and STATE commands, are split on whitespace which gives the same result much faster.
+    if '"' in l or "'" in l or "\\" in l:
+        return shlex.split(l)
+    return l.split()
+
+
+def _format_ok(_):
+    return "OK\n"
+
+
+def _format_state(state):
+    t = state.time
+    p = state.robot_position
+    a = state.arm_position
+    return f"STATE {t} {p[0]} {p[1]} {a[0]} {a[1]} {a[2]}\n"
+
+
+def _format_tool_pose(state):
+    x, y, theta = state.tool_pose.tolist()
+    return f"TOOLPOSE {x} {y} {theta}\n"
+
+
+def _format_move_tool(q):
+    return f"MOVETOOL {q[0]} {q[1]} {q[2]}\n"
+
+
+def _format_color(state):
+    c = state.color
+    return f"COLOR {c[0]} {c[1]} {c[2]}\n"
+
+
+def _format_traj(traj):
+    return f"TRAJ {traj.id}\n"
+
+
+def _format_traj_status(status):
+    if status is None:
+        return "TRAJSTATUS NONE\n"
+    return f"TRAJSTATUS {status['id']} {status['state'].upper()} {status['time']} {status['duration']} " \
+        f"{status['waypoint']}\n"
+
+
+def _parse_traj(s1):
+    # TRAJ <BASE|ARM|BOTH> followed by the time and positions of each waypoint
+    mode = s1[1]
+    assert mode in _traj_modes, "Invalid trajectory mode"
+    n = _traj_modes[mode] + 1
+    values = [float(v) for v in s1[2:]]
+    assert len(values) > 0 and len(values) % n == 0, "Invalid number of trajectory values"
+    w = [values[i:i + n] for i in range(0, len(values), n)]
+    times = [v[0] for v in w]
+    robot_positions = [v[1:3] for v in w] if mode != "ARM" else None
+    arm_positions = [v[-3:] for v in w] if mode != "BASE" else None
+    return Trajectory(robot_positions, arm_positions, times)
 
 
 class ReynardAsciiSocketConnection:
-    def __init__(self, reynard, s):
+    _read_size = 16384
+    _max_line_length = 65536
+    _max_batch_length = 10000
+    _max_write_buffer = 65536
+    _max_subscribe_rate = 1000.0
+    _max_history_lines = 1000
+
+    def __init__(self, reynard, reader, writer):
         self._reynard = reynard
-        self._s = s
-        self._f = s.makefile(mode='rw')
+        self._reader = reader
+        self._writer = writer
+
+        # Messages are read from Reynard's message log, starting after the newest message when the client connected
+        self._message_cursor = reynard.messages.last_seqno
+        self._batch = None
+        self._state_task = None
+        self._subscribe_message = False
 
-        self._message_queue = queue.Queue(10)
+        self._command_seconds = reynard.metrics["reynard_ascii_command_seconds"]
 
         self._reynard.new_message.connect(self._new_message)
 
-        self._thread = threading.Thread(target=self._run)
-        self._thread.daemon = True
-        self._thread.start()
+    def _new_message(self, _, **kwargs):
+        if self._subscribe_message:
+            self._push_messages()
 
-    def _new_message(self, _, message):
-        self._message_queue.put_nowait(message)
+    def _can_push(self):
+        transport = self._writer.transport
+        return not transport.is_closing() and transport.get_write_buffer_size() <= self._max_write_buffer
 
-    def _run(self):
-        while True:
-            l = None
-            try:
-                l = self._f.readline()
-            except (ConnectionResetError, ConnectionAbortedError):
-                return
-            ret = None
-            if l is None:
+    def _push(self, line):
+        # Pushed lines are dropped if the client is not reading fast enough, so a slow reader can never stall
+        # the server or cause unbounded buffering
+        if self._can_push():
+            self._writer.write(line.encode("utf-8"))
+
+    def _push_messages(self):
+        # The cursor only advances past the messages written, so messages that do not fit in the write buffer are
+        # pushed with the next message while they are still in the log
+        for seqno, message in self._reynard.messages.read(self._message_cursor):
+            if not self._can_push():
                 return
+            self._writer.write(f"MESSAGE \"{message}\"\n".encode("utf-8"))
+            self._message_cursor = seqno
 
-            try:
-                s1 = shlex.split(l)
-                if s1[0] == "TELEPORT":
-                    assert len(s1) == 3
-                    x = float(s1[1])
-                    y = float(s1[2])
-                    self._reynard.teleport(x, y)
-                    ret = "OK\n"
-                elif s1[0] == "SAY":
-                    assert len(s1) == 2
-                    msg = s1[1]
-                    self._reynard.say(msg)
-                    ret = "OK\n"
-                elif s1[0] == "SETARM":
-                    assert len(s1) == 4
-                    q1 = float(s1[1])
-                    q2 = float(s1[2])
-                    q3 = float(s1[3])
-                    self._reynard.set_arm_position(q1, q2, q3)
-                    ret = "OK\n"
-                elif s1[0] == "DRIVE":
-                    assert len(s1) >= 3
-                    vel_x = float(s1[1])
-                    vel_y = float(s1[2])
-                    timeout = -1
-                    if len(s1) >= 4:
-                        timeout = float(s1[3])
-                    wait = False
-                    if len(s1) >= 5:
-                        wait = bool(s1[4])
-                    self._reynard.drive_robot(vel_x, vel_y, timeout, wait)
-                    ret = "OK\n"
-                elif s1[0] == "DRIVEARM":
-                    assert len(s1) >= 4
-                    q1 = float(s1[1])
-                    q2 = float(s1[2])
-                    q3 = float(s1[3])
-                    timeout = -1
-                    if len(s1) >= 5:
-                        timeout = float(s1[4])
-                    wait = False
-                    if len(s1) >= 6:
-                        wait = bool(s1[5])
-                    self._reynard.drive_arm(q1, q2, q3, timeout, wait)
-                    ret = "OK\n"
-                elif s1[0] == "STATE":
-                    assert len(s1) == 1
-                    t = self._reynard.time
-                    p = self._reynard.robot_position
-                    a = self._reynard.arm_position
-                    ret = f"STATE {t} {p[0]} {p[1]} {a[0]} {a[1]} {a[2]}\n"
-                elif s1[0] == "COLORGET":
-                    assert len(s1) == 1
-                    c = self._reynard.color
-                    ret = f"COLOR {c[0]} {c[1]} {c[2]}\n"
-                elif s1[0] == "COLORSET":
-                    assert len(s1) == 4
-                    r = float(s1[1])
-                    g = float(s1[2])
-                    b = float(s1[3])
-                    self._reynard.color = (r, g, b)
-                    ret = "OK\n"
-                elif s1[0] == "MESSAGE":
-                    assert len(s1) == 1
-                    try:
-                        msg = self._message_queue.get_nowait()
-                    except queue.Empty:
-                        ret = "NOMESSAGE\n"
-                    else:
-                        ret = f"MESSAGE \"{msg}\"\n"
+    async def _push_state(self, period):
+        clock = self._reynard.clock
+        next_time = clock.now()
+        while True:
+            next_time += period
+            now = clock.now()
+            if next_time < now:
+                next_time = now
+            await clock.sleep(next_time - now)
+            self._push(_format_state(self._reynard.state))
+
+    def _subscribe(self, topic, rate=None):
+        if topic == "STATE":
+            self._unsubscribe("STATE")
+            self._state_task = asyncio.create_task(self._push_state(1.0 / min(rate, self._max_subscribe_rate)))
+        else:
+            self._subscribe_message = True
+            self._push_messages()
+        return "OK\n"
+
+    def _unsubscribe(self, topic=None):
+        if topic in (None, "STATE") and self._state_task is not None:
+            self._state_task.cancel()
+            self._state_task = None
+        if topic in (None, "MESSAGE"):
+            self._subscribe_message = False
+        return "OK\n"
+
+    async def run(self):
+        # Clients may pipeline commands. All complete lines received in a single read are processed in order
+        # and the responses are sent using a single write.
+        buf = b""
+        try:
+            while True:
+                try:
+                    data = await self._reader.read(self._read_size)
+                except (ConnectionResetError, ConnectionAbortedError):
+                    return
+                if data:
+                    buf += data
+                    lines = buf.split(b"\n")
+                    buf = lines.pop()
+                    if len(buf) > self._max_line_length:
+                        return
                 else:
-                    assert False, "Invalid command"
+                    lines = [buf] if buf else []
 
-            except Exception as e:
-                ret = f"ERROR {repr(e)}\n"
+                res = []
+                for l in lines:
+                    t0 = time.perf_counter()
+                    ret = await self._process_line(l.decode("utf-8", errors="replace"))
+                    if ret is not None:
+                        res.append(ret)
+                    # Only known command names are used as labels so clients cannot create unbounded label values
+                    command = l.split(None, 1)[0].decode("ascii", errors="replace") if l.strip() else ""
+                    self._command_seconds.observe(time.perf_counter() - t0,
+                                                  command if command in _commands else "INVALID")
+
+                if res:
+                    try:
+                        self._writer.write("".join(res).encode("utf-8"))
+                        await self._writer.drain()
+                    except Exception:
+                        return
+                if not data:
+                    return
+        finally:
+            self._reynard.new_message.disconnect(self._new_message)
+            self._unsubscribe()
+            self.close()
+
+    def _parse(self, s1):
+        # Returns the Reynard batch command to execute, the function to format the result, and the time to wait
+        # after executing the command. Commands that are handled by the connection return None for the command.
+        if s1[0] == "TELEPORT":
+            assert len(s1) == 3
+            x = float(s1[1])
+            y = float(s1[2])
+            return ("teleport", (x, y)), _format_ok, 0
+        elif s1[0] == "SAY":
+            assert len(s1) == 2
+            msg = s1[1]
+            return ("say", (msg,)), _format_ok, 0
+        elif s1[0] == "SETARM":
+            assert len(s1) == 4
+            q1 = float(s1[1])
+            q2 = float(s1[2])
+            q3 = float(s1[3])
+            return ("set_arm_position", (q1, q2, q3)), _format_ok, 0
+        elif s1[0] == "MOVETOOL":
+            assert len(s1) in (3, 4)
+            args = tuple(float(v) for v in s1[1:])
+            return ("move_tool_to", args), _format_move_tool, 0
+        elif s1[0] == "DRIVE":
+            assert len(s1) >= 3
+            vel_x = float(s1[1])
+            vel_y = float(s1[2])
+            timeout = -1
+            if len(s1) >= 4:
+                timeout = float(s1[3])
+            wait = False
+            if len(s1) >= 5:
+                wait = bool(s1[4])
+            return ("drive_robot", (vel_x, vel_y, timeout)), _format_ok, max(timeout, 0) if wait else 0
+        elif s1[0] == "DRIVEARM":
+            assert len(s1) >= 4
+            q1 = float(s1[1])
+            q2 = float(s1[2])
+            q3 = float(s1[3])
+            timeout = -1
+            if len(s1) >= 5:
+                timeout = float(s1[4])
+            wait = False
+            if len(s1) >= 6:
+                wait = bool(s1[5])
+            return ("drive_arm", (q1, q2, q3, timeout)), _format_ok, max(timeout, 0) if wait else 0
+        elif s1[0] == "STATE":
+            assert len(s1) == 1
+            return ("state", ()), _format_state, 0
+        elif s1[0] == "TOOLPOSE":
+            assert len(s1) == 1
+            return ("state", ()), _format_tool_pose, 0
+        elif s1[0] == "COLORGET":
+            assert len(s1) == 1
+            return ("state", ()), _format_color, 0
+        elif s1[0] == "COLORSET":
+            assert len(s1) == 4
+            r = float(s1[1])
+            g = float(s1[2])
+            b = float(s1[3])
+            return ("set_color", (r, g, b)), _format_ok, 0
+        elif s1[0] == "TRAJ":
+            assert len(s1) >= 2
+            return ("execute_trajectory", (_parse_traj(s1),)), _format_traj, 0
+        elif s1[0] == "TRAJSTATUS":
+            assert len(s1) == 1
+            return ("trajectory_status", ()), _format_traj_status, 0
+        elif s1[0] == "TRAJCANCEL":
+            assert len(s1) == 1
+            return ("cancel_trajectory", ()), _format_ok, 0
+        elif s1[0] == "MESSAGE":
+            assert len(s1) <= 2
+            if len(s1) == 2:
+                after = int(s1[1])
+                assert after >= 0, "Sequence number must not be negative"
+                return None, lambda _: self._read_message_after(after), 0
+            return None, self._read_message, 0
+        elif s1[0] == "HISTORY":
+            assert len(s1) in (2, 3)
+            since = float(s1[1])
+            count = int(s1[2]) if len(s1) == 3 else self._max_history_lines
+            assert 0 < count <= self._max_history_lines, f"Count must be between 1 and {self._max_history_lines}"
+            return None, lambda _: self._read_history(since, count), 0
+        elif s1[0] == "SUBSCRIBE":
+            assert len(s1) >= 2
+            if s1[1] == "STATE":
+                assert len(s1) == 3
+                rate = float(s1[2])
+                assert rate > 0, "Rate must be greater than zero"
+                return None, lambda _: self._subscribe("STATE", rate), 0
+            assert s1[1] == "MESSAGE" and len(s1) == 2, "Invalid subscription"
+            return None, lambda _: self._subscribe("MESSAGE"), 0
+        elif s1[0] == "UNSUBSCRIBE":
+            assert len(s1) <= 2
+            topic = s1[1] if len(s1) == 2 else None
+            assert topic in (None, "STATE", "MESSAGE"), "Invalid subscription"
+            return None, lambda _: self._unsubscribe(topic), 0
+        else:
+            assert False, "Invalid command"
+
+    def _read_message(self, _):
+        messages = self._reynard.messages.read(self._message_cursor, 1)
+        if not messages:
+            return "NOMESSAGE\n"
+        self._message_cursor, msg = messages[0]
+        return f"MESSAGE \"{msg}\"\n"
+
+    def _read_message_after(self, after):
+        # Reads the oldest message kept after a sequence number without moving the cursor of the connection
+        messages = self._reynard.messages.read(after, 1)
+        if not messages:
+            return "NOMESSAGE\n"
+        seqno, msg = messages[0]
+        return f"MESSAGE {seqno} \"{msg}\"\n"
+
+    def _read_history(self, since, count):
+        # One line for each state after the since time, with the sequence number followed by the other columns
+        rows = self._reynard.history.view(np.nextafter(since, np.inf))[:count].tolist()
+        lines = [f"HISTORY {len(rows)}\n"]
+        for r in rows:
+            lines.append(f"{int(r[0])} {' '.join(map(str, r[1:]))}\n")
+        return "".join(lines)
+
+    async def _process_line(self, l):
+        if self._batch is not None:
+            if l.split() == ["END"]:
+                return await self._run_batch()
+            if len(self._batch) >= self._max_batch_length:
+                self._batch = None
+                return "ERROR BATCH too long\n"
+            self._batch.append(l)
+            return None
+
+        try:
+            s1 = _tokenize(l)
+            if s1[0] == "BATCH":
+                assert len(s1) == 1
+                self._batch = []
+                return None
+            op, fmt, wait = self._parse(s1)
+            if op is None:
+                return fmt(None)
+            if op[0] == "state":
+                # Snapshots can be read without the lock
+                return fmt(self._reynard.state)
+            res = (await self._reynard.aio_execute_batch([op]))[0]
+            if isinstance(res, Exception):
+                raise res
+            if wait:
+                await self._reynard.clock.sleep(wait)
+            return fmt(res)
+        except Exception as e:
+            return f"ERROR {repr(e)}\n"
+
+    async def _run_batch(self):
+        # Execute the commands between BATCH and END with a single acquisition of the Reynard lock. One response
+        # line is returned for each command, followed by END.
+        lines = self._batch
+        self._batch = None
 
+        parsed = []
+        for l in lines:
             try:
-                self._f.writelines([ret])
-                self._f.flush()
-            except:
-                return
+                op, fmt, wait = self._parse(_tokenize(l))
+                assert op is not None, "Command not allowed in batch"
+                assert not wait, "Wait not allowed in batch"
+                parsed.append((op, fmt))
+            except Exception as e:
+                parsed.append(e)
+
+        results = iter(await self._reynard.aio_execute_batch([p[0] for p in parsed if not isinstance(p, Exception)]))
+
+        ret = []
+        for p in parsed:
+            if isinstance(p, Exception):
+                ret.append(f"ERROR {repr(p)}\n")
+                continue
+            r = next(results)
+            if isinstance(r, Exception):
+                ret.append(f"ERROR {repr(r)}\n")
+            else:
+                ret.append(p[1](r))
+        ret.append("END\n")
+        return "".join(ret)
 
     def close(self):
-        self._s.close()
+        self._writer.close()
 
 
 class ReynardAsciiSocketServer:
-    def __init__(self, reynard, host="localhost", port=29202):
-        self._keepgoing = True
+    """
+    ASCII socket server for Reynard the Robot. The server runs on the event loop of the Reynard object, and each
+    connection is handled by an asyncio task that calls the AIO API of Reynard directly.
+
+    By default the server is started on the event loop of a Reynard object that was started using ``start()``.
+    When using AIO, pass ``start=False`` and use ``aio_start`` and ``aio_close`` instead.
+
+    :param reynard: The Reynard object to control
+    :type reynard: Reynard
+    :param host: The host to bind the server to. Default is localhost. Set to an empty string to bind to all
+                 interfaces.
+    :type host: str
+    :param port: The port to bind the server to. Default is 29202.
+    :type port: int
+    :param start: If True, start the server on the event loop thread of Reynard. Default is True.
+    :type start: bool
+    """
+
+    def __init__(self, reynard, host="localhost", port=29202, start=True):
         self._reynard = reynard
         self._host = host
         self._port = port
-        self._connections = weakref.WeakSet()
+        self._connections = set()
+        self._server = None
 
-        self._s_server = socket.create_server((host, port))
-        self._s_server.listen()
+        if start:
+            asyncio.run_coroutine_threadsafe(self.aio_start(), self._reynard._loop).result()
 
-        self._thread = threading.Thread(target=self._run)
-        self._thread.daemon = True
-        self._thread.start()
+    async def aio_start(self):
+        """
+        AIO version of start. Start the server on the running event loop.
+        Use with await in an async function.
+        """
+        self._server = await asyncio.start_server(self._client_connected, self._host or None, self._port)
 
-    def _run(self):
-        while self._keepgoing:
-            try:
-                s, _ = self._s_server.accept()
-                if not s:
-                    return
-                c = ReynardAsciiSocketConnection(self._reynard, s)
-                self._connections.add(c)
-            except Exception:
-                if not self._keepgoing:
-                    return
-                else:
-                    raise
-
-    def close(self):
-        self._keepgoing = False
-        self._s_server.close()
+    async def _client_connected(self, reader, writer):
+        c = ReynardAsciiSocketConnection(self._reynard, reader, writer)
+        self._connections.add(c)
+        try:
+            await c.run()
+        finally:
+            self._connections.discard(c)
 
+    async def aio_close(self):
+        """
+        AIO version of close. Stop the server and close all connections.
+        Use with await in an async function.
+        """
+        if self._server is not None:
+            self._server.close()
         connections = list(self._connections)
-        for s in connections:
+        for c in connections:
             with suppress(Exception):
-                s.close()
+                c.close()
+
+    def close(self):
+        """
+        Stop the server and close all connections.
+        """
+        loop = self._reynard._loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.aio_close(), loop).result()
@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import importlib.metadata
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .reynard import Reynard
+from .fleet import ReynardFleet
+from .ascii_socket import ReynardAsciiSocketServer
+from .kinematics import forward_kinematics, inverse_kinematics, reynard_kinematics
+
+_frontends = ["api", "aio", "sync", "http", "ascii", "robotraconteur", "kinematics"]
+
+
+def _summarize(latencies, elapsed, errors):
+    # Latencies are in seconds. The summary reports milliseconds.
+    lat = np.array(latencies, dtype=np.float64) * 1e3
+    res = {
+        "count": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0
+    }
+    if len(lat) > 0:
+        p50, p90, p99 = np.percentile(lat, [50, 90, 99]).tolist()
+        res.update({
+            "mean_ms": float(np.mean(lat)),
+            "p50_ms": p50,
+            "p90_ms": p90,
+            "p99_ms": p99,
+            "max_ms": float(np.max(lat))
+        })
+    return res
+
+
+def _run_threads(connect, op, concurrency, duration, warmup):
+    # Runs op in a loop on concurrency threads, each with its own client from connect, and measures the latency
+    # of each call. Calls during the warmup time are not measured.
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+    times = dict()
+
+    def worker(i):
+        client = connect()
+        try:
+            barrier.wait()
+            t_start = times["start"]
+            t_end = times["end"]
+            lat = latencies[i]
+            while True:
+                t0 = time.perf_counter()
+                if t0 >= t_end:
+                    break
+                try:
+                    op(client)
+                except Exception:
+                    errors[i] += 1
+                    continue
+                t1 = time.perf_counter()
+                if t0 >= t_start:
+                    lat.append(t1 - t0)
+        finally:
+            close = getattr(client, "close", None)
+            if close is not None:
+                close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    now = time.perf_counter()
+    times["start"] = now + warmup
+    times["end"] = now + warmup + duration
+    barrier.wait()
+    for t in threads:
+        t.join()
+    return _summarize([x for lat in latencies for x in lat], duration, sum(errors))
+
+
+async def _run_tasks(op, concurrency, duration, warmup):
+    # AIO version of _run_threads. All tasks run on the Reynard event loop.
+    latencies = []
+    errors = 0
+    now = time.perf_counter()
+    t_start = now + warmup
+    t_end = t_start + duration
+
+    async def worker():
+        nonlocal errors
+        while True:
+            t0 = time.perf_counter()
+            if t0 >= t_end:
+                break
+            try:
+                await op()
+            except Exception:
+                errors += 1
+                continue
+            t1 = time.perf_counter()
+            if t0 >= t_start:
+                latencies.append(t1 - t0)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return _summarize(latencies, duration, errors)
+
+
+class _AsciiClient:
+    def __init__(self, host, port):
+        self._sock = socket.create_connection((host, port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rwb")
+
+    def command(self, line):
+        self._file.write(line)
+        self._file.flush()
+        res = self._file.readline()
+        if not res or res.startswith(b"ERROR"):
+            raise Exception(f"ASCII command failed: {res!r}")
+        return res
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def _version():
+    try:
+        return importlib.metadata.version("reynard-the-robot")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def _api_ops(reynard):
+    # The Python API has no per-client connection, all threads call the same Reynard object
+    def connect():
+        return None
+
+    return {
+        "set_arm_position": (connect, lambda _: reynard.set_arm_position(10, 20, 30)),
+        "state": (connect, lambda _: reynard.state),
+        "tool_pose": (connect, lambda _: reynard.state.tool_pose)
+    }
+
+
+def _aio_ops(reynard):
+    async def get_state():
+        return reynard.state
+
+    return {
+        "set_arm_position": lambda: reynard.aio_set_arm_position(10, 20, 30),
+        "state": get_state
+    }
+
+
+def _busy_loop(loop, chunk=0.001):
+    # Keep the event loop busy, as when it is serving other clients, by blocking it for chunk seconds at a time.
+    # Returns a function that stops the busy task.
+    stop = threading.Event()
+
+    async def busy():
+        while not stop.is_set():
+            time.sleep(chunk)
+            await asyncio.sleep(0)
+
+    fut = asyncio.run_coroutine_threadsafe(busy(), loop)
+
+    def close():
+        stop.set()
+        fut.result()
+
+    return close
+
+
+def _sync_benchmarks(robots, concurrency, duration, warmup):
+    # Compare the ways a command can reach the state of a robot: a synchronous method called from a thread, which
+    # takes the state lock directly ("direct"), the round trip through the event loop the synchronous methods used
+    # before ("loop"), and an AIO method awaited in a task on the event loop ("aio"). Each is measured with an idle
+    # event loop and with a busy event loop. The p50 speedup of "direct" over "loop" is added to the "direct"
+    # results.
+    results = dict()
+    for robot_name, (robot, loop) in robots.items():
+        def direct(_):
+            robot.set_arm_position(10, 20, 30)
+
+        def round_trip(_):
+            asyncio.run_coroutine_threadsafe(robot.aio_set_arm_position(10, 20, 30), loop).result()
+
+        for suffix in ("", "_busy"):
+            stop_busy = _busy_loop(loop) if suffix else None
+            try:
+                r_direct = _run_threads(lambda: None, direct, concurrency, duration, warmup)
+                r_loop = _run_threads(lambda: None, round_trip, concurrency, duration, warmup)
+                r_aio = asyncio.run_coroutine_threadsafe(
+                    _run_tasks(lambda: robot.aio_set_arm_position(10, 20, 30), concurrency, duration, warmup),
+                    loop).result()
+            finally:
+                if stop_busy is not None:
+                    stop_busy()
+            if r_direct["count"] > 0 and r_loop["count"] > 0:
+                r_direct["speedup_p50"] = r_loop["p50_ms"] / r_direct["p50_ms"]
+            results[f"sync.{robot_name}.direct{suffix}"] = r_direct
+            results[f"sync.{robot_name}.loop{suffix}"] = r_loop
+            results[f"sync.{robot_name}.aio{suffix}"] = r_aio
+    return results
+
+
+def _http_ops(host, port):
+    import requests
+    base_url = f"http://{host}:{port}/api"
+
+    def set_arm_position(s):
+        s.post(base_url + "/arm", json={"q1": 10, "q2": 20, "q3": 30}).raise_for_status()
+
+    def state(s):
+        s.get(base_url + "/state").raise_for_status()
+
+    return {
+        "set_arm_position": (requests.Session, set_arm_position),
+        "state": (requests.Session, state)
+    }
+
+
+def _ascii_ops(host, port):
+    def connect():
+        return _AsciiClient(host, port)
+
+    return {
+        "set_arm_position": (connect, lambda c: c.command(b"SETARM 10 20 30\n")),
+        "state": (connect, lambda c: c.command(b"STATE\n"))
+    }
+
+
+def _robotraconteur_ops(port, closers):
+    import RobotRaconteur as RR
+    url = f"rr+tcp://localhost:{port}?service=reynard"
+    client_node = RR.RobotRaconteurNode()
+    client_node.Init()
+    closers.append(RR.ClientNodeSetup(node=client_node, argv=[]).close)
+    q = np.deg2rad([10, 20, 30]).tolist()
+
+    class _Client:
+        def __init__(self):
+            self.c = client_node.ConnectService(url)
+
+        def close(self):
+            client_node.DisconnectService(self.c)
+
+    return {
+        "set_arm_position": (_Client, lambda c: c.c.setf_arm_position(*q)),
+        "state": (_Client, lambda c: c.c.state.PeekInValue())
+    }
+
+
+def _kinematics_ops(batch_size, ik_batch_size):
+    # Kinematics does not use the server. Random configurations within the joint limits are evaluated one at a time
+    # and in a single batch. The inverse kinematics targets are the tool positions of the configurations, solved
+    # from the default starting points, and warm started from configurations a few degrees away.
+    q_bounds = reynard_kinematics["q_bounds"]
+    rng = np.random.default_rng(0)
+    q = rng.uniform(q_bounds[0], q_bounds[1], (batch_size, 3))
+    ik_q = q[:ik_batch_size]
+    ik_targets = forward_kinematics(ik_q)[:, 0:2]
+    ik_warm = np.clip(ik_q + rng.uniform(-5, 5, ik_q.shape), q_bounds[0], q_bounds[1])
+
+    def connect():
+        return None
+
+    return {
+        "forward_single": (connect, lambda _: forward_kinematics(q[0])),
+        "forward_batch": (connect, lambda _: forward_kinematics(q)),
+        "inverse_single": (connect, lambda _: inverse_kinematics(ik_targets[0], initial_arm_positions=ik_warm[0])),
+        "inverse_batch": (connect, lambda _: inverse_kinematics(ik_targets)),
+        "inverse_batch_warm": (connect, lambda _: inverse_kinematics(ik_targets, initial_arm_positions=ik_warm))
+    }
+
+
+def run_benchmark(frontends=None, concurrency=1, duration=5.0, warmup=1.0, http_port=29211, ascii_port=29212,
+                  robotraconteur_port=29210, fleet_port=29213, update_rate=20.0, kinematics_batch_size=1000000,
+                  ik_batch_size=10000):
+    """
+    Start Reynard in this process and measure the command latency and throughput of each front end. Each front end
+    is measured with a command that changes the state (``set_arm_position``) and a command that reads the state
+    (``state``). The measurements are run one at a time with ``concurrency`` clients each sending commands in a
+    loop for ``duration`` seconds. The ``kinematics`` benchmark measures ``forward_kinematics`` for a single
+    configuration and for a batch of ``kinematics_batch_size`` configurations, and ``inverse_kinematics`` for a
+    single target and for a batch of ``ik_batch_size`` targets, without using a front end.
+
+    The ``sync`` benchmark compares the latency of ``set_arm_position`` on ``Reynard`` and on a ``ReynardFleet``
+    robot when called from a thread, which takes the state lock directly, when sent through the event loop with
+    ``asyncio.run_coroutine_threadsafe`` as the synchronous methods did before, and when awaited in a task on the
+    event loop. Each is measured with an idle event loop and with an event loop kept busy by a task that blocks it
+    for 1 ms at a time. The p50 speedup of the direct call over the event loop round trip is reported as
+    ``speedup_p50``.
+
+    :param frontends: The front ends to measure. Available front ends are ``api``, ``aio``, ``sync``, ``http``,
+                      ``ascii``, ``robotraconteur`` and ``kinematics``. Default is all front ends.
+    :type frontends: list
+    :param concurrency: The number of concurrent clients. Default is 1.
+    :type concurrency: int
+    :param duration: The measurement time of each benchmark in seconds. Default is 5.
+    :type duration: float
+    :param warmup: The time before each measurement where commands are sent but not measured. Default is 1.
+    :type warmup: float
+    :param http_port: The port for the HTTP server. Default is 29211.
+    :type http_port: int
+    :param ascii_port: The port for the ASCII socket server. Default is 29212.
+    :type ascii_port: int
+    :param robotraconteur_port: The port for the Robot Raconteur service. Default is 29210.
+    :type robotraconteur_port: int
+    :param fleet_port: The port for the HTTP server of the fleet used by the ``sync`` benchmark. Default is 29213.
+    :type fleet_port: int
+    :param update_rate: The rate of the simulation loop in Hz. Default is 20.
+    :type update_rate: float
+    :param kinematics_batch_size: The number of configurations in the forward kinematics batch. Default is 1000000.
+    :type kinematics_batch_size: int
+    :param ik_batch_size: The number of targets in the inverse kinematics batch. Default is 10000.
+    :type ik_batch_size: int
+    :return: The results as a dictionary with the settings and a result for each front end and command
+    :rtype: dict
+    """
+    if frontends is None:
+        frontends = _frontends
+    for f in frontends:
+        if f not in _frontends:
+            raise ValueError(f"Unknown front end: {f}")
+
+    results = dict()
+    closers = []
+    reynard = Reynard("localhost", http_port, update_rate, enable_http="http" in frontends)
+    reynard.start()
+    ascii_server = None
+    rr_server = None
+    fleet = None
+    try:
+        if "ascii" in frontends:
+            ascii_server = ReynardAsciiSocketServer(reynard, "localhost", ascii_port)
+        if "robotraconteur" in frontends:
+            from .robotraconteur import ReynardRobotRaconteurService
+            rr_server = ReynardRobotRaconteurService(
+                reynard, [f"--robotraconteur-tcp-port={robotraconteur_port}"])
+
+        for f in frontends:
+            if f == "aio":
+                for name, op in _aio_ops(reynard).items():
+                    results[f"{f}.{name}"] = asyncio.run_coroutine_threadsafe(
+                        _run_tasks(op, concurrency, duration, warmup), reynard._loop).result()
+                continue
+            if f == "sync":
+                fleet = ReynardFleet(1, "localhost", fleet_port, update_rate)
+                fleet.start()
+                results.update(_sync_benchmarks({"reynard": (reynard, reynard._loop),
+                                                 "fleet": (fleet[0], fleet._loop)},
+                                                concurrency, duration, warmup))
+                continue
+            if f == "api":
+                ops = _api_ops(reynard)
+            elif f == "http":
+                ops = _http_ops("localhost", http_port)
+            elif f == "ascii":
+                ops = _ascii_ops("localhost", ascii_port)
+            elif f == "kinematics":
+                ops = _kinematics_ops(kinematics_batch_size, min(ik_batch_size, kinematics_batch_size))
+            else:
+                ops = _robotraconteur_ops(robotraconteur_port, closers)
+            for name, (connect, op) in ops.items():
+                results[f"{f}.{name}"] = _run_threads(connect, op, concurrency, duration, warmup)
+            if f == "kinematics":
+                for name, n in (("forward_batch", kinematics_batch_size), ("inverse_batch", ik_batch_size),
+                                ("inverse_batch_warm", ik_batch_size)):
+                    r = results[f"kinematics.{name}"]
+                    r["batch_size"] = n
+                    r["configurations_per_second"] = r["throughput"] * n
+    finally:
+        for close in closers:
+            close()
+        if ascii_server is not None:
+            ascii_server.close()
+        if rr_server is not None:
+            rr_server.close()
+        if fleet is not None:
+            fleet.close()
+        reynard.close()
+
+    return {
+        "version": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "concurrency": concurrency,
+        "duration": duration,
+        "warmup": warmup,
+        "update_rate": update_rate,
+        "kinematics_batch_size": kinematics_batch_size,
+        "ik_batch_size": ik_batch_size,
+        "results": results
+    }
+
+
+def _print_results(res):
+    print(f"{'benchmark':<32}{'ops/s':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for name, r in res["results"].items():
+        if r["count"] == 0:
+            print(f"{name:<32}{0.0:>12.1f}{'-':>10}{'-':>10}{'-':>10}{'-':>10}{r['errors']:>8}")
+            continue
+        print(f"{name:<32}{r['throughput']:>12.1f}{r['p50_ms']:>10.3f}{r['p90_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+              f"{r['max_ms']:>10.3f}{r['errors']:>8}")
+    for name, r in res["results"].items():
+        if "speedup_p50" in r:
+            print(f"{name}: {r['speedup_p50']:.1f}x lower p50 latency than the event loop round trip")
+
+
+def main():
+    parser = argparse.ArgumentParser("reynard_the_robot.benchmark",
+                                     description="Measure the latency and throughput of the Reynard front ends")
+    parser.add_argument("--frontends", default=",".join(_frontends),
+                        help=f"Comma separated list of front ends to measure. Default is {','.join(_frontends)}")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=5.0, help="Measurement time of each benchmark in seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Warmup time of each benchmark in seconds")
+    parser.add_argument("--http-port", type=int, default=29211, help="Port for HTTP server")
+    parser.add_argument("--ascii-socket-port", type=int, default=29212, help="Port for ASCII socket server")
+    parser.add_argument("--robotraconteur-port", type=int, default=29210, help="Port for Robot Raconteur service")
+    parser.add_argument("--fleet-port", type=int, default=29213, help="Port for fleet HTTP server")
+    parser.add_argument("--update-rate", type=float, default=20.0, help="Simulation loop rate in Hz")
+    parser.add_argument("--kinematics-batch-size", type=int, default=1000000,
+                        help="Number of configurations in the forward kinematics batch benchmark")
+    parser.add_argument("--ik-batch-size", type=int, default=10000,
+                        help="Number of targets in the inverse kinematics batch benchmark")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to a file")
+    args = parser.parse_args()
+
+    frontends = [f.strip() for f in args.frontends.split(",") if f.strip()]
+    res = run_benchmark(frontends, args.concurrency, args.duration, args.warmup, args.http_port,
+                        args.ascii_socket_port, args.robotraconteur_port, args.fleet_port, args.update_rate,
+                        args.kinematics_batch_size, args.ik_batch_size)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=4)
+    if args.json:
+        json.dump(res, sys.stdout, indent=4)
+        print()
+    else:
+        _print_results(res)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class WallClock:
+    """
+    Clock that follows real time. The time starts at 0 when the clock is created.
+    """
+
+    virtual = False
+
+    def __init__(self):
+        self._t0 = time.perf_counter()
+
+    def now(self):
+        """
+        Get the current time of the clock in seconds.
+        """
+        return time.perf_counter() - self._t0
+
+    async def sleep(self, seconds):
+        """
+        Sleep for the given number of seconds of clock time. Use with await in an async function.
+
+        :param seconds: The time to sleep in seconds
+        :type seconds: float
+        """
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Clock that is advanced explicitly instead of following real time. When a Reynard simulation is run with a
+    virtual clock, the simulation loop advances the clock by one period each tick. Sleeps on the clock complete when
+    the clock has been advanced past their deadline.
+
+    A running clock lets the simulation loop run as fast as the CPU allows. A paused clock only runs when it is
+    stepped, and the simulation loop waits without using the CPU in between. Use ``step`` or ``aio_step`` to run the
+    simulation for a given time, for example in tests.
+
+    The ``pause``, ``resume`` and ``step`` methods can be called from any thread. The other methods must only be
+    used from the thread running the event loop.
+
+    :param start_time: The initial time of the clock in seconds. Default is 0.
+    :type start_time: float
+    :param paused: If True, the clock starts paused. Default is False.
+    :type paused: bool
+    """
+
+    virtual = True
+
+    def __init__(self, start_time=0.0, paused=False):
+        self._time = float(start_time)
+        self._waiters = []
+        self._counter = itertools.count()
+        self._paused = paused
+        # While paused, the clock may run up to the target time set by step
+        self._target = self._time
+        self._loop = None
+        self._stepped = None
+        self._running_to = False
+        self._step_waiters = []
+
+    def now(self):
+        """
+        Get the current time of the clock in seconds.
+        """
+        return self._time
+
+    def advance(self, dt):
+        """
+        Advance the clock by the given time.
+
+        :param dt: The time to advance the clock in seconds
+        :type dt: float
+        """
+        self.advance_to(self._time + dt)
+
+    def advance_to(self, t):
+        """
+        Advance the clock to the given time and wake sleepers with expired deadlines. The clock is not changed if
+        the time is earlier than the current time.
+
+        :param t: The new time of the clock in seconds
+        :type t: float
+        """
+        if t > self._time:
+            self._time = float(t)
+        if self._time > self._target:
+            self._target = self._time
+        while self._waiters and self._waiters[0][0] <= self._time:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def sleep(self, seconds):
+        """
+        Sleep until the clock has been advanced by the given number of seconds. Use with await in an async function.
+
+        :param seconds: The time to sleep in seconds
+        :type seconds: float
+        """
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        self._loop = asyncio.get_running_loop()
+        fut = self._loop.create_future()
+        heapq.heappush(self._waiters, (self._time + seconds, next(self._counter), fut))
+        await fut
+
+    @property
+    def paused(self):
+        """
+        True if the clock only runs when it is stepped.
+        """
+        return self._paused
+
+    def pause(self):
+        """
+        Pause the clock. The simulation loop stops at the next tick until the clock is stepped or resumed.
+        """
+        self._paused = True
+
+    def resume(self):
+        """
+        Resume the clock, so the simulation loop runs as fast as the CPU allows.
+        """
+        self._paused = False
+        self._call_soon(self._wake)
+
+    async def aio_step(self, dt):
+        """
+        AIO version of step. Run a paused clock for the given time and wait until it has been reached.
+        Use with await in an async function.
+
+        :param dt: The time to run the clock in seconds
+        :type dt: float
+        """
+        if not self._paused:
+            raise RuntimeError("Only a paused clock can be stepped")
+        self._target = max(self._target, self._time) + dt
+        if not self._running_to:
+            # No simulation loop is running on the clock, so only the sleepers need to be woken
+            self.advance_to(self._target)
+            await asyncio.sleep(0)
+            return
+        # Wait until the simulation loop has run the ticks up to the target and is waiting for the next step
+        fut = asyncio.get_running_loop().create_future()
+        self._step_waiters.append((self._target, fut))
+        self._wake()
+        await fut
+
+    def step(self, dt):
+        """
+        Run a paused clock for the given time. Blocks until the simulation loop has run to the new time. This
+        synchronous method must not be called from the thread running the event loop, use aio_step instead.
+
+        :param dt: The time to run the clock in seconds
+        :type dt: float
+        """
+        if self._loop is None:
+            # The clock is not used by a running event loop yet, so there are no ticks to wait for
+            if not self._paused:
+                raise RuntimeError("Only a paused clock can be stepped")
+            self.advance(dt)
+            return
+        asyncio.run_coroutine_threadsafe(self.aio_step(dt), self._loop).result()
+
+    async def run_to(self, t):
+        """
+        Advance the clock to the given time. If the clock is paused, waits until the clock has been stepped to the
+        time, advancing the clock as far as allowed in the meantime. Used by the simulation loop to run to the next
+        tick deadline.
+
+        :param t: The new time of the clock in seconds
+        :type t: float
+        """
+        self._loop = asyncio.get_running_loop()
+        # The simulation loop is running on the clock until run_to is cancelled
+        self._running_to = True
+        try:
+            # Deadlines accumulate rounding errors, so a deadline within a nanosecond of the target is reached
+            while self._paused and t - self._target > 1e-9:
+                self.advance_to(self._target)
+                self._release_steps()
+                self._stepped = self._loop.create_future()
+                await self._stepped
+        except BaseException:
+            self._running_to = False
+            self._release_steps(all_steps=True)
+            raise
+        self.advance_to(t)
+        if not self._paused:
+            self._release_steps()
+
+    def _release_steps(self, all_steps=False):
+        # Complete the aio_step calls whose target has been reached
+        waiters = self._step_waiters
+        self._step_waiters = [w for w in waiters if w[0] > self._time and not all_steps]
+        for target, fut in waiters:
+            if (all_steps or target <= self._time) and not fut.done():
+                fut.set_result(None)
+
+    def _wake(self):
+        if self._stepped is not None and not self._stepped.done():
+            self._stepped.set_result(None)
+
+    def _call_soon(self, callback):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(callback)
@@ -0,0 +1,981 @@
+from aiohttp import web
+import socketio
+import asyncio
+import time
+import warnings
+from threading import Thread, Event
+from urllib.parse import parse_qs
+
+import importlib_resources
+import numpy as np
+import blinker
+
+from .kinematics import forward_kinematics, inverse_kinematics, reynard_kinematics
+from .scheduler import FixedRateScheduler
+from .clock import WallClock
+from .state import ReynardState
+from .messages import MessageLog
+from . import rest
+from .profiler import SamplingProfiler
+from .runtime import get_loop_profile
+from .metrics import MetricsRegistry, TimedThreadLock, add_reynard_metrics, add_server_metrics
+
+
+def _active_dt(t0, t1, start_time, stop_time):
+    # Vectorized version of reynard._active_dt
+    t0 = np.maximum(t0, start_time)
+    t1 = np.where(stop_time >= 0, np.minimum(t1, stop_time), t1)
+    return np.maximum(t1 - t0, 0.0)
+
+
+class ReynardFleet:
+    """
+    The ReynardFleet class hosts many instances of Reynard the Robot in a single process. The state of all robots
+    is stored in shared NumPy arrays, and all robots are advanced together in a single vectorized integration step.
+    A single web server, socket.io server and event loop are shared by all robots in the fleet.
+
+    Each robot in the fleet is accessed using a ``ReynardFleetRobot`` handle, which provides the motion, color,
+    message, state and batch API of the ``Reynard`` class. Handles are retrieved by indexing the fleet, for example
+    ``fleet[3]``. Trajectories, the state history, recording and replay, streamed setpoints and the ``state_tick``
+    signal are only available on ``Reynard``. The ASCII socket server and the Robot Raconteur service use these
+    features, so they only support ``Reynard`` and are not started in fleet mode.
+
+    The GUI for a robot is accessed using the URL ``http://localhost:29201/robots/<id>/``, and the HTTP REST API
+    for a robot is available under ``http://localhost:29201/api/robots/<id>/``.
+
+    The start or aio_start method must be called to start the fleet server. The close method should be called
+    to stop the fleet server.
+
+    :param count: The number of robots in the fleet
+    :type count: int
+    :param host: The host to bind the fleet server to. Default is localhost. Set to 0.0.0.0 to bind to all interfaces.
+    :type host: str
+    :param port: The port to bind the fleet server to. Default is 29201.
+    :type port: int
+    :param update_rate: The rate of the simulation loop in Hz. Default is 20 Hz.
+    :type update_rate: float
+    :param clock: The clock used for the simulation time. Default is a ``WallClock`` that follows real time.
+    :type clock: WallClock or VirtualClock
+    :param loop_profile: The settings of the event loop created by ``start()``. See ``Reynard``.
+    :type loop_profile: LoopProfile or str
+    :param obstacles: Obstacles that the robots stop at, shared by all robots. The robots do not collide with each
+                      other. Default is None.
+    :type obstacles: ObstacleMap
+    :param message_capacity: The number of messages kept in the message log of each robot. Default is 1000.
+    :type message_capacity: int
+    """
+
+    def __init__(self, count, host="localhost", port=29201, update_rate=20.0, clock=None, loop_profile=None,
+                 obstacles=None, message_capacity=1000):
+        if count < 1:
+            raise ValueError("Fleet must contain at least one robot")
+        self.app = web.Application()
+        self.socketio = socketio.AsyncServer(async_mode='aiohttp')
+        self.socketio.attach(self.app)
+        self._host = host
+        self._port = port
+        self._loop = None
+        self._started = Event()
+        self._loop_profile = get_loop_profile(loop_profile)
+        self._clock = clock if clock is not None else WallClock()
+        self._scheduler = FixedRateScheduler(update_rate, clock=self._clock)
+        self._vel_loop_task = None
+
+        self._metrics = MetricsRegistry()
+        self._state_lock = TimedThreadLock(*add_reynard_metrics(self._metrics, self._scheduler))
+        self._metrics.callback("reynard_socketio_clients", "Connected socket.io clients",
+                               lambda: len(self._sid_robot))
+        self._tick_seconds = self._metrics["reynard_tick_seconds"]
+        self._profiler = SamplingProfiler()
+        self._emit_seconds = self._metrics["reynard_emit_seconds"]
+        self._collision_total = self._metrics["reynard_collision_stops_total"]
+        self._obstacles = obstacles
+
+        self._pos = np.zeros((count, 2), dtype=np.float64)
+        self._last_update_pos = np.copy(self._pos)
+        self._q = np.zeros((count, 3), dtype=np.float64)
+        self._last_update_q = np.copy(self._q)
+        self._vel = np.zeros((count, 2), dtype=np.float64)
+        self._vel_start_time = np.zeros((count,), dtype=np.float64)
+        self._vel_stop_time = np.full((count,), -1, dtype=np.float64)
+        self._q_vel = np.zeros((count, 3), dtype=np.float64)
+        self._q_vel_start_time = np.zeros((count,), dtype=np.float64)
+        self._q_vel_stop_time = np.full((count,), -1, dtype=np.float64)
+        self._color = np.tile(np.array([0.929, 0.49, 0.192], dtype=np.float64), (count, 1))
+
+        self._seqno = 0
+        self._snapshot = None
+        self._publish_snapshot(self._clock.now())
+        self._pending_events = []
+        self._robots = [ReynardFleetRobot(self, i, message_capacity) for i in range(count)]
+        self._sid_robot = dict()
+
+        static_path = importlib_resources.files('reynard_the_robot').joinpath('web_static')
+
+        async def serve(request):
+            path = request.match_info.get('path', '') or 'index.html'
+            return web.FileResponse(static_path / path)
+
+        async def redirect_robot(request):
+            raise web.HTTPFound(f"/robots/{self._get_robot(request).robot_id}/")
+
+        add_server_metrics(self.app, self._metrics)
+        self._register_api()
+        self.app.router.add_get('/robots/{robot_id}', redirect_robot)
+        self.app.router.add_get('/robots/{robot_id}/{path:.*}', serve)
+        self.app.router.add_get('/', serve)
+        self.app.router.add_get('/{path:.*}', serve)
+
+        self.socketio.on('connect', self._connect_cb)
+        self.socketio.on('disconnect', self._disconnect_cb)
+        self.socketio.on('new_message', self._new_message_cb)
+
+    def __len__(self):
+        return len(self._robots)
+
+    def __getitem__(self, robot_id):
+        return self._robots[robot_id]
+
+    def __iter__(self):
+        return iter(self._robots)
+
+    @property
+    def robots(self):
+        """
+        Get the list of ``ReynardFleetRobot`` handles in the fleet.
+        """
+        return list(self._robots)
+
+    @staticmethod
+    def _room(robot_id):
+        return f"robot{robot_id}"
+
+    async def _connect_cb(self, sid, environ, auth=None):
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        try:
+            robot_id = int(query.get("robot", ["0"])[0])
+        except ValueError:
+            return False
+        if robot_id < 0 or robot_id >= len(self._robots):
+            return False
+        self._sid_robot[sid] = robot_id
+        await self.socketio.enter_room(sid, self._room(robot_id))
+
+    def _disconnect_cb(self, sid, *args):
+        self._sid_robot.pop(sid, None)
+
+    def _new_message_cb(self, sid, message):
+        robot_id = self._sid_robot.get(sid)
+        if robot_id is None:
+            return
+        self._robots[robot_id]._new_message_cb(message)
+
+    async def aio_start(self):
+        """
+        AIO version of start. Must be called to start the fleet server.
+        Use with await in an async function.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, self._host, self._port)
+        await self._site.start()
+
+        self._vel_loop_task = asyncio.create_task(self._vel_loop())
+
+    def _step(self, t, dt):
+        # Advance all robots with a single vectorized integration step over the real elapsed time dt ending
+        # at time t. Returns the indices of the robots that have moved far enough to require a GUI update.
+        t0 = t - dt
+        vel_dt = _active_dt(t0, t, self._vel_start_time, self._vel_stop_time)
+        q_vel_dt = _active_dt(t0, t, self._q_vel_start_time, self._q_vel_stop_time)
+        obstacles = self._obstacles
+        if obstacles is not None:
+            pos = self._pos.copy()
+            q = self._q.copy()
+        self._pos += self._vel * vel_dt[:, None]
+        np.clip(self._pos, reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1], out=self._pos)
+        self._q += self._q_vel * q_vel_dt[:, None]
+        np.clip(self._q, reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1], out=self._q)
+
+        vel_stop = (self._vel_stop_time >= 0) & (t >= self._vel_stop_time)
+        self._vel[vel_stop] = 0
+        self._vel_stop_time[vel_stop] = -1
+        q_vel_stop = (self._q_vel_stop_time >= 0) & (t >= self._q_vel_stop_time)
+        self._q_vel[q_vel_stop] = 0
+        self._q_vel_stop_time[q_vel_stop] = -1
+
+        if obstacles is not None:
+            # Robots whose straight line motion during the tick would touch an obstacle stop at their last free
+            # position. Robots that were already touching an obstacle when the obstacles were set can move freely
+            hit = np.flatnonzero(np.any(self._pos != pos, axis=1) | np.any(self._q != q, axis=1))
+            hit = hit[~obstacles.check(pos[hit], q[hit])]
+            hit = hit[obstacles.check_motion(pos[hit], q[hit], self._pos[hit], self._q[hit])]
+            if len(hit) > 0:
+                self._pos[hit] = pos[hit]
+                self._q[hit] = q[hit]
+                self._vel[hit] = 0
+                self._vel_stop_time[hit] = -1
+                self._q_vel[hit] = 0
+                self._q_vel_stop_time[hit] = -1
+                self._collision_total.inc(amount=len(hit))
+
+        moved = (np.linalg.norm(self._last_update_pos - self._pos, axis=1) > 2) \
+            | np.any(np.abs(self._last_update_q - self._q) > 2, axis=1)
+        updated = np.flatnonzero(moved)
+        self._last_update_pos[updated] = self._pos[updated]
+        self._last_update_q[updated] = self._q[updated]
+        return updated
+
+    def _publish_snapshot(self, t):
+        # Must be called with _state_lock held at the end of each tick. The state of all robots is copied into a single
+        # read-only array and published as one tuple, so readers see the state of a complete tick without the lock.
+        # The ReynardState of a robot is created from its row when it is read.
+        self._seqno += 1
+        data = np.concatenate((self._pos, self._q, self._vel, self._q_vel, self._color), axis=1)
+        data.flags.writeable = False
+        self._snapshot = (self._seqno, t, data)
+
+    async def _vel_loop(self):
+        self._scheduler.start()
+        while True:
+            t, dt = await self._scheduler.wait_next()
+            t0 = time.perf_counter()
+            async with self._state_lock:
+                updated = self._step(t, dt)
+                self._publish_snapshot(t)
+                events = self._pending_events
+                self._pending_events = []
+                pos = self._pos[updated].tolist()
+                arm = self._q[updated].tolist()
+            t1 = time.perf_counter()
+            for i, event, data in events:
+                await self.socketio.emit(event, data, room=self._room(i))
+            for i, p, q in zip(updated, pos, arm):
+                await self.socketio.emit('update', {'x': p[0], 'y': p[1], 'q1': q[0],
+                                                    'q2': q[1], 'q3': q[2]}, room=self._room(i))
+            t2 = time.perf_counter()
+            self._emit_seconds.observe(t2 - t1)
+            self._tick_seconds.observe(t2 - t0)
+
+    @property
+    def obstacles(self):
+        """
+        Get or set the ``ObstacleMap`` shared by all robots, or None for no obstacles. See ``Reynard.obstacles``.
+        """
+        return self._obstacles
+
+    @obstacles.setter
+    def obstacles(self, obstacles):
+        # Replacing the reference is atomic, the simulation loop reads it once per tick
+        self._obstacles = obstacles
+
+    @property
+    def aio_lock(self):
+        """
+        Deprecated. The state of the fleet is protected by a thread lock instead of an ``asyncio.Lock``, so the
+        synchronous methods of the robots do not wait for the event loop. This alias of the thread lock can still be
+        used with ``async with``, but it must not be held across slow awaits. Use ``aio_execute_batch`` of a robot to
+        run several commands atomically.
+        """
+        warnings.warn("ReynardFleet.aio_lock is deprecated, use aio_execute_batch to run commands atomically",
+                      DeprecationWarning, stacklevel=2)
+        return self._state_lock
+
+    @property
+    def tool_poses(self):
+        """
+        Get the tool pose of every robot in the fleet at the last tick as an N x 3 array of ``[x, y, theta]``,
+        computed together in a single call to ``forward_kinematics``.
+        """
+        data = self._snapshot[2]
+        return forward_kinematics(data[:, 2:5], data[:, 0:2])
+
+    @property
+    def metrics(self):
+        """
+        Get the ``MetricsRegistry`` containing the instrumentation metrics of the fleet. The metrics are also
+        available in the Prometheus text format at ``GET /metrics``.
+        """
+        return self._metrics
+
+    @property
+    def profiler(self):
+        """
+        Get the ``SamplingProfiler`` used by the ``POST /api/debug/profile`` endpoint.
+        """
+        return self._profiler
+
+    @property
+    def loop_profile(self):
+        """
+        Get the ``LoopProfile`` used to create the event loop.
+        """
+        return self._loop_profile
+
+    @property
+    def loop_debug(self):
+        """
+        Get or set the asyncio debug mode of the running event loop. Debug mode can be enabled at runtime to
+        diagnose slow callbacks, and should be disabled again afterwards since it slows down the server.
+        """
+        return self._loop is not None and self._loop.get_debug()
+
+    @loop_debug.setter
+    def loop_debug(self, enabled):
+        self._loop.call_soon_threadsafe(self._loop.set_debug, bool(enabled))
+
+    @property
+    def loop_stats(self):
+        """
+        Get the timing statistics of the simulation loop as a dictionary. See ``Reynard.loop_stats``.
+        """
+        return self._scheduler.stats()
+
+    def start(self):
+        """
+        Start the fleet server. This synchronous method should be used with the standard Python threading model.
+        A thread will be created to run the server. If you are using AIO, use aio_start instead.
+        """
+        self.thread = Thread(target=self._run, name="ReynardFleet")
+        self.thread.daemon = True
+        self.thread.start()
+        self._started.wait()
+
+    def _run(self):
+        self._loop = self._loop_profile.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self.aio_start())
+        self._started.set()
+        self._loop.run_forever()
+
+    def close(self):
+        """
+        Close the fleet server. This synchronous method should be used with the standard Python threading model.
+        This is not needed when using AIO.
+        """
+        if self._loop.is_running():
+            self._loop.stop()
+
+    def _get_robot(self, request):
+        try:
+            robot_id = int(request.match_info["robot_id"])
+        except ValueError:
+            raise web.HTTPNotFound()
+        if robot_id < 0 or robot_id >= len(self._robots):
+            raise web.HTTPNotFound()
+        return self._robots[robot_id]
+
+    def _register_api(self):
+        async def api_get_robots(request):
+            return web.json_response(list(range(len(self._robots))))
+
+        async def api_post_debug_profile(request):
+            return await rest.handle_profile(request, self._profiler)
+
+        async def api_get_messages(request):
+            robot = self._get_robot(request)
+            if "after" in request.query:
+                return rest.handle_messages(request, robot.messages)
+            # Without a cursor, return the messages not returned by the previous request
+            messages = robot.messages.read(robot._api_msg_cursor)
+            if messages:
+                robot._api_msg_cursor = messages[-1][0]
+            return web.json_response([m for _, m in messages])
+
+        async def api_post_teleport(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            await robot.aio_teleport(json["x"], json["y"])
+            return web.Response()
+
+        async def api_post_say(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            await robot.aio_say(json["message"])
+            return web.Response()
+
+        async def api_post_arm(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            await robot.aio_set_arm_position(json["q1"], json["q2"], json["q3"])
+            return web.Response()
+
+        async def api_post_move_tool_to(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            try:
+                q1, q2, q3 = (await robot.aio_move_tool_to(json["x"], json["y"], json.get("theta"))).tolist()
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            return web.json_response({"q1": q1, "q2": q2, "q3": q3})
+
+        async def api_post_drive_robot(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            timeout = float(json.get("timeout", -1))
+            wait = bool(json.get("wait", False))
+            await robot.aio_drive_robot(json["vel_x"], json["vel_y"], timeout, wait)
+            return web.Response()
+
+        async def api_post_drive_arm(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            timeout = float(json.get("timeout", -1))
+            wait = bool(json.get("wait", False))
+            await robot.aio_drive_arm(json["q1"], json["q2"], json["q3"], timeout, wait)
+            return web.Response()
+
+        async def api_post_color(request):
+            robot = self._get_robot(request)
+            json = await request.json()
+            await robot.aio_set_color(json["r"], json["g"], json["b"])
+            return web.Response()
+
+        async def api_get_state(request):
+            robot = self._get_robot(request)
+            fields = rest.parse_state_fields(request)
+            return web.json_response(robot.state.to_dict(fields))
+
+        async def api_post_batch(request):
+            return await rest.handle_batch(request, self._get_robot(request))
+
+        async def api_get_state_ws(request):
+            return await rest.handle_state_websocket(request, self._get_robot(request))
+
+        async def api_get_state_events(request):
+            return await rest.handle_state_events(request, self._get_robot(request))
+
+        async def api_get_color(request):
+            robot = self._get_robot(request)
+            c = robot.state.color.tolist()
+            return web.json_response({"r": c[0], "g": c[1], "b": c[2]})
+
+        async def api_clock(request):
+            return await rest.handle_clock(request, self._clock)
+
+        async def api_get_obstacles(request):
+            obstacles = self._obstacles
+            return web.json_response(obstacles.to_dict() if obstacles is not None else None)
+
+        async def api_put_obstacles(request):
+            self.obstacles = await rest.parse_obstacles(request)
+            return web.Response()
+
+        async def api_post_obstacles_check(request):
+            return await rest.handle_obstacles_check(request, self._obstacles)
+
+        prefix = '/api/robots/{robot_id}'
+        self.app.router.add_get('/api/robots', api_get_robots)
+        self.app.router.add_post('/api/kinematics/forward', rest.handle_forward_kinematics)
+        self.app.router.add_post('/api/kinematics/inverse', rest.handle_inverse_kinematics)
+        self.app.router.add_get('/api/obstacles', api_get_obstacles)
+        self.app.router.add_put('/api/obstacles', api_put_obstacles)
+        self.app.router.add_post('/api/obstacles/check', api_post_obstacles_check)
+        self.app.router.add_post('/api/debug/profile', api_post_debug_profile)
+        self.app.router.add_get('/api/clock', api_clock)
+        self.app.router.add_post('/api/clock', api_clock)
+        self.app.router.add_get(prefix + '/messages', api_get_messages)
+        self.app.router.add_post(prefix + '/teleport', api_post_teleport)
+        self.app.router.add_post(prefix + '/say', api_post_say)
+        self.app.router.add_post(prefix + '/arm', api_post_arm)
+        self.app.router.add_post(prefix + '/drive_robot', api_post_drive_robot)
+        self.app.router.add_post(prefix + '/drive_arm', api_post_drive_arm)
+        self.app.router.add_post(prefix + '/color', api_post_color)
+        self.app.router.add_get(prefix + '/state', api_get_state)
+        self.app.router.add_get(prefix + '/state/ws', api_get_state_ws)
+        self.app.router.add_get(prefix + '/state/events', api_get_state_events)
+        self.app.router.add_get(prefix + '/color', api_get_color)
+        self.app.router.add_post(prefix + '/set_arm_position', api_post_arm)
+        self.app.router.add_post(prefix + '/move_tool_to', api_post_move_tool_to)
+        self.app.router.add_post(prefix + '/batch', api_post_batch)
+
+
+class ReynardFleetRobot:
+    """
+    Handle for a single robot in a ``ReynardFleet``. This class provides the same Python API as the ``Reynard``
+    class, but the state is stored in the shared arrays of the fleet. Do not construct this class directly,
+    instead index the fleet using ``fleet[robot_id]``.
+    """
+
+    def __init__(self, fleet, robot_id, message_capacity=1000):
+        self._fleet = fleet
+        self._robot_id = robot_id
+        self._new_message = blinker.Signal()
+        self._messages = MessageLog(message_capacity)
+        self._api_msg_cursor = 0
+        # Snapshot published by the last command, and the snapshot created from the last tick of the fleet
+        self._command_state = None
+        self._tick_state = None
+
+    def _new_message_cb(self, message):
+        seqno = self._messages.append(message)
+        self._new_message.send(None, message=message, seqno=seqno)
+
+    @property
+    def robot_id(self):
+        """
+        Get the index of the robot in the fleet.
+        """
+        return self._robot_id
+
+    @property
+    def fleet(self):
+        """
+        Get the fleet that contains the robot.
+        """
+        return self._fleet
+
+    @property
+    def aio_lock(self):
+        """
+        Deprecated. See ``ReynardFleet.aio_lock``.
+        """
+        return self._fleet.aio_lock
+
+    @property
+    def _loop(self):
+        return self._fleet._loop
+
+    @property
+    def clock(self):
+        """
+        Get the clock used for the simulation time.
+        """
+        return self._fleet._clock
+
+    @property
+    def metrics(self):
+        """
+        Get the ``MetricsRegistry`` of the fleet.
+        """
+        return self._fleet._metrics
+
+    def _queue_emit(self, event, data):
+        self._fleet._pending_events.append((self._robot_id, event, data))
+
+    def _publish_state(self):
+        # Must be called with _state_lock held after a command modifies the state of the robot. The snapshot is used
+        # until the next tick of the fleet publishes a newer one.
+        f = self._fleet
+        i = self._robot_id
+        f._seqno += 1
+        self._command_state = ReynardState(f._seqno, f._clock.now(), f._pos[i], f._q[i], f._vel[i], f._q_vel[i],
+                                           f._color[i])
+
+    def _teleport(self, x, y):
+        # Command implementations, must be called with _state_lock held. See the methods of the same name in Reynard.
+        x, y = np.clip([x, y], reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1])
+        f = self._fleet
+        i = self._robot_id
+        self._check_obstacles([x, y], f._q[i])
+        f._vel[i] = 0
+        f._pos[i] = (x, y)
+        self._publish_state()
+        self._queue_emit('teleport', {'x': x, 'y': y})
+
+    def _say(self, message):
+        self._queue_emit('say', message)
+
+    def _check_obstacles(self, pos, q):
+        obstacles = self._fleet._obstacles
+        if obstacles is not None and obstacles.check(pos, q):
+            raise ValueError("Robot would collide with an obstacle")
+
+    def _set_arm_position(self, q1, q2, q3):
+        q1, q2, q3 = np.clip([q1, q2, q3], reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1])
+        f = self._fleet
+        i = self._robot_id
+        self._check_obstacles(f._pos[i], [q1, q2, q3])
+        f._q_vel[i] = 0
+        f._q[i] = (q1, q2, q3)
+        self._publish_state()
+        self._queue_emit('arm', {'q1': q1, 'q2': q2, 'q3': q3})
+
+    def _move_tool_to(self, x, y, theta=None):
+        f = self._fleet
+        i = self._robot_id
+        q, ok = inverse_kinematics([x, y], theta, f._pos[i], f._q[i])
+        if not ok:
+            raise ValueError("Tool target is not reachable")
+        self._set_arm_position(*q)
+        return q
+
+    def _drive_robot(self, vel_x, vel_y, timeout=-1):
+        vel_x, vel_y = np.clip([vel_x, vel_y], -reynard_kinematics["vel_max"], reynard_kinematics["vel_max"])
+        f = self._fleet
+        i = self._robot_id
+        f._vel[i] = (vel_x, vel_y)
+        f._vel_start_time[i] = f._clock.now()
+        if timeout > 0:
+            f._vel_stop_time[i] = f._vel_start_time[i] + timeout
+        else:
+            f._vel_stop_time[i] = -1
+        self._publish_state()
+
+    def _drive_arm(self, q1, q2, q3, timeout=-1):
+        q1, q2, q3 = np.clip([q1, q2, q3], -reynard_kinematics["q_vel_max"], reynard_kinematics["q_vel_max"])
+        f = self._fleet
+        i = self._robot_id
+        f._q_vel[i] = (q1, q2, q3)
+        f._q_vel_start_time[i] = f._clock.now()
+        if timeout > 0:
+            f._q_vel_stop_time[i] = f._q_vel_start_time[i] + timeout
+        else:
+            f._q_vel_stop_time[i] = -1
+        self._publish_state()
+
+    def _set_color(self, r, g, b):
+        r, g, b = np.clip([r, g, b], 0, 1.0)
+        self._fleet._color[self._robot_id] = (r, g, b)
+        self._publish_state()
+        self._queue_emit('color', {'r': r, 'g': g, 'b': b})
+
+    def _get_state(self):
+        return self.state
+
+    async def aio_teleport(self, x, y):
+        """
+        AIO version of teleport. Teleport the robot to a new position instantly.
+        Use with await in an async function.
+
+        :param x: The x position to teleport the robot to in millimeters
+        :type x: float
+        :param y: The y position to teleport the robot to in millimeters
+        :type y: float
+        """
+        async with self._fleet._state_lock:
+            self._teleport(x, y)
+
+    async def aio_say(self, message):
+        """
+        AIO version of say. Make the robot say a message.
+        Use with await in an async function.
+
+        :param message: The message to say
+        :type message: str
+        """
+        async with self._fleet._state_lock:
+            self._say(message)
+
+    async def aio_set_arm_position(self, q1, q2, q3):
+        """
+        AIO version of set_arm_position. Set the position of the robot's arm joints instantly.
+        Use with await in an async function.
+
+        :param q1: The position of the first arm joint in degrees
+        :type q1: float
+        :param q2: The position of the second arm joint in degrees
+        :type q2: float
+        :param q3: The position of the third arm joint in degrees
+        :type q3: float
+        """
+        async with self._fleet._state_lock:
+            self._set_arm_position(q1, q2, q3)
+
+    async def aio_move_tool_to(self, x, y, theta=None):
+        """
+        AIO version of move_tool_to. Set the arm joints instantly so the tool reaches a target pose.
+        Use with await in an async function.
+
+        :param x: The x position of the tool tip in millimeters
+        :type x: float
+        :param y: The y position of the tool tip in millimeters
+        :type y: float
+        :param theta: The angle of the tool in degrees, or None to reach the position with any tool angle. Default
+                      is None.
+        :type theta: float
+        :return: The new position of the arm joints in degrees
+        :rtype: numpy.ndarray
+        """
+        async with self._fleet._state_lock:
+            return self._move_tool_to(x, y, theta)
+
+    async def aio_drive_robot(self, vel_x, vel_y, timeout=-1, wait=False):
+        """
+        AIO version of drive_robot. Drive the robot's base in the x and y directions at a given velocity.
+        Use with await in an async function.
+
+        :param vel_x: The velocity in the x direction in millimeters per second
+        :type vel_x: float
+        :param vel_y: The velocity in the y direction in millimeters per second
+        :type vel_y: float
+        :param timeout: The time to drive the robot at the given velocity. If timeout is less than 0, the robot will
+                        continue indefinitely. Default is -1.
+        :type timeout: float
+        :param wait: If wait is True, the function will wait until the timeout has expired before returning.
+                     Default is False.
+        """
+        async with self._fleet._state_lock:
+            self._drive_robot(vel_x, vel_y, timeout)
+        if wait:
+            await self._fleet._clock.sleep(timeout)
+
+    async def aio_drive_arm(self, q1, q2, q3, timeout=-1, wait=False):
+        """
+        AIO version of drive_arm. Drive the robot's arm joints at a given angular velocity.
+        Use with await in an async function.
+
+        :param q1: The angular velocity of the first arm joint in degrees per second
+        :type q1: float
+        :param q2: The angular velocity of the second arm joint in degrees per second
+        :type q2: float
+        :param q3: The angular velocity of the third arm joint in degrees per second
+        :type q3: float
+        """
+        async with self._fleet._state_lock:
+            self._drive_arm(q1, q2, q3, timeout)
+        if wait:
+            await self._fleet._clock.sleep(timeout)
+
+    async def aio_set_color(self, r, g, b):
+        """
+        AIO version of property set color. Set the color of the robot's body as an RGB tuple between 0 and 1.
+        Use with await in an async function.
+
+        :param r: The red component of the color between 0 and 1
+        :type r: float
+        :param g: The green component of the color between 0 and 1
+        :type g: float
+        :param b: The blue component of the color between 0 and 1
+        :type b: float
+        """
+        async with self._fleet._state_lock:
+            self._set_color(r, g, b)
+
+    async def aio_execute_batch(self, commands):
+        """
+        AIO version of execute_batch. Execute a list of commands atomically.
+        Use with await in an async function.
+
+        :param commands: The commands to execute as a list of ``(name, args)`` tuples
+        :type commands: list
+        :return: The result of each command, or the exception raised by the command
+        :rtype: list
+        """
+        async with self._fleet._state_lock:
+            return self._execute_batch(commands)
+
+    def _execute_batch(self, commands):
+        # Must be called with _state_lock held
+        batch_commands = {
+            "teleport": self._teleport,
+            "say": self._say,
+            "set_arm_position": self._set_arm_position,
+            "move_tool_to": self._move_tool_to,
+            "drive_robot": self._drive_robot,
+            "drive_arm": self._drive_arm,
+            "set_color": self._set_color,
+            "state": self._get_state
+        }
+        results = []
+        for name, args in commands:
+            try:
+                results.append(batch_commands[name](*args))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _wait(self, timeout):
+        # A virtual clock can only be waited on from the event loop
+        if self._fleet._clock.virtual:
+            asyncio.run_coroutine_threadsafe(self._fleet._clock.sleep(timeout), self._loop).result()
+        elif timeout > 0:
+            time.sleep(timeout)
+
+    def teleport(self, x, y):
+        """
+        Instantly move the robot to a new position.
+
+        :param x: The x position to teleport the robot to in millimeters
+        :type x: float
+        :param y: The y position to teleport the robot to in millimeters
+        :type y: float
+        """
+        with self._fleet._state_lock:
+            self._teleport(x, y)
+
+    def say(self, message):
+        """
+        Make the robot say a message.
+
+        :param message: The message to say
+        :type message: str
+        """
+        with self._fleet._state_lock:
+            self._say(message)
+
+    def set_arm_position(self, q1, q2, q3):
+        """
+        Instantly set the position of the robot's arm joints.
+
+        :param q1: The position of the first arm joint in degrees
+        :type q1: float
+        :param q2: The position of the second arm joint in degrees
+        :type q2: float
+        :param q3: The position of the third arm joint in degrees
+        :type q3: float
+        """
+        with self._fleet._state_lock:
+            self._set_arm_position(q1, q2, q3)
+
+    def move_tool_to(self, x, y, theta=None):
+        """
+        Instantly set the position of the robot's arm joints so the tool reaches a target pose. See
+        ``Reynard.move_tool_to``.
+
+        :param x: The x position of the tool tip in millimeters
+        :type x: float
+        :param y: The y position of the tool tip in millimeters
+        :type y: float
+        :param theta: The angle of the tool in degrees, or None to reach the position with any tool angle. Default
+                      is None.
+        :type theta: float
+        :return: The new position of the arm joints in degrees
+        :rtype: numpy.ndarray
+        """
+        with self._fleet._state_lock:
+            return self._move_tool_to(x, y, theta)
+
+    def drive_robot(self, vel_x, vel_y, timeout=-1, wait=False):
+        """
+        Drive the robot's base in the x and y directions at a given velocity.
+
+        :param vel_x: The velocity in the x direction in millimeters per second
+        :type vel_x: float
+        :param vel_y: The velocity in the y direction in millimeters per second
+        :type vel_y: float
+        :param timeout: The time to drive the robot at the given velocity. If timeout is less than 0, the robot will
+                        continue indefinitely. Default is -1.
+        :type timeout: float
+        :param wait: If wait is True, the function will wait until the timeout has expired before returning.
+                        Default is False.
+        :type wait: bool
+        """
+        with self._fleet._state_lock:
+            self._drive_robot(vel_x, vel_y, timeout)
+        if wait:
+            self._wait(timeout)
+
+    def drive_arm(self, q1, q2, q3, timeout=-1, wait=False):
+        """
+        Drive the robot's arm joints at a given angular velocity.
+
+        :param q1: The angular velocity of the first arm joint in degrees per second
+        :type q1: float
+        :param q2: The angular velocity of the second arm joint in degrees per second
+        :type q2: float
+        :param q3: The angular velocity of the third arm joint in degrees per second
+        :type q3: float
+        :param timeout: The time to drive the robot at the given velocity. If timeout is less than 0, the robot will
+                        continue indefinitely. Default is -1.
+        :type timeout: float
+        :param wait: If wait is True, the function will wait until the timeout has expired before returning.
+                        Default is False.
+        """
+        with self._fleet._state_lock:
+            self._drive_arm(q1, q2, q3, timeout)
+        if wait:
+            self._wait(timeout)
+
+    def execute_batch(self, commands):
+        """
+        Execute a list of commands atomically. See ``Reynard.execute_batch``.
+
+        :param commands: The commands to execute as a list of ``(name, args)`` tuples
+        :type commands: list
+        :return: The result of each command, or the exception raised by the command
+        :rtype: list
+        """
+        with self._fleet._state_lock:
+            return self._execute_batch(commands)
+
+    @property
+    def state(self):
+        """
+        Get the latest immutable snapshot of the robot's state as a ``ReynardState``. A snapshot is published by
+        each tick of the fleet and after each command that changes the state of the robot. The sequence number is
+        shared by all robots in the fleet, so it increases but does not increase by one for each snapshot of a robot.
+        """
+        seqno, t, data = self._fleet._snapshot
+        state = self._command_state
+        if state is not None and state.seqno > seqno:
+            return state
+        state = self._tick_state
+        if state is None or state.seqno != seqno:
+            d = data[self._robot_id]
+            state = ReynardState(seqno, t, d[0:2], d[2:5], d[5:7], d[7:10], d[10:13])
+            self._tick_state = state
+        return state
+
+    @property
+    def arm_position(self):
+        """
+        Get the current position of the robot's arm joints in degrees. The returned array is read-only.
+        """
+        return self.state.arm_position
+
+    @property
+    def robot_position(self):
+        """
+        Get the current position of the robot's base. The returned array is read-only.
+        """
+        return self.state.robot_position
+
+    @property
+    def tool_pose(self):
+        """
+        Get the current pose of the robot's tool as ``[x, y, theta]``, with the position of the tool tip in
+        millimeters and the angle of the tool in degrees. The returned array is read-only.
+        """
+        return self.state.tool_pose
+
+    @property
+    def robot_velocity(self):
+        """
+        Get the current velocity of the robot's base. The returned array is read-only.
+        """
+        return self.state.robot_velocity
+
+    @property
+    def arm_velocity(self):
+        """
+        Get the current velocity of the robot's arm joints. The returned array is read-only.
+        """
+        return self.state.arm_velocity
+
+    @property
+    def time(self):
+        """
+        Get the current simulation time in seconds.
+        """
+        return self._fleet._clock.now()
+
+    @property
+    def color(self):
+        """
+        Get or set the color of the robot's body as an RGB tuple between 0 and 1. Use aio_set_color to set the color
+        when using AIO. The returned array is read-only.
+        """
+        return self.state.color
+
+    @color.setter
+    def color(self, color):
+        with self._fleet._state_lock:
+            self._set_color(*color)
+
+    @property
+    def new_message(self):
+        """
+        Event for new messages received from the GUI for this robot. The receivers are called with the ``message``
+        and its ``seqno`` in ``messages`` as keyword arguments. This property is a blinker signal. Use the connect
+        method to connect to the signal.
+        """
+        return self._new_message
+
+    @property
+    def messages(self):
+        """
+        Get the ``MessageLog`` containing the recent messages received from the GUI for this robot.
+        """
+        return self._messages
@@ -0,0 +1,137 @@
+import threading
+
+import numpy as np
+
+from .state import ReynardState
+
+# Columns of the grouped fields returned by window. The state values are stored in the same order as the buffer of
+# ReynardState, after the sequence number and the time.
+_groups = {
+    "seqno": slice(0, 1),
+    "time": slice(1, 2),
+    "robot_position": slice(2, 4),
+    "arm_position": slice(4, 7),
+    "robot_velocity": slice(7, 9),
+    "arm_velocity": slice(9, 12),
+    "color": slice(12, 15)
+}
+
+
+class StateHistory:
+    """
+    Fixed capacity history of recent state snapshots. The snapshots are stored in a preallocated NumPy ring buffer,
+    so the memory used does not grow with the number of snapshots, and the oldest snapshots are overwritten when the
+    buffer is full. Snapshots must be appended in time order.
+
+    Each snapshot is written twice, so every time window is a contiguous part of the buffer and can be returned as a
+    view without copying. The history can be read from any thread while snapshots are appended.
+
+    :param capacity: The maximum number of snapshots kept. Default is 6000, five minutes at the default update rate.
+    :type capacity: int
+    """
+
+    # The names of the grouped fields returned by window, and the names of the columns of the arrays returned by view
+    fields = tuple(_groups)
+    columns = ReynardState.fields[0:15]
+
+    def __init__(self, capacity=6000):
+        if capacity < 1:
+            raise ValueError("History capacity must be at least 1")
+        self._capacity = capacity
+        self._data = np.zeros((2 * capacity, len(self.columns)), dtype=np.float64)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        """
+        The maximum number of snapshots kept.
+        """
+        return self._capacity
+
+    @property
+    def count(self):
+        """
+        The total number of snapshots appended, including the snapshots that were overwritten.
+        """
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    def append(self, state):
+        """
+        Append a snapshot, overwriting the oldest snapshot if the history is full.
+
+        :param state: The snapshot to append
+        :type state: ReynardState
+        """
+        with self._lock:
+            i = self._count % self._capacity
+            row = self._data[i]
+            row[0] = state.seqno
+            row[1] = state.time
+            row[2:] = state._data
+            self._data[i + self._capacity] = row
+            self._count += 1
+
+    def _slice(self, start_time, end_time):
+        # Rows of the buffer with the snapshots in the time window, oldest first. Must be called with the lock held.
+        n = min(self._count, self._capacity)
+        head = self._count % self._capacity if self._count > self._capacity else 0
+        t = self._data[head:head + n, 1]
+        i0 = 0 if start_time is None else int(np.searchsorted(t, start_time, "left"))
+        i1 = n if end_time is None else int(np.searchsorted(t, end_time, "right"))
+        return slice(head + i0, head + max(i0, i1))
+
+    def view(self, start_time=None, end_time=None):
+        """
+        Get a read-only view of the snapshots in a time window, without copying. The columns of the view are listed
+        in ``StateHistory.columns``, the rows are the snapshots from the oldest to the newest.
+
+        The view shares memory with the history, so the rows are overwritten when the history wraps around, about
+        ``capacity`` snapshots after they were appended. Use ``window`` to keep a copy.
+
+        :param start_time: The earliest time in seconds to include. Default is None, the oldest snapshot kept.
+        :type start_time: float
+        :param end_time: The latest time in seconds to include. Default is None, the newest snapshot.
+        :type end_time: float
+        :return: An N x 15 array view
+        :rtype: numpy.ndarray
+        """
+        with self._lock:
+            v = self._data[self._slice(start_time, end_time)]
+        v.flags.writeable = False
+        return v
+
+    def window(self, start_time=None, end_time=None, fields=None, max_count=None):
+        """
+        Copy the snapshots in a time window into packed arrays.
+
+        :param start_time: The earliest time in seconds to include. Default is None, the oldest snapshot kept.
+        :type start_time: float
+        :param end_time: The latest time in seconds to include. Default is None, the newest snapshot.
+        :type end_time: float
+        :param fields: The names of the fields to include. Default is all fields, listed in ``StateHistory.fields``.
+        :type fields: list
+        :param max_count: The maximum number of snapshots to return, starting from the earliest. Default is None,
+                          no limit.
+        :type max_count: int
+        :return: A dictionary with ``seqno`` and ``time`` arrays of N entries, and ``robot_position``,
+                 ``arm_position``, ``robot_velocity``, ``arm_velocity`` and ``color`` arrays of N rows
+        :rtype: dict
+        """
+        if fields is None:
+            fields = self.fields
+        for f in fields:
+            if f not in _groups:
+                raise ValueError(f"Invalid history field {f}")
+        with self._lock:
+            s = self._slice(start_time, end_time)
+            stop = s.stop if max_count is None else min(s.stop, s.start + max_count)
+            rows = self._data[s.start:stop].copy()
+        res = dict()
+        for f in fields:
+            c = rows[:, _groups[f]]
+            res[f] = c[:, 0].astype(np.uint64) if f == "seqno" else c[:, 0] if f == "time" else c
+        return res
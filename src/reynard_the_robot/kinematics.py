@@ -0,0 +1,243 @@
+import numpy as np
+
+# Kinematic parameters of Reynard in millimeters and degrees. The link vectors use the screen convention of the GUI
+# with the y axis pointing down, matching reynard_kinematics in app.js.
+reynard_kinematics = {
+    "body_offset": np.array([0, 70], dtype=np.float64),
+    "bounds": np.array([[-1000, -500], [1000, 500]], dtype=np.float64),
+    "p0": np.array([0, -95], dtype=np.float64),
+    "p1": np.array([170, 0], dtype=np.float64),
+    "p2": np.array([170, 0], dtype=np.float64),
+    "p3": np.array([60, 0], dtype=np.float64),
+    "q_bounds": np.array([[-10, -140, -175], [180, 140, 175]], dtype=np.float64),
+    "vel_max": np.array([100, 100], dtype=np.float64),
+    "q_vel_max": np.array([100, 100, 100], dtype=np.float64),
+    "body_size": np.array([320, 220], dtype=np.float64),
+    "link_width": 30.0
+}
+
+_flip_y = np.array([1, -1], dtype=np.float64)
+
+# Position of the body center and the first joint relative to the robot position, and the link vectors as the rows
+# of a 3 x 2 array, with the y axis pointing up
+_body_center = -reynard_kinematics["body_offset"] * _flip_y
+_shoulder = _body_center + reynard_kinematics["p0"] * _flip_y
+_links = np.stack([reynard_kinematics[p] * _flip_y for p in ("p1", "p2", "p3")])
+# Converts the joint angles in degrees to the absolute angle of each link in radians with one matrix product
+_cumulative = np.deg2rad(np.triu(np.ones((3, 3), dtype=np.float64)))
+
+
+def forward_kinematics(arm_positions, robot_positions=None):
+    """
+    Compute the pose of Reynard's tool for one or many configurations of the arm. The configurations are evaluated
+    together using NumPy, so millions of configurations can be evaluated in a single call.
+
+    The pose is returned as ``[x, y, theta]``, with the position of the tool tip in millimeters and the angle of the
+    tool in degrees, in the same frame as the robot position. The joint angles are not clipped to the joint limits.
+
+    :param arm_positions: The joint angles in degrees as ``[q1, q2, q3]``, or an N x 3 array of joint angles
+    :type arm_positions: numpy.ndarray
+    :param robot_positions: The position of the base in millimeters as ``[x, y]`` or an N x 2 array. Default is
+                            None, which computes the pose relative to the robot position.
+    :type robot_positions: numpy.ndarray
+    :return: The tool pose as ``[x, y, theta]``, or an N x 3 array of tool poses
+    :rtype: numpy.ndarray
+    """
+    q = np.asarray(arm_positions, dtype=np.float64)
+    if q.shape[-1:] != (3,):
+        raise ValueError("Arm positions must have 3 joint angles")
+    theta = q @ _cumulative
+    c = np.cos(theta)
+    s = np.sin(theta)
+    pose = np.empty(q.shape, dtype=np.float64)
+    pose[..., 0] = c @ _links[:, 0] - s @ _links[:, 1] + _shoulder[0]
+    pose[..., 1] = s @ _links[:, 0] + c @ _links[:, 1] + _shoulder[1]
+    pose[..., 2] = np.rad2deg(theta[..., 2])
+    if robot_positions is not None:
+        pose[..., 0:2] += robot_positions
+    return pose
+
+
+def link_positions(arm_positions, robot_positions=None):
+    """
+    Compute the positions of the arm joints and the tool tip for one or many configurations of the arm.
+
+    :param arm_positions: The joint angles in degrees as ``[q1, q2, q3]``, or an N x 3 array of joint angles
+    :type arm_positions: numpy.ndarray
+    :param robot_positions: The position of the base in millimeters as ``[x, y]`` or an N x 2 array. Default is
+                            None, which computes the positions relative to the robot position.
+    :type robot_positions: numpy.ndarray
+    :return: The positions in millimeters of the three joints followed by the tool tip as a 4 x 2 array, or an
+             N x 4 x 2 array
+    :rtype: numpy.ndarray
+    """
+    q = np.asarray(arm_positions, dtype=np.float64)
+    if q.shape[-1:] != (3,):
+        raise ValueError("Arm positions must have 3 joint angles")
+    theta = q @ _cumulative
+    c = np.cos(theta)
+    s = np.sin(theta)
+    p = np.empty(q.shape[:-1] + (4, 2), dtype=np.float64)
+    p[..., 0, :] = _shoulder
+    np.cumsum(c * _links[:, 0] - s * _links[:, 1], axis=-1, out=p[..., 1:, 0])
+    np.cumsum(s * _links[:, 0] + c * _links[:, 1], axis=-1, out=p[..., 1:, 1])
+    p[..., 1:, :] += _shoulder
+    if robot_positions is not None:
+        p += np.asarray(robot_positions, dtype=np.float64)[..., None, :]
+    return p
+
+
+# Scale of the tool angle error relative to the position error in millimeters per radian
+_angle_weight = 100.0
+_damping = 1.0
+_max_step = 0.5
+_reach = float(np.sum(np.linalg.norm(_links, axis=1)))
+# Starting points in degrees for targets without initial joint angles, and for restarts. The arm is bent in both
+# directions since the solver cannot leave a fully stretched configuration towards the base.
+_seeds = np.array([[90, 90, 90], [90, -90, -90], [170, 130, 100], [10, -130, -100], [10, 90, 90], [170, -90, -90]],
+                  dtype=np.float64)
+
+
+def _step(J, e):
+    # Damped least squares step J^T (J J^T + damping I)^-1 e for each row
+    m = J.shape[1]
+    JT = J.transpose((0, 2, 1))
+    A = J @ JT
+    A[:, np.arange(m), np.arange(m)] += _damping
+    return (JT @ np.linalg.solve(A, e[:, :, None]))[:, :, 0]
+
+
+def _solve(target, q, angle, tolerance, max_iterations):
+    # Damped least squares iterations for the rows of q in radians, projecting onto the joint limits after each
+    # step. Rows stop iterating once converged. Returns the solutions and a mask of the converged rows.
+    lower, upper = np.deg2rad(reynard_kinematics["q_bounds"])
+    n = q.shape[0]
+    m = 2 if angle is None else 3
+    done = np.zeros((n,), dtype=bool)
+    active = np.arange(n)
+    J = np.empty((n, m, 3), dtype=np.float64)
+    for _ in range(max_iterations + 1):
+        qa = q[active]
+        theta = np.cumsum(qa, axis=1)
+        c = np.cos(theta)
+        s = np.sin(theta)
+        # Link vectors rotated into the base frame, and the vector from each joint to the tool tip
+        vx = c * _links[:, 0] - s * _links[:, 1]
+        vy = s * _links[:, 0] + c * _links[:, 1]
+        rx = np.cumsum(vx[:, ::-1], axis=1)[:, ::-1]
+        ry = np.cumsum(vy[:, ::-1], axis=1)[:, ::-1]
+        e = np.empty((len(active), m), dtype=np.float64)
+        e[:, 0] = target[active, 0] - rx[:, 0]
+        e[:, 1] = target[active, 1] - ry[:, 0]
+        ok = np.abs(e[:, 0:2]).max(axis=1) <= tolerance
+        if m == 3:
+            a = angle[active] - theta[:, 2]
+            a = (a + np.pi) % (2 * np.pi) - np.pi
+            e[:, 2] = a * _angle_weight
+            ok &= np.abs(np.rad2deg(a)) <= tolerance
+        done[active[ok]] = True
+        keep = ~ok
+        active = active[keep]
+        if len(active) == 0:
+            break
+        e = e[keep]
+        Ja = J[:len(active)]
+        Ja[:, 0, :] = -ry[keep]
+        Ja[:, 1, :] = rx[keep]
+        if m == 3:
+            Ja[:, 2, :] = _angle_weight
+        qk = qa[keep]
+        dq = _step(Ja, e)
+        # Joints at a limit that would move further out are held, and the step is solved again for the others
+        held = ((qk <= lower) & (dq < 0)) | ((qk >= upper) & (dq > 0))
+        rows = held.any(axis=1)
+        if rows.any():
+            Jh = Ja[rows]
+            Jh *= ~held[rows][:, None, :]
+            dq[rows] = _step(Jh, e[rows])
+        np.clip(dq, -_max_step, _max_step, out=dq)
+        q[active] = np.clip(qk + dq, lower, upper)
+    return q, done
+
+
+def inverse_kinematics(tool_positions, tool_angles=None, robot_positions=None, initial_arm_positions=None,
+                       tolerance=0.01, max_iterations=50, restarts=6):
+    """
+    Compute the arm joint angles that place Reynard's tool at a target position, and optionally at a target angle,
+    for one or many targets. The targets are solved together using NumPy with a damped least squares iteration
+    that respects the joint limits.
+
+    The arm has three joints, so a position target without an angle has many solutions. The solver returns the
+    solution found from the initial joint angles, so pass the current joint angles to move the arm as little as
+    possible. Targets that do not converge from the initial joint angles are retried from ``restarts`` other
+    starting points. Targets that still do not converge are outside the reach of the arm or its joint limits, and
+    are reported as unsuccessful with the initial joint angles.
+
+    :param tool_positions: The target tool tip position in millimeters as ``[x, y]``, or an N x 2 array of targets
+    :type tool_positions: numpy.ndarray
+    :param tool_angles: The target tool angle in degrees, or an array of N angles. Default is None, which does not
+                        constrain the tool angle.
+    :type tool_angles: numpy.ndarray
+    :param robot_positions: The position of the base in millimeters as ``[x, y]`` or an N x 2 array. Default is
+                            None, which treats the targets as relative to the robot position.
+    :type robot_positions: numpy.ndarray
+    :param initial_arm_positions: The joint angles in degrees to start the search from as ``[q1, q2, q3]`` or an
+                                  N x 3 array. Default is None, which starts from the middle of the joint limits.
+    :type initial_arm_positions: numpy.ndarray
+    :param tolerance: The maximum position error in millimeters, and the maximum angle error in degrees. Default is
+                      0.01.
+    :type tolerance: float
+    :param max_iterations: The maximum number of iterations from each starting point. Default is 50.
+    :type max_iterations: int
+    :param restarts: The number of additional starting points for targets that do not converge. Default is 6.
+    :type restarts: int
+    :return: The joint angles in degrees as ``[q1, q2, q3]`` or an N x 3 array, and True or a boolean array of N
+             entries for the targets that were reached
+    :rtype: tuple
+    """
+    target = np.array(tool_positions, dtype=np.float64)
+    if target.shape[-1:] != (2,):
+        raise ValueError("Tool positions must have 2 coordinates")
+    single = target.ndim == 1
+    target = target.reshape((-1, 2))
+    n = target.shape[0]
+    if robot_positions is not None:
+        target -= np.broadcast_to(np.asarray(robot_positions, dtype=np.float64), (n, 2))
+    target -= _shoulder
+    angle = None
+    if tool_angles is not None:
+        angle = np.deg2rad(np.broadcast_to(np.asarray(tool_angles, dtype=np.float64), (n,)))
+
+    lower, upper = reynard_kinematics["q_bounds"]
+    if initial_arm_positions is None:
+        q0 = np.broadcast_to(_seeds[0], (n, 3))
+        seeds = _seeds[1:]
+    else:
+        q0 = np.broadcast_to(np.asarray(initial_arm_positions, dtype=np.float64), (n, 3))
+        seeds = _seeds
+    q = np.deg2rad(np.clip(q0, lower, upper))
+
+    # Targets beyond the length of the arm are rejected without iterating
+    reachable = np.hypot(target[:, 0], target[:, 1]) <= _reach + tolerance
+    success = np.zeros((n,), dtype=bool)
+    idx = np.flatnonzero(reachable)
+    rng = np.random.default_rng(0)
+    for i in range(restarts + 1):
+        if len(idx) == 0:
+            break
+        if i == 0:
+            start = q[idx]
+        elif i <= len(seeds):
+            start = np.broadcast_to(np.deg2rad(seeds[i - 1]), (len(idx), 3)).copy()
+        else:
+            start = np.deg2rad(rng.uniform(lower, upper, (len(idx), 3)))
+        sol, done = _solve(target[idx], start, angle[idx] if angle is not None else None, tolerance,
+                           max_iterations)
+        q[idx[done]] = sol[done]
+        success[idx[done]] = True
+        idx = idx[~done]
+
+    q = np.rad2deg(q)
+    if single:
+        return q[0], bool(success[0])
+    return q, success
@@ -1,4 +1,7 @@
 from .reynard import Reynard
+from .fleet import ReynardFleet
+from .clock import VirtualClock
+from .obstacles import ObstacleMap
 from .ascii_socket import ReynardAsciiSocketServer
 import drekar_launch_process
 import time
@@ -6,6 +9,12 @@ from .robotraconteur import ReynardRobotRaconteurService
 import sys
 from .gui import ReynardGui
 import argparse
+import json
+
+
+def _print_replay_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Replay failed: {future.exception()}", file=sys.stderr)
 
 
 def main():
@@ -18,6 +27,31 @@ def main():
     parser.add_argument("--http-port", type=int, default=29201, help="Port for HTTP socket server")
     parser.add_argument("--ascii-socket-public", action="store_true", help="Use public IP for ASCII socket server")
     parser.add_argument("--ascii-socket-port", type=int, default=29202, help="Port for ASCII socket server")
+    parser.add_argument("--update-rate", type=float, default=20.0, help="Simulation loop rate in Hz")
+    parser.add_argument("--stream-max-rate", type=float, default=None,
+                        help="Maximum rate in Hz of state updates sent to each web GUI client")
+    parser.add_argument("--virtual-time", action="store_true",
+                        help="Run the simulation with a paused virtual clock that is stepped using POST /api/clock")
+    parser.add_argument("--disable-http", action="store_true", help="Disable HTTP server and web GUI")
+    parser.add_argument("--fleet-size", type=int, default=1,
+                        help="Number of robots to host in fleet mode. Fleet mode only provides the HTTP interface")
+    parser.add_argument("--loop-profile", choices=["production", "development"], default="production",
+                        help="Event loop profile. development enables asyncio debug mode")
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="Profile the whole run and write the collapsed stacks to FILE on exit")
+    parser.add_argument("--obstacles", default=None, metavar="FILE",
+                        help="JSON file with rectangles and circles that the robots stop at")
+    parser.add_argument("--record", default=None, metavar="FILE",
+                        help="Record the state and commands to a binary log FILE")
+    parser.add_argument("--replay", default=None, metavar="FILE",
+                        help="Play back a binary log FILE recorded with --record")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="Playback speed of --replay")
+    parser.add_argument("--robotraconteur-state-rate", type=float, default=None,
+                        help="Maximum rate of the Robot Raconteur state wire in Hz. Default is every simulation tick")
+    parser.add_argument("--history-capacity", type=int, default=6000,
+                        help="Number of simulation ticks kept in the state history")
+    parser.add_argument("--message-capacity", type=int, default=1000,
+                        help="Number of messages from the GUI kept in the message log")
     parser.add_argument("--quiet", action="store_true", help="Suppress output")
     args, _ = parser.parse_known_args()
 
@@ -25,15 +59,42 @@ def main():
     ascii_server = None
     rr_server = None
     try:
+        if args.disable_http and (args.gui or args.fleet_size > 1):
+            raise Exception("--disable-http cannot be used with --gui or --fleet-size")
+        if (args.record is not None or args.replay is not None) and args.fleet_size > 1:
+            raise Exception("--record and --replay cannot be used with --fleet-size")
+        clock = VirtualClock(paused=True) if args.virtual_time else None
         reynard_host = "localhost"
         if args.http_public:
             reynard_host = ""
-        reynard = Reynard(reynard_host, args.http_port)
-        if not args.quiet:
-            print(f"Reynard the Robot started on http://localhost:{args.http_port}")
-            print()
+        obstacles = None
+        if args.obstacles is not None:
+            with open(args.obstacles) as f:
+                obstacles = ObstacleMap.from_dict(json.load(f))
+        fleet_mode = args.fleet_size > 1
+        if fleet_mode:
+            reynard = ReynardFleet(args.fleet_size, reynard_host, args.http_port, args.update_rate, clock,
+                                   args.loop_profile, obstacles, args.message_capacity)
+            if not args.quiet:
+                print(f"Reynard the Robot fleet of {args.fleet_size} robots started on "
+                      f"http://localhost:{args.http_port}/robots/0/")
+                print()
+        else:
+            reynard = Reynard(reynard_host, args.http_port, args.update_rate, clock, not args.disable_http,
+                              args.loop_profile, obstacles, args.history_capacity, args.message_capacity)
+            reynard.streamer.max_rate = args.stream_max_rate
+            if not args.quiet and not args.disable_http:
+                print(f"Reynard the Robot started on http://localhost:{args.http_port}")
+                print()
         reynard.start()
-        if not args.disable_ascii_socket:
+        if args.profile is not None:
+            reynard.profiler.start()
+        if args.record is not None:
+            reynard.start_recording(args.record)
+        if args.replay is not None:
+            replay = reynard.replay(args.replay, args.replay_speed, wait=False)
+            replay.add_done_callback(_print_replay_error)
+        if not args.disable_ascii_socket and not fleet_mode:
             ascii_host = "localhost"
             if args.ascii_socket_public:
                 ascii_host = ""
@@ -41,8 +102,8 @@ def main():
             if not args.quiet:
                 print(f"ASCII socket server started on port {args.ascii_socket_port}")
                 print()
-        if not args.disable_robotraconteur:
-            rr_server = ReynardRobotRaconteurService(reynard, sys.argv)
+        if not args.disable_robotraconteur and not fleet_mode:
+            rr_server = ReynardRobotRaconteurService(reynard, sys.argv, args.robotraconteur_state_rate)
             if not args.quiet:
                 rr_server.print_info()
                 print()
@@ -57,11 +118,16 @@ def main():
                 print("Reynard the Robot started in headless mode. Press Ctrl+C to exit.")
             drekar_launch_process.wait_exit()
     finally:
-        reynard.close()
+        if args.profile is not None and reynard is not None:
+            with open(args.profile, "w") as f:
+                f.write(reynard.profiler.stop())
+        if args.record is not None and reynard is not None:
+            reynard.stop_recording()
         if ascii_server is not None:
             ascii_server.close()
         if rr_server is not None:
             rr_server.close()
+        reynard.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import threading
+
+
+class MessageLog:
+    """
+    Bounded log of the messages received from the GUI. Each message is assigned a sequence number, starting at 1,
+    and the log keeps the last ``capacity`` messages. Messages are never removed by reading, so any number of
+    consumers can read the log independently. Each consumer keeps the sequence number of the last message it has
+    read as a cursor, and reads the newer messages using ``read``. A consumer that falls more than ``capacity``
+    messages behind misses the oldest messages but does not affect the other consumers.
+
+    The log can be read and appended to from any thread.
+
+    :param capacity: The maximum number of messages kept. Default is 1000.
+    :type capacity: int
+    """
+
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError("Message log capacity must be at least 1")
+        self._capacity = capacity
+        self._messages = [None] * capacity
+        self._seqno = 0
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        """
+        The maximum number of messages kept.
+        """
+        return self._capacity
+
+    @property
+    def last_seqno(self):
+        """
+        The sequence number of the newest message, or 0 if no message has been received. Use as the initial cursor
+        to only read messages received from now on.
+        """
+        return self._seqno
+
+    @property
+    def first_seqno(self):
+        """
+        The sequence number of the oldest message kept. Equal to ``last_seqno + 1`` if the log is empty.
+        """
+        return max(self._seqno - self._capacity, 0) + 1
+
+    def append(self, message):
+        """
+        Append a message, overwriting the oldest message if the log is full.
+
+        :param message: The message
+        :type message: str
+        :return: The sequence number of the message
+        :rtype: int
+        """
+        with self._lock:
+            self._seqno += 1
+            self._messages[self._seqno % self._capacity] = message
+            return self._seqno
+
+    def read(self, after=0, max_count=None):
+        """
+        Read the messages newer than a cursor, oldest first.
+
+        :param after: The sequence number of the last message already read. Default is 0, which reads all messages
+                      kept.
+        :type after: int
+        :param max_count: The maximum number of messages to return. Default is None, no limit.
+        :type max_count: int
+        :return: A list of ``(seqno, message)`` tuples. The sequence number of the last entry is the new cursor.
+        :rtype: list
+        """
+        with self._lock:
+            first = max(after + 1, self._seqno - self._capacity + 1, 1)
+            last = self._seqno
+            if max_count is not None:
+                last = min(last, first + max_count - 1)
+            c = self._capacity
+            return [(i, self._messages[i % c]) for i in range(first, last + 1)]
@@ -0,0 +1,313 @@
+import asyncio
+from bisect import bisect_left
+import threading
+import time
+
+from aiohttp import web
+
+# Default histogram buckets in seconds, from 50 microseconds to 10 seconds
+default_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+_le_inf = 'le="+Inf"'
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(labelnames, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """
+    Counter metric that only increases. Do not construct directly, use ``MetricsRegistry.counter``.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+
+    def inc(self, *labels, amount=1):
+        """
+        Increase the counter.
+
+        :param labels: The label values in the order of the label names
+        :param amount: The amount to increase the counter by. Default is 1.
+        :type amount: float
+        """
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        if not self.labelnames:
+            return self._values.get((), 0)
+        return {",".join(k): v for k, v in self._values.items()}
+
+    def render(self):
+        for labels, v in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {v}"
+
+
+class Histogram:
+    """
+    Histogram metric with fixed buckets. Do not construct directly, use ``MetricsRegistry.histogram``.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = dict()
+
+    def observe(self, value, *labels):
+        """
+        Add an observation to the histogram.
+
+        :param value: The observed value
+        :type value: float
+        :param labels: The label values in the order of the label names
+        """
+        v = self._values.get(labels)
+        if v is None:
+            # Bucket counts, followed by the count of values greater than the last bucket, and the sum
+            v = [0] * (len(self.buckets) + 1) + [0.0]
+            self._values[labels] = v
+        v[bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def _collect_one(self, v):
+        counts = v[:-1]
+        cumulative = 0
+        buckets = dict()
+        for le, c in zip(self.buckets, counts):
+            cumulative += c
+            buckets[le] = cumulative
+        return {"count": sum(counts), "sum": v[-1], "buckets": buckets}
+
+    def collect(self):
+        if not self.labelnames:
+            v = self._values.get(())
+            return self._collect_one(v) if v is not None else {"count": 0, "sum": 0.0, "buckets": {}}
+        return {",".join(k): self._collect_one(v) for k, v in self._values.items()}
+
+    def render(self):
+        le_labels = [f'le="{le}"' for le in self.buckets]
+        for labels, v in self._values.items():
+            cumulative = 0
+            for le, c in zip(le_labels, v):
+                cumulative += c
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            count = sum(v[:-1])
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, _le_inf)} {count}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {v[-1]}"
+
+
+class CallbackMetric:
+    """
+    Gauge or counter metric that reads its value from a function when collected. Do not construct directly, use
+    ``MetricsRegistry.callback``.
+    """
+
+    def __init__(self, name, help, fn, type="gauge"):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._fn = fn
+
+    def collect(self):
+        return self._fn()
+
+    def render(self):
+        yield f"{self.name} {self._fn()}"
+
+
+class MetricsRegistry:
+    """
+    Registry of the metrics of a Reynard server. Metrics are updated on the hot paths with minimal overhead, and are
+    read using ``collect`` from Python, or in the Prometheus text format using ``render`` or ``GET /metrics``.
+
+    Metrics are not synchronized. Each metric should only be updated from a single thread.
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        """
+        Create and register a counter.
+
+        :rtype: Counter
+        """
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=default_buckets):
+        """
+        Create and register a histogram.
+
+        :rtype: Histogram
+        """
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, fn, type="gauge"):
+        """
+        Register a metric that reads its value by calling ``fn`` when collected.
+
+        :param type: The Prometheus type of the metric, ``gauge`` or ``counter``. Default is ``gauge``.
+        :type type: str
+        :rtype: CallbackMetric
+        """
+        return self._add(CallbackMetric(name, help, fn, type))
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def collect(self):
+        """
+        Get the current value of all metrics as a dictionary. Counters and gauges are numbers and histograms are
+        dictionaries with ``count``, ``sum`` and cumulative ``buckets``. Labeled metrics are dictionaries keyed by
+        the comma separated label values.
+
+        :rtype: dict
+        """
+        return {name: m.collect() for name, m in self._metrics.items()}
+
+    def render(self):
+        """
+        Get all metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = []
+        for m in self._metrics.values():
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.type}")
+            lines.extend(m.render())
+        lines.append("")
+        return "\n".join(lines)
+
+
+class TimedThreadLock:
+    """
+    ``threading.Lock`` that records the time spent waiting for and holding the lock in histograms. The histograms
+    are only updated while the lock is held, so the lock can be used from any thread. Use ``with`` in threads and
+    ``async with`` on the event loop, which does not block the event loop while another thread holds the lock.
+
+    :param wait_histogram: Histogram for the time waiting to acquire the lock
+    :type wait_histogram: Histogram
+    :param hold_histogram: Histogram for the time the lock is held
+    :type hold_histogram: Histogram
+    """
+
+    def __init__(self, wait_histogram, hold_histogram):
+        self._lock = threading.Lock()
+        self._wait = wait_histogram
+        self._hold = hold_histogram
+        self._acquired_time = 0.0
+
+    def locked(self):
+        return self._lock.locked()
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        t1 = time.perf_counter()
+        self._wait.observe(t1 - t0)
+        self._acquired_time = t1
+        return True
+
+    def release(self):
+        self._hold.observe(time.perf_counter() - self._acquired_time)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    async def __aenter__(self):
+        # Used on the event loop. The lock is taken directly if it is free. Otherwise another thread holds it, and it
+        # is taken in a worker thread so the event loop keeps running while waiting.
+        t0 = time.perf_counter()
+        if not self._lock.acquire(blocking=False):
+            fut = asyncio.get_running_loop().run_in_executor(None, self._lock.acquire)
+            try:
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # The worker thread still takes the lock, release it for the cancelled caller
+                fut.add_done_callback(lambda _: self._lock.release())
+                raise
+        t1 = time.perf_counter()
+        self._wait.observe(t1 - t0)
+        self._acquired_time = t1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def add_server_metrics(app, metrics, prefix="reynard"):
+    """
+    Add per route request latency to an aiohttp application, and serve the metrics at ``GET /metrics``. Must be
+    called before the catch all static file route is added.
+    """
+    request_seconds = metrics.histogram(f"{prefix}_http_request_seconds", "HTTP request handling time",
+                                        ("method", "route"))
+
+    @web.middleware
+    async def middleware(request, handler):
+        t0 = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.resource
+            name = route.canonical if route is not None else "unmatched"
+            request_seconds.observe(time.perf_counter() - t0, request.method, name)
+
+    async def get_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app.middlewares.append(middleware)
+    app.router.add_get('/metrics', get_metrics)
+
+
+def add_reynard_metrics(metrics, scheduler, prefix="reynard"):
+    """
+    Register the metrics shared by Reynard and ReynardFleet. Returns the wait and hold histograms for the lock that
+    protects the state.
+    """
+    stats = scheduler.stats
+    metrics.callback(f"{prefix}_ticks_total", "Simulation loop ticks", lambda: stats()["ticks"], "counter")
+    metrics.callback(f"{prefix}_tick_overruns_total", "Simulation ticks that started after their deadline",
+                     lambda: stats()["overruns"], "counter")
+    metrics.callback(f"{prefix}_tick_missed_total", "Simulation ticks skipped because the loop fell behind",
+                     lambda: stats()["missed"], "counter")
+    metrics.histogram(f"{prefix}_tick_seconds", "Simulation tick processing time including GUI updates")
+    metrics.histogram(f"{prefix}_emit_seconds", "Time sending GUI updates to socket.io clients each tick")
+    metrics.histogram(f"{prefix}_ascii_command_seconds", "ASCII socket command handling time", ("command",))
+    metrics.counter(f"{prefix}_robotraconteur_state_publish_total", "Robot Raconteur state wire values published")
+    metrics.counter(f"{prefix}_robotraconteur_state_skipped_total",
+                    "Robot Raconteur state wire values not published because the state did not change")
+    metrics.counter(f"{prefix}_collision_stops_total", "Robot motions stopped by contact with an obstacle")
+    return (metrics.histogram(f"{prefix}_lock_wait_seconds", "Time waiting to acquire the state lock"),
+            metrics.histogram(f"{prefix}_lock_hold_seconds", "Time the state lock is held"))
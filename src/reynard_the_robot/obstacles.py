@@ -0,0 +1,270 @@
+import numpy as np
+
+from .kinematics import reynard_kinematics, link_positions, _body_center
+
+# Margin around the bounds of the base covered by the occupancy grids. The arm and body never reach further from
+# the robot position than this, so obstacles outside the grids cannot be touched.
+_margin = 600.0
+
+
+class ObstacleMap:
+    """
+    Map of static 2-D obstacles that Reynard's body and arm may not touch. Obstacles are axis aligned rectangles
+    and circles in millimeters, in the same frame as the robot position.
+
+    The obstacles are rasterized into occupancy grids when the map is created, so checking a configuration costs a
+    fixed number of array lookups independent of the number of obstacles. The arm links are checked by sampling
+    points along each link against a grid where the obstacles are inflated by half the link width and the sample
+    spacing, and the body rectangle is checked with a summed area table of the grid. The checks are conservative:
+    a configuration up to about one cell size away from an obstacle may be reported as a collision, but a
+    configuration touching an obstacle is never reported as free. Many configurations, such as every robot in a
+    fleet or every sample of a trajectory, are checked together using NumPy.
+
+    The map is immutable. Create a new map to change the obstacles.
+
+    :param rectangles: The rectangles as an N x 4 array of ``[x_min, y_min, x_max, y_max]``. Default is None.
+    :type rectangles: numpy.ndarray
+    :param circles: The circles as an N x 3 array of ``[x, y, radius]``. Default is None.
+    :type circles: numpy.ndarray
+    :param cell_size: The size of the grid cells in millimeters. Default is 10.
+    :type cell_size: float
+    """
+
+    def __init__(self, rectangles=None, circles=None, cell_size=10.0):
+        rectangles = np.array(rectangles if rectangles is not None else [], dtype=np.float64).reshape((-1, 4))
+        circles = np.array(circles if circles is not None else [], dtype=np.float64).reshape((-1, 3))
+        if not (np.all(np.isfinite(rectangles)) and np.all(np.isfinite(circles))):
+            raise ValueError("Obstacle values must be finite")
+        if np.any(rectangles[:, 0:2] > rectangles[:, 2:4]):
+            raise ValueError("Rectangle minimum must not be greater than maximum")
+        if np.any(circles[:, 2] <= 0):
+            raise ValueError("Circle radius must be greater than zero")
+        if not cell_size > 0:
+            raise ValueError("Cell size must be greater than zero")
+        rectangles.flags.writeable = False
+        circles.flags.writeable = False
+        self._rectangles = rectangles
+        self._circles = circles
+        self._cell_size = float(cell_size)
+
+        bounds = reynard_kinematics["bounds"]
+        self._origin = bounds[0] - _margin
+        self._shape = tuple(np.ceil((bounds[1] - bounds[0] + 2 * _margin) / cell_size).astype(np.int64))
+
+        # Points are sampled along the links at most one cell apart, so a link touches an obstacle only if a
+        # sample point is within half the link width and half the spacing of it
+        lengths = np.linalg.norm(np.diff(link_positions(np.zeros(3)), axis=0), axis=1)
+        fractions = [np.linspace(0, 1, int(np.ceil(n / cell_size)) + 1) for n in lengths]
+        self._sample_link = np.concatenate([np.full(len(f), i) for i, f in enumerate(fractions)])
+        self._sample_fraction = np.concatenate(fractions)[:, None]
+        inflate = reynard_kinematics["link_width"] / 2 + cell_size / 2
+        self._reach = float(np.sum(lengths))
+
+        self._occupied = self._rasterize(0.0)
+        self._inflated = self._rasterize(inflate)
+        self._occupied_sum = np.zeros((self._shape[0] + 1, self._shape[1] + 1), dtype=np.int32)
+        np.cumsum(np.cumsum(self._occupied, axis=0), axis=1, out=self._occupied_sum[1:, 1:])
+        self._body_half = reynard_kinematics["body_size"] / 2
+        self._empty = len(rectangles) == 0 and len(circles) == 0
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Create a map from a dictionary with ``rectangles``, ``circles`` and ``cell_size`` entries, as returned by
+        ``to_dict``. All entries are optional.
+
+        :rtype: ObstacleMap
+        """
+        return cls(d.get("rectangles"), d.get("circles"), d.get("cell_size", 10.0))
+
+    def to_dict(self):
+        """
+        Convert the map to a dictionary of lists.
+
+        :rtype: dict
+        """
+        return {
+            "rectangles": self._rectangles.tolist(),
+            "circles": self._circles.tolist(),
+            "cell_size": self._cell_size
+        }
+
+    @property
+    def rectangles(self):
+        """
+        The rectangles as an N x 4 array of ``[x_min, y_min, x_max, y_max]``.
+        """
+        return self._rectangles
+
+    @property
+    def circles(self):
+        """
+        The circles as an N x 3 array of ``[x, y, radius]``.
+        """
+        return self._circles
+
+    @property
+    def cell_size(self):
+        """
+        The size of the grid cells in millimeters.
+        """
+        return self._cell_size
+
+    def _rasterize(self, inflate):
+        # Mark every cell whose rectangle is within the inflate distance of an obstacle
+        grid = np.zeros(self._shape, dtype=bool)
+        c = self._cell_size
+        for x0, y0, x1, y1 in self._rectangles - [inflate, inflate, -inflate, -inflate]:
+            i0, j0 = self._cell_range_start(x0, y0)
+            i1, j1 = self._cell_range_start(x1, y1)
+            grid[max(i0, 0):max(i1 + 1, 0), max(j0, 0):max(j1 + 1, 0)] = True
+        for x, y, r in self._circles:
+            r += inflate
+            i0, j0 = self._cell_range_start(x - r, y - r)
+            i1, j1 = self._cell_range_start(x + r, y + r)
+            i0, j0 = max(i0, 0), max(j0, 0)
+            i1, j1 = min(i1 + 1, self._shape[0]), min(j1 + 1, self._shape[1])
+            if i0 >= i1 or j0 >= j1:
+                continue
+            # Distance from the circle center to the nearest point of each cell
+            cx = self._origin[0] + np.arange(i0, i1) * c
+            cy = self._origin[1] + np.arange(j0, j1) * c
+            dx = np.maximum(np.maximum(cx - x, x - (cx + c)), 0)
+            dy = np.maximum(np.maximum(cy - y, y - (cy + c)), 0)
+            grid[i0:i1, j0:j1] |= (dx[:, None] ** 2 + dy[None, :] ** 2) <= r * r
+        return grid
+
+    def _cell_range_start(self, x, y):
+        c = self._cell_size
+        return int(np.floor((x - self._origin[0]) / c)), int(np.floor((y - self._origin[1]) / c))
+
+    def _lookup(self, grid, points):
+        # Occupancy of the cells containing the points, with points outside the grid treated as free
+        ij = np.floor((points - self._origin) / self._cell_size).astype(np.int64)
+        inside = np.all((ij >= 0) & (ij < self._shape), axis=-1)
+        ij[~inside] = 0
+        return grid[ij[..., 0], ij[..., 1]] & inside
+
+    def check_points(self, points):
+        """
+        Check if points are inside an obstacle.
+
+        :param points: The points in millimeters as ``[x, y]`` or an N x 2 array
+        :type points: numpy.ndarray
+        :return: True or a boolean array of N entries for the points inside an obstacle
+        """
+        res = self._lookup(self._occupied, np.asarray(points, dtype=np.float64))
+        return bool(res) if res.ndim == 0 else res
+
+    def check(self, robot_positions, arm_positions):
+        """
+        Check if configurations of Reynard touch an obstacle.
+
+        :param robot_positions: The position of the base in millimeters as ``[x, y]`` or an N x 2 array
+        :type robot_positions: numpy.ndarray
+        :param arm_positions: The joint angles in degrees as ``[q1, q2, q3]`` or an N x 3 array
+        :type arm_positions: numpy.ndarray
+        :return: True or a boolean array of N entries for the configurations that touch an obstacle
+        """
+        pos = np.asarray(robot_positions, dtype=np.float64)
+        q = np.asarray(arm_positions, dtype=np.float64)
+        single = pos.ndim == 1 and q.ndim == 1
+        pos = pos.reshape((-1, 2))
+        q = q.reshape((-1, 3))
+        n = max(len(pos), len(q))
+        if self._empty:
+            return False if single else np.zeros((n,), dtype=bool)
+        pos = np.broadcast_to(pos, (n, 2))
+        q = np.broadcast_to(q, (n, 3))
+
+        # Arm links
+        joints = link_positions(q, pos)
+        start = joints[:, self._sample_link]
+        points = start + (joints[:, self._sample_link + 1] - start) * self._sample_fraction
+        res = np.any(self._lookup(self._inflated, points), axis=1)
+
+        # Body rectangle, using the summed area table to count the occupied cells it overlaps
+        center = pos + _body_center
+        lo = np.floor((center - self._body_half - self._origin) / self._cell_size).astype(np.int64)
+        hi = np.floor((center + self._body_half - self._origin) / self._cell_size).astype(np.int64) + 1
+        np.clip(lo, 0, self._shape, out=lo)
+        np.clip(hi, 0, self._shape, out=hi)
+        s = self._occupied_sum
+        res |= (s[hi[:, 0], hi[:, 1]] - s[lo[:, 0], hi[:, 1]] - s[hi[:, 0], lo[:, 1]] + s[lo[:, 0], lo[:, 1]]) > 0
+        return bool(res[0]) if single else res
+
+    def check_motion(self, start_robot_positions, start_arm_positions, robot_positions, arm_positions):
+        """
+        Check if moving Reynard in a straight line from start configurations to end configurations touches an
+        obstacle. The motion is sampled as in ``check_path``, so an obstacle passed through during the motion is
+        found even if both ends are free. The start configurations themselves are not checked.
+
+        :param start_robot_positions: The start position of the base in millimeters as ``[x, y]`` or an N x 2 array
+        :type start_robot_positions: numpy.ndarray
+        :param start_arm_positions: The start joint angles in degrees as ``[q1, q2, q3]`` or an N x 3 array
+        :type start_arm_positions: numpy.ndarray
+        :param robot_positions: The end position of the base in millimeters as ``[x, y]`` or an N x 2 array
+        :type robot_positions: numpy.ndarray
+        :param arm_positions: The end joint angles in degrees as ``[q1, q2, q3]`` or an N x 3 array
+        :type arm_positions: numpy.ndarray
+        :return: True or a boolean array of N entries for the motions that touch an obstacle
+        """
+        args = [np.asarray(a, dtype=np.float64)
+                for a in (start_robot_positions, start_arm_positions, robot_positions, arm_positions)]
+        single = all(a.ndim == 1 for a in args)
+        args = [a.reshape((-1, a.shape[-1])) for a in args]
+        n = max(len(a) for a in args)
+        if self._empty:
+            return False if single else np.zeros((n,), dtype=bool)
+        start = np.empty((n, 5), dtype=np.float64)
+        end = np.empty((n, 5), dtype=np.float64)
+        start[:, 0:2] = args[0]
+        start[:, 2:5] = args[1]
+        end[:, 0:2] = args[2]
+        end[:, 2:5] = args[3]
+        seg, samples = self._sweep(start, end)
+        res = np.zeros((n,), dtype=bool)
+        res[seg[self.check(samples[:, 0:2], samples[:, 2:5])]] = True
+        return bool(res[0]) if single else res
+
+    def _sweep(self, start, end):
+        # Sample the straight line motions from the start to the end configurations, given as N x 5 arrays of
+        # [x, y, q1, q2, q3], finely enough that no part of the robot moves more than one cell between samples.
+        # Returns the index of the motion of each sample and the samples, which include the end but not the start
+        # of each motion. A joint rotation moves the points after the joint by at most the angle times the distance
+        # to the farthest point.
+        d = end - start
+        moved = np.max(np.abs(d[:, 0:2]), axis=1, initial=0) * np.sqrt(2) \
+            + np.sum(np.abs(np.deg2rad(d[:, 2:5])), axis=1) * self._reach
+        counts = np.maximum(np.ceil(moved / self._cell_size).astype(np.int64), 1)
+        seg = np.repeat(np.arange(len(d)), counts)
+        frac = (np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts) + 1) / np.repeat(counts, counts)
+        return seg, start[seg] + d[seg] * frac[:, None]
+
+    def check_path(self, robot_positions, arm_positions):
+        """
+        Check if moving Reynard in straight lines through a list of configurations touches an obstacle. The motion
+        between the configurations is sampled finely enough that no part of the robot moves more than one cell
+        between samples.
+
+        :param robot_positions: The position of the base in millimeters at each waypoint as an N x 2 array
+        :type robot_positions: numpy.ndarray
+        :param arm_positions: The joint angles in degrees at each waypoint as an N x 3 array
+        :type arm_positions: numpy.ndarray
+        :return: None if the path is free, otherwise the index of the first waypoint that is in collision or that
+                 is being moved towards when the collision occurs
+        :rtype: int
+        """
+        w = np.empty((max(len(robot_positions), len(arm_positions)), 5), dtype=np.float64)
+        w[:, 0:2] = robot_positions
+        w[:, 2:5] = arm_positions
+        if self._empty or len(w) == 0:
+            return None
+        seg, samples = self._sweep(w[:-1], w[1:])
+        samples = np.concatenate((w[0:1], samples))
+        hits = np.flatnonzero(self.check(samples[:, 0:2], samples[:, 2:5]))
+        if len(hits) == 0:
+            return None
+        if hits[0] == 0:
+            return 0
+        return int(seg[hits[0] - 1]) + 1
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """
+    Sampling profiler that periodically records the Python stack of every thread in the process, including the
+    event loop thread that runs the simulation, the web server and the ASCII socket server, and the Robot Raconteur
+    threads that run the state wire timer and service calls. The profiler runs in its own thread and can be started
+    and stopped at any time without restarting the server.
+
+    The result is returned in the collapsed stack format used by flame graph tools such as ``flamegraph.pl`` and
+    speedscope. Each line is the thread name and the stack frames from the outermost to the innermost, separated by
+    semicolons, followed by the number of samples.
+
+    :param interval: The sampling interval in seconds. Default is 0.005.
+    :type interval: float
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._counts = dict()
+        self._names = dict()
+        self._samples = 0
+
+    @property
+    def running(self):
+        """
+        True if the profiler is currently sampling.
+        """
+        return self._thread is not None
+
+    def start(self):
+        """
+        Clear the previous samples and start sampling. Raises ``RuntimeError`` if the profiler is already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("Profiler is already running")
+            self._counts = dict()
+            self._samples = 0
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="ReynardProfiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and return the collapsed stacks.
+
+        :rtype: str
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is not None:
+                self._stop.set()
+                thread.join()
+                self._thread = None
+        return self.collapsed()
+
+    async def aio_profile(self, seconds):
+        """
+        Sample for the given time in seconds and return the collapsed stacks. The time is wall clock time, also when
+        the simulation uses a virtual clock. Use with await in an async function.
+
+        :param seconds: The time to sample in seconds
+        :type seconds: float
+        :rtype: str
+        """
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            result = await asyncio.get_running_loop().run_in_executor(None, self.stop)
+        return result
+
+    def profile(self, seconds):
+        """
+        Sample for the given time in seconds and return the collapsed stacks.
+
+        :param seconds: The time to sample in seconds
+        :type seconds: float
+        :rtype: str
+        """
+        self.start()
+        try:
+            time.sleep(seconds)
+        finally:
+            result = self.stop()
+        return result
+
+    def _frame_name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._names[code] = name
+        return name
+
+    def _run(self):
+        own_id = threading.get_ident()
+        next_time = time.perf_counter()
+        while not self._stop.is_set():
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                key = (thread_names.get(ident, f"Thread-{ident}"), tuple(stack))
+                self._counts[key] = self._counts.get(key, 0) + 1
+            self._samples += 1
+            next_time += self.interval
+            delay = next_time - time.perf_counter()
+            if delay < 0:
+                next_time -= delay
+                delay = 0
+            self._stop.wait(delay)
+
+    def collapsed(self):
+        """
+        Get the samples recorded by the last run of the profiler in the collapsed stack format.
+
+        :rtype: str
+        """
+        lines = []
+        for (thread_name, stack), count in list(self._counts.items()):
+            frames = ";".join(self._frame_name(code) for code in reversed(stack))
+            lines.append(f"{thread_name.replace(';', '_').replace(' ', '_')};{frames} {count}")
+        lines.sort()
+        lines.append("")
+        return "\n".join(lines)
+
+    @property
+    def samples(self):
+        """
+        The number of samples recorded by the last run of the profiler.
+        """
+        return self._samples
@@ -0,0 +1,360 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from .state import ReynardState
+
+# File layout. The file starts with a header followed by records. Each record has a fixed size header with the
+# record kind, a code identifying the command, the length of the payload and the time, followed by the payload.
+# State payloads are the sequence number and the 13 float64 values of ReynardState. Index records are written every
+# index_interval records and when the recorder is closed. They contain the offset of the previous index record, the
+# offset, count and time range of the records they cover and the offsets of the state records, and end with a footer
+# that points back to the start of the index record so the index can be read from the end of the file.
+_magic = b"REYNARD\x00"
+_version = 1
+_file_header = struct.Struct("<8sI")
+_record_header = struct.Struct("<BBHd")
+_state_payload = struct.Struct("<Q13d")
+_index_payload = struct.Struct("<qqIdd")
+_index_footer = struct.Struct("<q8s")
+_index_magic = b"REYNIDX\x00"
+
+_kind_state = 1
+_kind_command = 2
+_kind_index = 3
+
+_command_names = ("teleport", "say", "set_arm_position", "drive_robot", "drive_arm", "set_color", "message")
+_command_codes = {name: i for i, name in enumerate(_command_names)}
+_text_commands = frozenset(("say", "message"))
+
+_max_index_interval = 4096
+
+
+class StateRecorder:
+    """
+    Recorder that appends Reynard's state snapshots and commands to a compact binary log file. Use
+    ``Reynard.start_recording`` to record a running Reynard, and ``StateLog`` to read the file.
+
+    The record methods only put the snapshot or command on a queue, and the records are encoded and written to the
+    file by a background thread, so recording does not add file writes to the simulation loop. Records are never
+    dropped, and the file is flushed whenever the queue is empty so readers can follow the file while it is being
+    recorded.
+
+    The file is append-only. An index record is written every ``index_interval`` records and when the recorder is
+    closed, so a reader can seek by time without scanning the whole file. A file that was not closed, for example
+    because the process was killed, can still be read up to the last complete record.
+
+    :param path: The path of the log file. An existing file is replaced.
+    :type path: str
+    :param index_interval: The number of records between index records. Default is 256.
+    :type index_interval: int
+    """
+
+    def __init__(self, path, index_interval=256):
+        if not 0 < index_interval <= _max_index_interval:
+            raise ValueError(f"Index interval must be between 1 and {_max_index_interval}")
+        self._path = path
+        self._index_interval = index_interval
+        self._file = open(path, "wb")
+        self._file.write(_file_header.pack(_magic, _version))
+        self._offset = _file_header.size
+        self._queue = queue.SimpleQueue()
+        self._records = 0
+        self._closed = False
+        self._block_offset = self._offset
+        self._block_count = 0
+        self._block_times = None
+        self._block_states = []
+        self._last_index = -1
+        self._thread = threading.Thread(target=self._run, name="ReynardRecorder", daemon=True)
+        self._thread.start()
+
+    @property
+    def path(self):
+        """
+        The path of the log file.
+        """
+        return self._path
+
+    @property
+    def records(self):
+        """
+        The number of state and command records written to the file.
+        """
+        return self._records
+
+    def record_state(self, state):
+        """
+        Record a state snapshot.
+
+        :param state: The snapshot to record
+        :type state: ReynardState
+        """
+        self._queue.put((_kind_state, state.time, 0, state))
+
+    def record_command(self, t, name, *args):
+        """
+        Record a command. The ``say`` and ``message`` commands take a single string argument, the other commands
+        take numbers.
+
+        :param t: The simulation time of the command in seconds
+        :type t: float
+        :param name: The name of the command, one of ``teleport``, ``say``, ``set_arm_position``, ``drive_robot``,
+                     ``drive_arm``, ``set_color`` or ``message``
+        :type name: str
+        """
+        code = _command_codes[name]
+        if name in _text_commands:
+            data = str(args[0])
+        else:
+            data = tuple(float(a) for a in args)
+        self._queue.put((_kind_command, t, code, data))
+
+    def close(self):
+        """
+        Write the remaining records and the final index, and close the file. Blocks until the records are written.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        buf = bytearray()
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                self._encode(buf, *item)
+                if self._block_count >= self._index_interval:
+                    self._encode_index(buf)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if closing and self._block_count > 0:
+                self._encode_index(buf)
+            self._file.write(buf)
+            self._file.flush()
+            buf.clear()
+        self._file.close()
+
+    def _encode(self, buf, kind, t, code, data):
+        if kind == _kind_state:
+            payload = _state_payload.pack(data.seqno, *data._data.tolist())
+            self._block_states.append(self._offset)
+        elif isinstance(data, str):
+            payload = data.encode("utf-8")[:0xffff]
+        else:
+            payload = struct.pack(f"<{len(data)}d", *data)
+        buf += _record_header.pack(kind, code, len(payload), t)
+        buf += payload
+        self._offset += _record_header.size + len(payload)
+        if self._block_times is None:
+            self._block_times = [t, t]
+        else:
+            self._block_times[1] = t
+        self._block_count += 1
+        self._records += 1
+
+    def _encode_index(self, buf):
+        states = np.array(self._block_states, dtype=np.int64).tobytes()
+        offset = self._offset
+        payload_size = _index_payload.size + len(states) + _index_footer.size
+        buf += _record_header.pack(_kind_index, 0, payload_size, self._block_times[1])
+        buf += _index_payload.pack(self._last_index, self._block_offset, self._block_count, *self._block_times)
+        buf += states
+        buf += _index_footer.pack(offset, _index_magic)
+        self._offset += _record_header.size + payload_size
+        self._last_index = offset
+        self._block_offset = self._offset
+        self._block_count = 0
+        self._block_times = None
+        self._block_states = []
+
+
+class StateLog:
+    """
+    Reader for the binary log files written by ``StateRecorder``. The file is memory-mapped, so opening a large log
+    only reads its index, and the state snapshots can be read as NumPy arrays without decoding each record.
+
+    The index written by the recorder is used when the file was closed properly. Otherwise the records are scanned
+    once when the log is opened, up to the last complete record.
+
+    :param path: The path of the log file
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _file_header.size:
+                raise ValueError("Not a Reynard log file")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = _file_header.unpack_from(self._mmap, 0)
+        if magic != _magic or version != _version:
+            self._mmap.close()
+            raise ValueError("Not a Reynard log file")
+        self._size = size
+        blocks = self._read_index()
+        if blocks is None:
+            blocks = self._scan()
+        # Each block is (first record offset, end offset, first time, last time, state record offsets)
+        self._blocks = blocks
+        self._block_times = np.array([b[2] for b in blocks], dtype=np.float64)
+        self._state_offsets = np.concatenate([b[4] for b in blocks]) if blocks else np.zeros((0,), dtype=np.int64)
+
+    def _read_index(self):
+        # Follow the chain of index records back from the footer at the end of the file
+        m = self._mmap
+        if self._size < _file_header.size + _index_footer.size:
+            return None
+        offset, magic = _index_footer.unpack_from(m, self._size - _index_footer.size)
+        if magic != _index_magic:
+            return None
+        blocks = []
+        while offset >= 0:
+            kind, _, length, _ = _record_header.unpack_from(m, offset)
+            if kind != _kind_index:
+                return None
+            p = offset + _record_header.size
+            prev, first, count, t0, t1 = _index_payload.unpack_from(m, p)
+            n = (length - _index_payload.size - _index_footer.size) // 8
+            states = np.frombuffer(m, dtype=np.int64, count=n, offset=p + _index_payload.size).copy()
+            blocks.append((first, offset, t0, t1, states))
+            offset = prev
+        blocks.reverse()
+        return blocks
+
+    def _scan(self):
+        # Index a log that was not closed by reading every record header
+        m = self._mmap
+        blocks = []
+        offset = _file_header.size
+        first = offset
+        times = None
+        states = []
+        while offset + _record_header.size <= self._size:
+            kind, _, length, t = _record_header.unpack_from(m, offset)
+            end = offset + _record_header.size + length
+            if end > self._size:
+                break
+            if kind == _kind_index:
+                if times is not None:
+                    blocks.append((first, offset, times[0], times[1], np.array(states, dtype=np.int64)))
+                first = end
+                times = None
+                states = []
+            else:
+                if kind == _kind_state:
+                    states.append(offset)
+                times = [t, t] if times is None else [times[0], t]
+            offset = end
+        if times is not None:
+            blocks.append((first, offset, times[0], times[1], np.array(states, dtype=np.int64)))
+        return blocks
+
+    def close(self):
+        """
+        Close the memory map of the file.
+        """
+        self._mmap.close()
+
+    @property
+    def path(self):
+        """
+        The path of the log file.
+        """
+        return self._path
+
+    @property
+    def start_time(self):
+        """
+        The time of the first record in seconds, or None if the log is empty.
+        """
+        return self._blocks[0][2] if self._blocks else None
+
+    @property
+    def end_time(self):
+        """
+        The time of the last record in seconds, or None if the log is empty.
+        """
+        return self._blocks[-1][3] if self._blocks else None
+
+    @property
+    def state_count(self):
+        """
+        The number of state snapshots in the log.
+        """
+        return len(self._state_offsets)
+
+    def records(self, start_time=None, end_time=None):
+        """
+        Iterate over the records in the order they were recorded. Each record is a ``(time, name, data)`` tuple.
+        State snapshots have the name ``state`` and a ``ReynardState`` as the data. Commands have the name of the
+        command and a tuple of the numeric arguments, or the string for ``say`` and ``message``.
+
+        :param start_time: The time in seconds of the first record to return. Default is None, which starts at the
+                           first record. The index is used to skip to the start time without reading the earlier
+                           records.
+        :type start_time: float
+        :param end_time: The time in seconds after which to stop. Default is None, which reads to the end.
+        :type end_time: float
+        :rtype: Iterator[tuple]
+        """
+        m = self._mmap
+        i = 0
+        if start_time is not None and len(self._block_times) > 0:
+            i = max(int(np.searchsorted(self._block_times, start_time, side="right")) - 1, 0)
+        for first, end, _, _, _ in self._blocks[i:]:
+            offset = first
+            while offset < end:
+                kind, code, length, t = _record_header.unpack_from(m, offset)
+                p = offset + _record_header.size
+                offset = p + length
+                if kind == _kind_index or (start_time is not None and t < start_time):
+                    continue
+                if end_time is not None and t > end_time:
+                    return
+                if kind == _kind_state:
+                    v = _state_payload.unpack_from(m, p)
+                    yield t, "state", ReynardState(v[0], t, v[1:3], v[3:6], v[6:8], v[8:11], v[11:14])
+                else:
+                    name = _command_names[code]
+                    if name in _text_commands:
+                        data = bytes(m[p:p + length]).decode("utf-8", errors="replace")
+                    else:
+                        data = struct.unpack_from(f"<{length // 8}d", m, p)
+                    yield t, name, data
+
+    def state_arrays(self):
+        """
+        Read all state snapshots as NumPy arrays. The snapshots are gathered from the memory-mapped file in a single
+        vectorized operation.
+
+        :return: A dictionary with ``seqno`` and ``time`` arrays of N entries, and ``robot_position``,
+                 ``arm_position``, ``robot_velocity``, ``arm_velocity`` and ``color`` arrays of N rows
+        :rtype: dict
+        """
+        raw = np.frombuffer(self._mmap, dtype=np.uint8)
+        size = _record_header.size + _state_payload.size
+        rows = raw[self._state_offsets[:, None] + np.arange(size)]
+        data = rows[:, _record_header.size + 8:].copy().view(np.float64)
+        return {
+            "seqno": rows[:, _record_header.size:_record_header.size + 8].copy().view(np.uint64)[:, 0],
+            "time": rows[:, 4:12].copy().view(np.float64)[:, 0],
+            "robot_position": data[:, 0:2],
+            "arm_position": data[:, 2:5],
+            "robot_velocity": data[:, 5:7],
+            "arm_velocity": data[:, 7:10],
+            "color": data[:, 10:13]
+        }
@@ -0,0 +1,466 @@
+import asyncio
+from contextlib import suppress
+import json
+
+from aiohttp import web
+import numpy as np
+
+from .kinematics import forward_kinematics, inverse_kinematics
+from .obstacles import ObstacleMap
+from .state import ReynardState
+from .history import StateHistory
+from .trajectory import Trajectory, TrajectoryExecution
+
+# Batch operations of the HTTP REST API. Each entry maps the name of the operation to the name of the batch
+# command and the JSON fields passed as positional arguments. Fields in the optional list may be omitted.
+_batch_ops = {
+    "teleport": ("teleport", ["x", "y"], []),
+    "say": ("say", ["message"], []),
+    "arm": ("set_arm_position", ["q1", "q2", "q3"], []),
+    "set_arm_position": ("set_arm_position", ["q1", "q2", "q3"], []),
+    "move_tool_to": ("move_tool_to", ["x", "y"], ["theta"]),
+    "drive_robot": ("drive_robot", ["vel_x", "vel_y"], ["timeout"]),
+    "drive_arm": ("drive_arm", ["q1", "q2", "q3"], ["timeout"]),
+    "color": ("set_color", ["r", "g", "b"], []),
+    "state": ("state", [], []),
+    "cancel_trajectory": ("cancel_trajectory", [], []),
+    "trajectory_status": ("trajectory_status", [], [])
+}
+
+max_batch_length = 10000
+default_stream_rate = 10.0
+max_stream_rate = 1000.0
+_max_stream_messages = 100
+max_message_count = 1000
+max_profile_seconds = 60.0
+max_kinematics_length = 100000
+max_clock_step = 3600.0
+
+
+def parse_state_fields(request):
+    """
+    Parse the comma separated ``fields`` query parameter of a ``GET /state`` request. Returns None if the
+    parameter is not present. Raises ``HTTPBadRequest`` for unknown fields.
+    """
+    fields = request.query.get("fields")
+    if fields is None:
+        return None
+    fields = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in ReynardState.fields]
+    if unknown:
+        raise web.HTTPBadRequest(text=f"Unknown state fields: {', '.join(unknown)}")
+    return fields
+
+
+def parse_trajectory(json):
+    """
+    Create a ``Trajectory`` from the ``robot_positions``, ``arm_positions`` and ``times`` fields of a JSON object.
+    """
+    return Trajectory(json.get("robot_positions"), json.get("arm_positions"), json.get("times"))
+
+
+def _parse_batch_op(op):
+    name = op["op"]
+    if name == "trajectory":
+        return ("execute_trajectory", (parse_trajectory(op),)), None
+    command, required, optional = _batch_ops[name]
+    args = [op[k] for k in required]
+    args.extend(float(op[k]) for k in optional if k in op)
+    fields = None
+    if command == "state":
+        fields = op.get("fields")
+        if fields is not None:
+            unknown = [f for f in fields if f not in ReynardState.fields]
+            assert not unknown, f"Unknown state fields: {', '.join(unknown)}"
+    return (command, tuple(args)), fields
+
+
+async def handle_batch(request, robot):
+    """
+    Handle a ``POST /batch`` request for a Reynard or fleet robot. The body is a JSON list of operations, each a
+    dictionary with an ``op`` field containing the name of the REST endpoint and the same fields as the endpoint.
+    All valid operations are executed in order with a single acquisition of the lock. The response contains one
+    result for each operation.
+    """
+    try:
+        ops = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid JSON")
+    if not isinstance(ops, list):
+        raise web.HTTPBadRequest(text="Batch must be a list of operations")
+    if len(ops) > max_batch_length:
+        raise web.HTTPBadRequest(text="Batch too long")
+
+    parsed = []
+    for op in ops:
+        try:
+            parsed.append(_parse_batch_op(op))
+        except Exception as e:
+            parsed.append(e)
+
+    results = iter(await robot.aio_execute_batch([p[0] for p in parsed if not isinstance(p, Exception)]))
+
+    res = []
+    for p in parsed:
+        r = p if isinstance(p, Exception) else next(results)
+        if isinstance(r, Exception):
+            res.append({"ok": False, "error": repr(r)})
+        elif isinstance(r, ReynardState):
+            res.append({"ok": True, "state": r.to_dict(p[1])})
+        elif isinstance(r, TrajectoryExecution):
+            res.append({"ok": True, "id": r.id})
+        elif isinstance(r, dict):
+            res.append({"ok": True, "status": r})
+        elif isinstance(r, np.ndarray):
+            q1, q2, q3 = r.tolist()
+            res.append({"ok": True, "q1": q1, "q2": q2, "q3": q3})
+        else:
+            res.append({"ok": True})
+    return web.json_response(res)
+
+
+class _StateSubscription:
+    # Pushes state snapshots or heartbeats at a fixed rate and messages as they arrive to a single WebSocket or SSE
+    # client.
+    # The query parameters are rate in Hz, fields as for GET /state, and messages=0 to disable messages.
+
+    def __init__(self, robot, request):
+        try:
+            rate = float(request.query.get("rate", default_stream_rate))
+        except ValueError:
+            raise web.HTTPBadRequest(text="Invalid rate")
+        if not rate > 0:
+            raise web.HTTPBadRequest(text="Invalid rate")
+        self._robot = robot
+        self._period = 1.0 / min(rate, max_stream_rate)
+        self._fields = parse_state_fields(request)
+        self._messages = request.query.get("messages", "1") not in ("0", "false")
+        # Messages are read from the message log of the robot starting after the newest message at subscription.
+        # The signal only wakes the sender, so a slow client lags behind in the log without buffering messages.
+        self._message_cursor = robot.messages.last_seqno
+        self._message_event = asyncio.Event()
+        self._send_lock = asyncio.Lock()
+
+    def _new_message(self, _, **kwargs):
+        self._message_event.set()
+
+    async def _send_states(self, send):
+        # Snapshots are only sent if a field other than seqno and time changed since the last one sent. A new
+        # snapshot is published every tick, so the sequence number alone does not show that the robot moved.
+        # Otherwise a heartbeat with the sequence number and time of the snapshot is sent.
+        clock = self._robot.clock
+        next_time = clock.now()
+        last_values = None
+        while True:
+            snapshot = self._robot.state
+            state = snapshot.to_dict(self._fields)
+            values = [v for k, v in state.items() if k not in ("seqno", "time")]
+            async with self._send_lock:
+                if not values or values != last_values:
+                    last_values = values
+                    await send("state", state)
+                else:
+                    # Unchanged states are replaced by a heartbeat every period so an idle stream stays alive
+                    await send("heartbeat", {"seqno": snapshot.seqno, "time": snapshot.time})
+            next_time += self._period
+            now = clock.now()
+            if next_time < now:
+                next_time = now
+            await clock.sleep(next_time - now)
+
+    async def _send_messages(self, send):
+        log = self._robot.messages
+        while True:
+            await self._message_event.wait()
+            self._message_event.clear()
+            while True:
+                messages = log.read(self._message_cursor, _max_stream_messages)
+                if not messages:
+                    break
+                for seqno, message in messages:
+                    async with self._send_lock:
+                        await send("message", message)
+                    self._message_cursor = seqno
+
+    async def run(self, send, receive=None):
+        # Runs until a send fails or the receive coroutine returns because the client closed the connection
+        tasks = [asyncio.create_task(self._send_states(send))]
+        if self._messages:
+            self._robot.new_message.connect(self._new_message)
+            tasks.append(asyncio.create_task(self._send_messages(send)))
+        if receive is not None:
+            tasks.append(asyncio.create_task(receive))
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._robot.new_message.disconnect(self._new_message)
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                with suppress(asyncio.CancelledError, Exception):
+                    await task
+
+
+async def handle_state_websocket(request, robot):
+    """
+    Handle a ``GET /state/ws`` WebSocket request for a Reynard or fleet robot. A message is sent at the requested
+    rate. Each state snapshot is sent as a JSON text message ``{"type": "state", "state": {...}}``. States whose
+    fields other than ``seqno`` and ``time`` have not changed since the last state sent are suppressed, and a
+    ``{"type": "heartbeat", "heartbeat": {"seqno": ..., "time": ...}}`` message is sent instead. Each new message is
+    sent as ``{"type": "message", "message": "..."}``. Messages received from the client are ignored.
+    """
+    subscription = _StateSubscription(robot, request)
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    async def send(event, data):
+        await ws.send_json({"type": event, event: data})
+
+    async def receive():
+        async for _ in ws:
+            pass
+
+    await subscription.run(send, receive())
+    await ws.close()
+    return ws
+
+
+async def handle_state_events(request, robot):
+    """
+    Handle a ``GET /state/events`` Server-Sent-Events request for a Reynard or fleet robot. An event is sent at the
+    requested rate. State snapshots are sent as ``state`` events. States whose fields other than ``seqno`` and
+    ``time`` have not changed since the last state sent are suppressed, and a ``heartbeat`` event with the ``seqno``
+    and ``time`` is sent instead. New messages are sent as ``message`` events. The data is encoded as JSON.
+    """
+    subscription = _StateSubscription(robot, request)
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+
+    async def send(event, data):
+        await resp.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+
+    await subscription.run(send)
+    return resp
+
+
+def handle_messages(request, messages):
+    """
+    Handle a ``GET /messages`` request with a cursor. The ``after`` query parameter is the sequence number of the
+    last message already read, 0 to read all messages kept, and the optional ``limit`` is the maximum number of
+    messages to return. Returns an object with the ``messages`` as a list of ``{"seqno": ..., "message": ...}``,
+    the ``last_seqno`` of the log and the number of messages ``missed`` because they were overwritten before they
+    were read.
+    """
+    try:
+        after = int(request.query["after"])
+        limit = int(request.query.get("limit", max_message_count))
+    except ValueError:
+        raise web.HTTPBadRequest(text="after and limit must be integers")
+    if after < 0:
+        raise web.HTTPBadRequest(text="after must not be negative")
+    if not 0 < limit <= max_message_count:
+        raise web.HTTPBadRequest(text=f"limit must be greater than 0 and at most {max_message_count}")
+    entries = messages.read(after, limit)
+    missed = entries[0][0] - after - 1 if entries else 0
+    return web.json_response({
+        "messages": [{"seqno": seqno, "message": message} for seqno, message in entries],
+        "last_seqno": messages.last_seqno,
+        "missed": missed
+    })
+
+
+async def handle_clock(request, clock):
+    """
+    Handle a ``GET /clock`` or ``POST /clock`` request. Returns the ``time`` of the clock, and whether it is
+    ``virtual`` and ``paused``. The body of a POST request is a JSON object with the optional fields ``paused`` to
+    pause or resume a virtual clock, and ``step`` to run a paused virtual clock for a time in seconds. A step returns
+    when the simulation has run to the new time. Returns status 409 if the clock is not virtual, or if a clock that is
+    not paused is stepped.
+    """
+    if request.method == "POST":
+        try:
+            body = await request.json()
+            assert isinstance(body, dict), "Expected a JSON object"
+            paused = body.get("paused")
+            step = body.get("step")
+            assert paused is None or isinstance(paused, bool), "paused must be a boolean"
+            assert step is None or (isinstance(step, (int, float)) and 0 <= step <= max_clock_step), \
+                f"step must be a number between 0 and {max_clock_step}"
+        except (ValueError, AssertionError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if not clock.virtual:
+            raise web.HTTPConflict(text="The clock is not virtual")
+        if paused is True:
+            clock.pause()
+        elif paused is False:
+            clock.resume()
+        if step is not None:
+            if not clock.paused:
+                raise web.HTTPConflict(text="Only a paused clock can be stepped")
+            await clock.aio_step(step)
+    return web.json_response({"time": clock.now(), "virtual": clock.virtual,
+                              "paused": clock.virtual and clock.paused})
+
+
+async def handle_profile(request, profiler):
+    """
+    Handle a ``POST /debug/profile`` request. Samples the stacks of all threads for ``seconds`` (default 5) and
+    returns the collapsed stacks as text. The optional ``interval`` query parameter sets the sampling interval in
+    seconds. Returns status 409 if a profile is already being captured.
+    """
+    try:
+        seconds = float(request.query.get("seconds", 5.0))
+        interval = float(request.query.get("interval", profiler.interval))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid seconds or interval")
+    if not 0 < seconds <= max_profile_seconds:
+        raise web.HTTPBadRequest(text=f"seconds must be greater than 0 and at most {max_profile_seconds}")
+    if not 0 < interval <= 1:
+        raise web.HTTPBadRequest(text="interval must be greater than 0 and at most 1")
+    if profiler.running:
+        raise web.HTTPConflict(text="Profiler is already running")
+    profiler.interval = interval
+    return web.Response(text=await profiler.aio_profile(seconds))
+
+
+async def handle_forward_kinematics(request):
+    """
+    Handle a ``POST /kinematics/forward`` request. The body is a JSON object with ``arm_positions``, a list of
+    ``[q1, q2, q3]`` in degrees, and optionally ``robot_positions``, a list of ``[x, y]`` in millimeters. Returns
+    the tool poses as a list of ``[x, y, theta]``. The poses are computed in a worker thread so large requests do
+    not block the simulation loop.
+    """
+    try:
+        body = await request.json()
+        assert isinstance(body, dict), "Expected a JSON object"
+        q = body.get("arm_positions")
+        p = body.get("robot_positions")
+        assert isinstance(q, list) and len(q) <= max_kinematics_length, \
+            f"arm_positions must be a list with at most {max_kinematics_length} entries"
+        assert p is None or (isinstance(p, list) and len(p) == len(q)), \
+            "robot_positions must have one entry for each arm position"
+    except (ValueError, AssertionError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    def compute():
+        return forward_kinematics(np.array(q, dtype=np.float64).reshape((-1, 3)),
+                                  np.array(p, dtype=np.float64).reshape((-1, 2)) if p is not None else None).tolist()
+
+    try:
+        poses = await asyncio.get_running_loop().run_in_executor(None, compute)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response({"poses": poses})
+
+
+async def handle_inverse_kinematics(request):
+    """
+    Handle a ``POST /kinematics/inverse`` request. The body is a JSON object with ``tool_positions``, a list of
+    ``[x, y]`` in millimeters, and optionally ``tool_angles`` in degrees, ``robot_positions`` and
+    ``initial_arm_positions`` with one entry for each target. Returns the joint angles as a list of
+    ``[q1, q2, q3]`` and a list of booleans for the targets that were reached. The targets are solved in a worker
+    thread so large requests do not block the simulation loop.
+    """
+    try:
+        body = await request.json()
+        assert isinstance(body, dict), "Expected a JSON object"
+        p = body.get("tool_positions")
+        assert isinstance(p, list) and len(p) <= max_kinematics_length, \
+            f"tool_positions must be a list with at most {max_kinematics_length} entries"
+        optional = dict()
+        for k, n in (("tool_angles", 1), ("robot_positions", 2), ("initial_arm_positions", 3)):
+            v = body.get(k)
+            if v is not None:
+                assert isinstance(v, list) and len(v) == len(p), f"{k} must have one entry for each tool position"
+                optional[k] = np.array(v, dtype=np.float64).reshape((-1, n) if n > 1 else (-1,))
+        p = np.array(p, dtype=np.float64).reshape((-1, 2))
+    except (ValueError, AssertionError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    def compute():
+        q, success = inverse_kinematics(p, **optional)
+        return q.tolist(), success.tolist()
+
+    q, success = await asyncio.get_running_loop().run_in_executor(None, compute)
+    return web.json_response({"arm_positions": q, "success": success})
+
+
+async def parse_obstacles(request):
+    """
+    Parse the body of a ``PUT /obstacles`` request into an ``ObstacleMap``. The body is a JSON object with
+    ``rectangles``, ``circles`` and ``cell_size`` as returned by ``ObstacleMap.to_dict``, or null to remove the
+    obstacles. Raises ``HTTPBadRequest`` for invalid obstacles.
+    """
+    try:
+        body = await request.json()
+        if body is None:
+            return None
+        assert isinstance(body, dict), "Expected a JSON object"
+        return ObstacleMap.from_dict(body)
+    except (ValueError, AssertionError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+
+async def handle_obstacles_check(request, obstacles):
+    """
+    Handle a ``POST /obstacles/check`` request. The body is a JSON object with ``robot_positions``, a list of
+    ``[x, y]``, and ``arm_positions``, a list of ``[q1, q2, q3]``. Returns a list of booleans for the
+    configurations that touch an obstacle.
+    """
+    try:
+        body = await request.json()
+        assert isinstance(body, dict), "Expected a JSON object"
+        p = body.get("robot_positions")
+        q = body.get("arm_positions")
+        assert isinstance(p, list) and isinstance(q, list) and len(p) == len(q), \
+            "robot_positions and arm_positions must be lists of the same length"
+        assert len(p) <= max_kinematics_length, f"At most {max_kinematics_length} configurations can be checked"
+        p = np.array(p, dtype=np.float64).reshape((-1, 2))
+        q = np.array(q, dtype=np.float64).reshape((-1, 3))
+    except (ValueError, AssertionError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    if obstacles is None:
+        return web.json_response({"collision": [False] * len(p)})
+    res = await asyncio.get_running_loop().run_in_executor(None, obstacles.check, p, q)
+    return web.json_response({"collision": res.tolist()})
+
+
+async def handle_history(request, history):
+    """
+    Handle a ``GET /history`` request. The ``since`` query parameter selects the states after a time in seconds,
+    ``until`` the states up to and including a time, and ``fields`` the comma separated columns, using the field
+    names of ``GET /state`` without the tool pose. Returns an object with the ``count`` of states and an array for
+    each field. If ``format=binary``, returns the arrays as little-endian float64 values, one array after the other
+    in the order of the fields.
+    """
+    try:
+        since = float(request.query["since"]) if "since" in request.query else None
+        until = float(request.query["until"]) if "until" in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="since and until must be numbers")
+    fields = request.query.get("fields")
+    fields = StateHistory.columns if fields is None else [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in StateHistory.columns]
+    if unknown:
+        raise web.HTTPBadRequest(text=f"Unknown history fields: {', '.join(unknown)}")
+    fmt = request.query.get("format", "json")
+    if fmt not in ("json", "binary"):
+        raise web.HTTPBadRequest(text="format must be json or binary")
+
+    # The view is only copied once, column by column into the packed columns
+    view = history.view(np.nextafter(since, np.inf) if since is not None else None, until)
+    columns = np.empty((len(fields), len(view)), dtype=np.float64)
+    for c, f in zip(columns, fields):
+        c[:] = view[:, StateHistory.columns.index(f)]
+    if fmt == "binary":
+        return web.Response(body=columns.astype("<f8", copy=False).tobytes(), content_type="application/octet-stream",
+                            headers={"X-Reynard-Count": str(columns.shape[1]),
+                                     "X-Reynard-Fields": ",".join(fields)})
+
+    def encode():
+        res = {"count": columns.shape[1]}
+        for f, c in zip(fields, columns):
+            res[f] = c.astype(np.int64).tolist() if f == "seqno" else c.tolist()
+        return json.dumps(res)
+
+    return web.json_response(text=await asyncio.get_running_loop().run_in_executor(None, encode))
@@ -1,24 +1,36 @@
 from aiohttp import web
 import socketio
 import asyncio
-from threading import Thread, Lock, Event
 import time
+import warnings
+from threading import Thread, Lock, Event
 
 import importlib_resources
 import numpy as np
 import blinker
 
-reynard_kinematics = {
-    "body_offset": np.array([0, 70], dtype=np.float64),
-    "bounds": np.array([[-1000, -500], [1000, 500]], dtype=np.float64),
-    "p0": np.array([0, -95], dtype=np.float64),
-    "p1": np.array([170, 0], dtype=np.float64),
-    "p2": np.array([170, 0], dtype=np.float64),
-    "p3": np.array([60, 0], dtype=np.float64),
-    "q_bounds": np.array([[-10, -140, -175], [180, 140, 175]], dtype=np.float64),
-    "vel_max": np.array([100, 100], dtype=np.float64),
-    "q_vel_max": np.array([100, 100, 100], dtype=np.float64)
-}
+from .scheduler import FixedRateScheduler
+from .clock import WallClock
+from .state import ReynardState
+from .streaming import SocketIOStateStreamer
+from . import rest
+from .profiler import SamplingProfiler
+from .runtime import get_loop_profile
+from .trajectory import TrajectoryExecution
+from .recorder import StateRecorder, StateLog
+from .history import StateHistory
+from .messages import MessageLog
+from .kinematics import inverse_kinematics, reynard_kinematics
+from .metrics import MetricsRegistry, TimedThreadLock, add_reynard_metrics, add_server_metrics
+
+
+def _active_dt(t0, t1, start_time, stop_time):
+    # Length of the part of the interval [t0, t1] where a commanded velocity is active. A negative stop time
+    # means the velocity has no stop time.
+    t0 = max(t0, start_time)
+    if stop_time >= 0:
+        t1 = min(t1, stop_time)
+    return max(t1 - t0, 0.0)
 
 
 class Reynard:
@@ -38,19 +50,31 @@ class Reynard:
     - say: Make Reynard say a message
     - drive_robot: Drive Reynard's base in the x and y directions at a given velocity
     - set_arm_position: Set the position of Reynard's arm joints instantly
+    - move_tool_to: Set the position of Reynard's arm joints instantly so the tool reaches a target pose
     - drive_arm: Drive Reynard's arm joints at a given velocity
+    - set_setpoint: Set a velocity or arm position setpoint that is applied at the next simulation tick
+    - execute_trajectory: Move Reynard's base and arm through a list of waypoints
     - arm_position: Get the current position of Reynard's arm joints
     - robot_position: Get the current position of Reynard's base
     - robot_velocity: Get the current velocity of Reynard's base
+    - tool_pose: Get the current pose of Reynard's tool
     - arm_velocity: Get the current velocity of Reynard's arm joints
     - time: Get the current simulation time in seconds
     - color: Get or set the color of Reynard's body as an RGB tuple between 0 and 1
     - new_message: Signal that is emitted when a new message is received from the API
+    - messages: Get the log of recent messages received from the API
+    - history: Get the recent states of Reynard as NumPy arrays
+    - start_recording: Record the state and commands to a binary log file
+    - replay: Play back a recorded log file
 
     The Reynard class can be used with AIO or with the standard Python threading model. When used with AIO, the
     methods starting with ``aio_`` should be used. When used with the standard Python threading model, the methods
     without ``aio_`` should be used.
 
+    The state is protected by a thread lock that is only held while a command changes the state. The synchronous
+    methods change the state directly from the calling thread without waiting for the event loop, and GUI updates
+    are sent by the simulation loop on the next tick.
+
     The start or aio_start method must be called to start the Reynard server. The close method should be called
     to stop the Reynard server.
 
@@ -58,31 +82,103 @@ class Reynard:
     :type host: str
     :param port: The port to bind the Reynard server to. Default is 29201.
     :type port: int
+    :param update_rate: The rate of the simulation loop in Hz. Default is 20 Hz.
+    :type update_rate: float
+    :param clock: The clock used for the simulation time. Default is a ``WallClock`` that follows real time.
+                  Pass a ``VirtualClock`` to run the simulation faster than real time.
+    :type clock: WallClock or VirtualClock
+    :param enable_http: If False, the web server and socket.io GUI are not started. Default is True.
+    :type enable_http: bool
+    :param loop_profile: The settings of the event loop created by ``start()``, either a ``LoopProfile`` or the name
+                         ``production`` or ``development``. Default is ``production``, which disables asyncio debug
+                         mode.
+    :type loop_profile: LoopProfile or str
+    :param obstacles: Obstacles that Reynard stops at. Default is None.
+    :type obstacles: ObstacleMap
+    :param history_capacity: The number of ticks kept in the state history. Default is 6000, five minutes at the
+                             default update rate.
+    :type history_capacity: int
+    :param message_capacity: The number of messages kept in the message log. Default is 1000.
+    :type message_capacity: int
     """
 
-    def __init__(self, host="localhost", port=29201):
+    def __init__(self, host="localhost", port=29201, update_rate=20.0, clock=None, enable_http=True,
+                 loop_profile=None, obstacles=None, history_capacity=6000,
+                 message_capacity=1000):
         self.app = web.Application()
-        self.aio_lock = asyncio.Lock()
         self.socketio = socketio.AsyncServer(async_mode='aiohttp')
         self.socketio.attach(self.app)
         self._host = host
         self._port = port
         self._loop = None
         self._started = Event()
-        self._dt = 5e-2
+        self._loop_profile = get_loop_profile(loop_profile)
+        self._clock = clock if clock is not None else WallClock()
+        self._enable_http = enable_http
+        self._scheduler = FixedRateScheduler(update_rate, clock=self._clock)
         self._vel_loop_task = None
 
+        self._streamer = SocketIOStateStreamer(self.socketio)
+
+        self._metrics = MetricsRegistry()
+        self._state_lock = TimedThreadLock(*add_reynard_metrics(self._metrics, self._scheduler))
+        self._metrics.callback("reynard_socketio_clients", "Connected socket.io clients",
+                               lambda: self._streamer.stats()["clients"])
+        self._metrics.callback("reynard_emit_messages_total", "socket.io messages sent counting each recipient",
+                               lambda: self._streamer.stats()["messages_sent"], "counter")
+        self._metrics.callback("reynard_emit_bytes_total", "socket.io payload bytes sent counting each recipient",
+                               lambda: self._streamer.stats()["bytes_sent"], "counter")
+        self._tick_seconds = self._metrics["reynard_tick_seconds"]
+        self._profiler = SamplingProfiler()
+        self._emit_seconds = self._metrics["reynard_emit_seconds"]
+        self._collision_total = self._metrics["reynard_collision_stops_total"]
+
         self._pos = np.array([0, 0], dtype=np.float64)
-        self._last_update_pos = np.copy(self._pos)
         self._q = np.array([0, 0, 0], dtype=np.float64)
-        self._last_update_q = np.copy(self._q)
         self._vel = np.array([0, 0], dtype=np.float64)
+        self._vel_start_time = 0
         self._vel_stop_time = -1
         self._q_vel = np.array([0, 0, 0], dtype=np.float64)
+        self._q_vel_start_time = 0
         self._q_vel_stop_time = -1
         self._color = np.array([0.929, 0.49, 0.192], dtype=np.float64)
-
-        self._new_message = blinker.signal('new_message')
+        self._trajectory = None
+        self._last_trajectory = None
+        self._trajectory_count = 0
+        self._obstacles = obstacles
+        self._recorder = None
+        self._replaying = False
+        self._history = StateHistory(history_capacity)
+        # Latest streamed setpoints by name, applied by the simulation loop at the start of the next tick
+        self._setpoint_lock = Lock()
+        self._setpoints = dict()
+        self._state = None
+        self._publish_state()
+
+        self._setpoint_commands = {
+            "drive_robot": self._drive_robot,
+            "drive_arm": self._drive_arm,
+            "set_arm_position": self._set_arm_position
+        }
+
+        self._batch_commands = {
+            "teleport": self._teleport,
+            "say": self._say,
+            "set_arm_position": self._set_arm_position,
+            "move_tool_to": self._move_tool_to,
+            "drive_robot": self._drive_robot,
+            "drive_arm": self._drive_arm,
+            "set_color": self._set_color,
+            "state": self._get_state,
+            "execute_trajectory": self._execute_trajectory,
+            "cancel_trajectory": self._cancel_trajectory,
+            "trajectory_status": self._get_trajectory_status
+        }
+
+        self._new_message = blinker.Signal()
+        self._messages = MessageLog(message_capacity)
+        self._api_msg_cursor = 0
+        self._state_tick = blinker.Signal()
 
         static_path = importlib_resources.files('reynard_the_robot').joinpath('web_static')
 
@@ -90,47 +186,275 @@ class Reynard:
             path = request.match_info.get('path', 'index.html')
             return web.FileResponse(static_path / path)
 
+        add_server_metrics(self.app, self._metrics)
         self._register_api()
         self.app.router.add_get('/', serve)
         self.app.router.add_get('/{path:.*}', serve)
 
-        self._api_msg_queue = asyncio.Queue()
         self.socketio.on('new_message', self._new_message_cb)
+        self.socketio.on('connect', self._connect_cb)
+        self.socketio.on('disconnect', self._disconnect_cb)
+
+    async def _connect_cb(self, sid, environ, auth=None):
+        await self._streamer.connect(sid, environ)
+
+    def _disconnect_cb(self, sid, *args):
+        self._streamer.disconnect(sid)
 
     def _new_message_cb(self, sid, message):
-        self._new_message.send(None, message=message)
-        self._api_msg_queue.put_nowait(message)
+        self._record("message", message)
+        seqno = self._messages.append(message)
+        self._new_message.send(None, message=message, seqno=seqno)
 
     async def aio_start(self):
         """
         AIO version of start. Must be called to start the Reynard server.
         Use with await in an async function.
         """
-        self._runner = web.AppRunner(self.app)
-        await self._runner.setup()
-        self._site = web.TCPSite(self._runner, self._host, self._port)
-        await self._site.start()
+        self._loop = asyncio.get_running_loop()
+        if self._enable_http:
+            self._runner = web.AppRunner(self.app)
+            await self._runner.setup()
+            self._site = web.TCPSite(self._runner, self._host, self._port)
+            await self._site.start()
 
         self._vel_loop_task = asyncio.create_task(self._vel_loop())
 
+    def _queue_emit(self, event, data, coalesce=False):
+        # GUI events are sent by the simulation loop after the next tick
+        if self._enable_http:
+            self._streamer.queue_event(event, data, coalesce)
+
+    def _publish_state(self, t=None):
+        # Must be called with the lock held after the state is modified. Readers only ever see complete
+        # snapshots since the snapshot reference is replaced in a single assignment.
+        if t is None:
+            t = self._clock.now()
+        seqno = self._state.seqno + 1 if self._state is not None else 0
+        self._state = ReynardState(seqno, t, self._pos, self._q, self._vel, self._q_vel, self._color)
+
+    def _step(self, t, dt):
+        # Integrate over the real elapsed time dt ending at time t. Velocities are only integrated between the
+        # time they were commanded and their stop time so the distance traveled does not depend on the loop rate.
+        t0 = t - dt
+        vel_dt = _active_dt(t0, t, self._vel_start_time, self._vel_stop_time)
+        q_vel_dt = _active_dt(t0, t, self._q_vel_start_time, self._q_vel_stop_time)
+
+        pos = self._pos
+        q = self._q
+        self._pos = self._pos + self._vel * vel_dt
+        self._pos = np.clip(self._pos, reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1])
+        self._q = self._q + self._q_vel * q_vel_dt
+        self._q = np.clip(self._q, reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1])
+        if t >= self._vel_stop_time and self._vel_stop_time >= 0:
+            self._vel = np.array([0, 0], dtype=np.float64)
+            self._vel_stop_time = -1
+        if t >= self._q_vel_stop_time and self._q_vel_stop_time >= 0:
+            self._q_vel = np.array([0, 0, 0], dtype=np.float64)
+            self._q_vel_stop_time = -1
+        if self._trajectory is not None:
+            self._step_trajectory(t)
+        obstacles = self._obstacles
+        if obstacles is not None and (np.any(self._pos != pos) or np.any(self._q != q)) \
+                and not obstacles.check(pos, q) and obstacles.check_motion(pos, q, self._pos, self._q):
+            # Stop at the last position that was free of obstacles. The motion during the tick is checked as a
+            # straight line, so thin obstacles are not passed through at high speed. Reynard can move freely if it
+            # was already touching an obstacle when the obstacles were set, so it can be moved out.
+            self._pos = pos
+            self._q = q
+            self._stop_motion("collision")
+            self._collision_total.inc()
+        self._publish_state(t)
+
+    def _stop_motion(self, trajectory_state):
+        self._vel = np.array([0, 0], dtype=np.float64)
+        self._vel_stop_time = -1
+        self._q_vel = np.array([0, 0, 0], dtype=np.float64)
+        self._q_vel_stop_time = -1
+        traj = self._trajectory
+        if traj is not None:
+            self._trajectory = None
+            traj.finish(trajectory_state)
+
+    def _check_obstacles(self, pos, q):
+        if self._obstacles is not None and self._obstacles.check(pos, q):
+            raise ValueError("Reynard would collide with an obstacle")
+
+    def _step_trajectory(self, t):
+        # The trajectory overrides the integrated position of the axes it controls
+        traj = self._trajectory
+        p, v, done = traj.sample(t)
+        if traj.controls_base:
+            self._pos = p[0:2].copy()
+            self._vel = v[0:2].copy()
+        if traj.controls_arm:
+            self._q = p[2:5].copy()
+            self._q_vel = v[2:5].copy()
+        if done:
+            self._trajectory = None
+            traj.finish("completed")
+
     async def _vel_loop(self):
+        self._scheduler.start()
         while True:
-            async with self.aio_lock:
-                self._pos += self._vel * self._dt
-                self._pos = np.clip(self._pos, reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1])
-                self._q += self._q_vel * self._dt
-                self._q = np.clip(self._q, reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1])
-                t = time.perf_counter()
-                if t > self._vel_stop_time and self._vel_stop_time >= 0:
-                    self._vel = np.array([0, 0], dtype=np.float64)
-                if t > self._q_vel_stop_time and self._q_vel_stop_time >= 0:
-                    self._q_vel = np.array([0, 0, 0], dtype=np.float64)
-                if np.linalg.norm(self._last_update_pos - self._pos) > 2 or np.any(np.abs(self._last_update_q - self._q) > 2):
-                    self._last_update_pos = np.copy(self._pos)
-                    self._last_update_q = np.copy(self._q)
-                    await self.socketio.emit('update', {'x': self._pos[0], 'y': self._pos[1], 'q1': self._q[0],
-                                                        'q2': self._q[1], 'q3': self._q[2]})
-            await asyncio.sleep(self._dt)
+            t, dt = await self._scheduler.wait_next()
+            t0 = time.perf_counter()
+            async with self._state_lock:
+                # During a replay the state is set by the replayed snapshots instead of the simulation
+                if not self._replaying:
+                    if self._setpoints:
+                        self._apply_setpoints(t - dt)
+                    self._step(t, dt)
+                    if self._recorder is not None:
+                        self._recorder.record_state(self._state)
+                state = self._state
+                self._history.append(state)
+                if self._enable_http:
+                    pending = self._streamer.prepare_tick(state.robot_position, state.arm_position)
+            if self._state_tick.receivers:
+                self._state_tick.send(self, state=state)
+            if self._enable_http:
+                t1 = time.perf_counter()
+                await self._streamer.send_tick(t, pending)
+                self._emit_seconds.observe(time.perf_counter() - t1)
+            self._tick_seconds.observe(time.perf_counter() - t0)
+
+    def _apply_setpoints(self, t0):
+        # Must be called with _state_lock held at the start of the tick that integrates from t0. Setpoints that are
+        # rejected, for example because they would move the arm into an obstacle, are dropped.
+        with self._setpoint_lock:
+            setpoints = self._setpoints
+            self._setpoints = dict()
+        for name, args in setpoints.items():
+            try:
+                if name == "set_arm_position":
+                    self._set_arm_position(*args)
+                else:
+                    # Velocities are active for the whole tick they are applied in
+                    self._setpoint_commands[name](*args, start_time=t0)
+            except ValueError:
+                pass
+
+    def _teleport(self, x, y):
+        # The _teleport, _say, _set_arm_position, _drive_robot, _drive_arm and _set_color methods implement the
+        # commands. They must be called with _state_lock held. The lock is a thread lock that is only held for the
+        # duration of the state change, so both the AIO methods on the event loop and the synchronous methods on
+        # other threads call the commands directly.
+        self._record("teleport", x, y)
+        x, y = np.clip([x, y], reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1])
+        self._check_obstacles([x, y], self._q)
+        self._cancel_trajectory(arm=False)
+        self._vel = np.array([0, 0], dtype=np.float64)
+        self._pos = np.array([x, y], dtype=np.float64)
+        self._publish_state()
+        self._streamer.mark_base()
+
+    def _say(self, message):
+        self._record("say", message)
+        self._queue_emit('say', message)
+
+    def _set_arm_position(self, q1, q2, q3):
+        self._record("set_arm_position", q1, q2, q3)
+        q1, q2, q3 = np.clip([q1, q2, q3], reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1])
+        self._check_obstacles(self._pos, [q1, q2, q3])
+        self._cancel_trajectory(base=False)
+        self._q_vel = np.array([0, 0, 0], dtype=np.float64)
+        self._q = np.array([q1, q2, q3], dtype=np.float64)
+        self._publish_state()
+        self._streamer.mark_arm()
+
+    def _move_tool_to(self, x, y, theta=None):
+        # Solve from the current joint angles so the arm moves as little as possible
+        q, ok = inverse_kinematics([x, y], theta, self._pos, self._q)
+        if not ok:
+            raise ValueError("Tool target is not reachable")
+        self._set_arm_position(*q)
+        return q
+
+    def _drive_robot(self, vel_x, vel_y, timeout=-1, start_time=None):
+        self._record("drive_robot", vel_x, vel_y, timeout)
+        vel_x, vel_y = np.clip([vel_x, vel_y], -reynard_kinematics["vel_max"], reynard_kinematics["vel_max"])
+        self._cancel_trajectory(arm=False)
+        self._vel = np.array([vel_x, vel_y], dtype=np.float64)
+        self._vel_start_time = self._clock.now() if start_time is None else start_time
+        if timeout > 0:
+            self._vel_stop_time = self._vel_start_time + timeout
+        else:
+            self._vel_stop_time = -1
+        self._publish_state()
+
+    def _drive_arm(self, q1, q2, q3, timeout=-1, start_time=None):
+        self._record("drive_arm", q1, q2, q3, timeout)
+        q1, q2, q3 = np.clip([q1, q2, q3], -reynard_kinematics["q_vel_max"], reynard_kinematics["q_vel_max"])
+        self._cancel_trajectory(base=False)
+        self._q_vel = np.array([q1, q2, q3], dtype=np.float64)
+        self._q_vel_start_time = self._clock.now() if start_time is None else start_time
+        if timeout > 0:
+            self._q_vel_stop_time = self._q_vel_start_time + timeout
+        else:
+            self._q_vel_stop_time = -1
+        self._publish_state()
+
+    def _set_color(self, r, g, b):
+        self._record("set_color", r, g, b)
+        r, g, b = np.clip([r, g, b], 0, 1.0)
+        self._color = np.array([r, g, b], dtype=np.float64)
+        self._publish_state()
+        self._queue_emit('color', {'r': r, 'g': g, 'b': b}, coalesce=True)
+
+    def _record(self, name, *args):
+        # Commands are recorded as they were received, before they are clipped or rejected. Nothing is recorded
+        # during a replay, since the replayed states are not recorded either.
+        recorder = self._recorder
+        if recorder is not None and not self._replaying:
+            recorder.record_command(self._clock.now(), name, *args)
+
+    def _apply_state(self, state):
+        # Set the state from a replayed snapshot. The color is sent to the GUI since it is not part of the ticks.
+        self._pos = state.robot_position.copy()
+        self._q = state.arm_position.copy()
+        self._vel = state.robot_velocity.copy()
+        self._q_vel = state.arm_velocity.copy()
+        if np.any(self._color != state.color):
+            r, g, b = state.color.tolist()
+            self._queue_emit('color', {'r': r, 'g': g, 'b': b}, coalesce=True)
+        self._color = state.color.copy()
+        self._publish_state()
+
+    def _get_state(self):
+        return self._state
+
+    def _execute_trajectory(self, trajectory):
+        self._cancel_trajectory()
+        self._trajectory_count += 1
+        traj = TrajectoryExecution(self._trajectory_count, trajectory, self._clock.now(), self._pos, self._q,
+                                   reynard_kinematics)
+        if traj.controls_base:
+            self._vel_stop_time = -1
+        if traj.controls_arm:
+            self._q_vel_stop_time = -1
+        self._trajectory = traj
+        self._last_trajectory = traj
+        return traj
+
+    def _cancel_trajectory(self, base=True, arm=True):
+        # Cancel the active trajectory if it controls the base or arm. Commands that move an axis controlled by
+        # the trajectory cancel it.
+        traj = self._trajectory
+        if traj is None or not ((base and traj.controls_base) or (arm and traj.controls_arm)):
+            return
+        self._trajectory = None
+        if traj.controls_base:
+            self._vel = np.array([0, 0], dtype=np.float64)
+        if traj.controls_arm:
+            self._q_vel = np.array([0, 0, 0], dtype=np.float64)
+        traj.finish("cancelled")
+        self._publish_state()
+
+    def _get_trajectory_status(self):
+        if self._last_trajectory is None:
+            return None
+        return self._last_trajectory.status()
 
     async def aio_teleport(self, x, y):
         """
@@ -142,11 +466,8 @@ class Reynard:
         :param y: The y position to teleport Reynard to in millimeters
         :type y: float
         """
-        x, y = np.clip([x, y], reynard_kinematics["bounds"][0], reynard_kinematics["bounds"][1])
-        async with self.aio_lock:
-            self._vel = np.array([0, 0], dtype=np.float64)
-            self._pos = np.array([x, y], dtype=np.float64)
-            await self.socketio.emit('teleport', {'x': x, 'y': y})
+        async with self._state_lock:
+            self._teleport(x, y)
 
     async def aio_say(self, message):
         """
@@ -156,7 +477,8 @@ class Reynard:
         :param message: The message to say
         :type message: str
         """
-        await self.socketio.emit('say', message)
+        async with self._state_lock:
+            self._say(message)
 
     async def aio_set_arm_position(self, q1, q2, q3):
         """
@@ -170,11 +492,26 @@ class Reynard:
         :param q3: The position of the third arm joint in degrees
         :type q3: float
         """
-        q1, q2, q3 = np.clip([q1, q2, q3], reynard_kinematics["q_bounds"][0], reynard_kinematics["q_bounds"][1])
-        async with self.aio_lock:
-            self._q_vel = np.array([0, 0, 0], dtype=np.float64)
-            self._q = np.array([q1, q2, q3], dtype=np.float64)
-            await self.socketio.emit('arm', {'q1': q1, 'q2': q2, 'q3': q3})
+        async with self._state_lock:
+            self._set_arm_position(q1, q2, q3)
+
+    async def aio_move_tool_to(self, x, y, theta=None):
+        """
+        AIO version of move_tool_to. Set the arm joints instantly so the tool reaches a target pose.
+        Use with await in an async function.
+
+        :param x: The x position of the tool tip in millimeters
+        :type x: float
+        :param y: The y position of the tool tip in millimeters
+        :type y: float
+        :param theta: The angle of the tool in degrees, or None to reach the position with any tool angle. Default
+                      is None.
+        :type theta: float
+        :return: The new position of the arm joints in degrees
+        :rtype: numpy.ndarray
+        """
+        async with self._state_lock:
+            return self._move_tool_to(x, y, theta)
 
     async def aio_drive_robot(self, vel_x, vel_y, timeout=-1, wait=False):
         """
@@ -191,15 +528,10 @@ class Reynard:
         :param wait: If wait is True, the function will wait until the timeout has expired before returning.
                      Default is False.
         """
-        vel_x, vel_y = np.clip([vel_x, vel_y], -reynard_kinematics["vel_max"], reynard_kinematics["vel_max"])
-        async with self.aio_lock:
-            self._vel = np.array([vel_x, vel_y], dtype=np.float64)
-            if timeout > 0:
-                self._vel_stop_time = time.perf_counter() + timeout
-            else:
-                self._vel_stop_time = -1
+        async with self._state_lock:
+            self._drive_robot(vel_x, vel_y, timeout)
         if wait:
-            await asyncio.sleep(timeout)
+            await self._clock.sleep(timeout)
 
     async def aio_drive_arm(self, q1, q2, q3, timeout=-1, wait=False):
         """
@@ -213,15 +545,10 @@ class Reynard:
         :param q3: The angular velocity of the third arm joint in degrees per second
         :type q3: float
         """
-        q1, q2, q3 = np.clip([q1, q2, q3], -reynard_kinematics["q_vel_max"], reynard_kinematics["q_vel_max"])
-        async with self.aio_lock:
-            self._q_vel = np.array([q1, q2, q3], dtype=np.float64)
-            if timeout > 0:
-                self._q_vel_stop_time = time.perf_counter() + timeout
-            else:
-                self._q_vel_stop_time = -1
+        async with self._state_lock:
+            self._drive_arm(q1, q2, q3, timeout)
         if wait:
-            await asyncio.sleep(timeout)
+            await self._clock.sleep(timeout)
 
     async def aio_set_color(self, r, g, b):
         """
@@ -235,10 +562,58 @@ class Reynard:
         :param b: The blue component of the color between 0 and 1
         :type b: float
         """
-        r, g, b = np.clip([r, g, b], 0, 1.0)
-        async with self.aio_lock:
-            self._color = np.array([r, g, b], dtype=np.float64)
-            await self.socketio.emit('color', {'r': r, 'g': g, 'b': b})
+        async with self._state_lock:
+            self._set_color(r, g, b)
+
+    async def aio_execute_trajectory(self, trajectory, wait=False):
+        """
+        AIO version of execute_trajectory. Execute a waypoint trajectory.
+        Use with await in an async function.
+
+        :param trajectory: The trajectory to execute
+        :type trajectory: Trajectory
+        :param wait: If True, wait until the trajectory is completed or cancelled. Default is False.
+        :type wait: bool
+        :return: The id of the trajectory
+        :rtype: int
+        """
+        async with self._state_lock:
+            traj = self._execute_trajectory(trajectory)
+        if wait:
+            while not traj.done.is_set():
+                await self._clock.sleep(self._scheduler.period)
+        return traj.id
+
+    async def aio_cancel_trajectory(self):
+        """
+        AIO version of cancel_trajectory. Stop the trajectory being executed.
+        Use with await in an async function.
+        """
+        async with self._state_lock:
+            self._cancel_trajectory()
+
+    async def aio_execute_batch(self, commands):
+        """
+        AIO version of execute_batch. Execute a list of commands atomically.
+        Use with await in an async function.
+
+        :param commands: The commands to execute as a list of ``(name, args)`` tuples
+        :type commands: list
+        :return: The result of each command, or the exception raised by the command
+        :rtype: list
+        """
+        async with self._state_lock:
+            return self._execute_batch(commands)
+
+    def _execute_batch(self, commands):
+        # Must be called with _state_lock held
+        results = []
+        for name, args in commands:
+            try:
+                results.append(self._batch_commands[name](*args))
+            except Exception as e:
+                results.append(e)
+        return results
 
     def start(self):
         """
@@ -246,15 +621,14 @@ class Reynard:
         A thread will be created to run the server. If you are using AIO, use aio_start instead. The AIO version
         will use the asyncio event loop to run the server instead of a thread.
         """
-        self.thread = Thread(target=self._run)
+        self.thread = Thread(target=self._run, name="Reynard")
         self.thread.daemon = True
         self.thread.start()
         self._started.wait()
 
     def _run(self):
-        self._loop = asyncio.new_event_loop()
+        self._loop = self._loop_profile.new_event_loop()
         asyncio.set_event_loop(self._loop)
-        self._loop.set_debug(True)
         self._loop.run_until_complete(self.aio_start())
         self._started.set()
         self._loop.run_forever()
@@ -267,6 +641,13 @@ class Reynard:
         if self._loop.is_running():
             self._loop.stop()
 
+    def _wait(self, timeout):
+        # A virtual clock can only be waited on from the event loop
+        if self._clock.virtual:
+            asyncio.run_coroutine_threadsafe(self._clock.sleep(timeout), self._loop).result()
+        elif timeout > 0:
+            time.sleep(timeout)
+
     def teleport(self, x, y):
         """
         Instantly move Reynard to a new position.
@@ -276,7 +657,8 @@ class Reynard:
         :param y: The y position to teleport Reynard to in millimeters
         :type y: float
         """
-        asyncio.run_coroutine_threadsafe(self.aio_teleport(x, y), self._loop).result()
+        with self._state_lock:
+            self._teleport(x, y)
 
     def say(self, message):
         """
@@ -285,7 +667,8 @@ class Reynard:
         :param message: The message to say
         :type message: str
         """
-        asyncio.run_coroutine_threadsafe(self.aio_say(message), self._loop).result()
+        with self._state_lock:
+            self._say(message)
 
     def set_arm_position(self, q1, q2, q3):
         """
@@ -298,7 +681,28 @@ class Reynard:
         :param q3: The position of the third arm joint in degrees
         :type q3: float
         """
-        asyncio.run_coroutine_threadsafe(self.aio_set_arm_position(q1, q2, q3), self._loop).result()
+        with self._state_lock:
+            self._set_arm_position(q1, q2, q3)
+
+    def move_tool_to(self, x, y, theta=None):
+        """
+        Instantly set the position of Reynard's arm joints so the tool tip reaches a target position, and optionally
+        a target tool angle. The joint angles are found with ``inverse_kinematics``, starting from the current joint
+        angles so the arm moves as little as possible. The base does not move. Raises ``ValueError`` if the target
+        cannot be reached from the current base position within the joint limits.
+
+        :param x: The x position of the tool tip in millimeters
+        :type x: float
+        :param y: The y position of the tool tip in millimeters
+        :type y: float
+        :param theta: The angle of the tool in degrees, or None to reach the position with any tool angle. Default
+                      is None.
+        :type theta: float
+        :return: The new position of the arm joints in degrees
+        :rtype: numpy.ndarray
+        """
+        with self._state_lock:
+            return self._move_tool_to(x, y, theta)
 
     def drive_robot(self, vel_x, vel_y, timeout=-1, wait=False):
         """
@@ -315,7 +719,10 @@ class Reynard:
                         Default is False.
         :type wait: bool
         """
-        asyncio.run_coroutine_threadsafe(self.aio_drive_robot(vel_x, vel_y, timeout, wait), self._loop).result()
+        with self._state_lock:
+            self._drive_robot(vel_x, vel_y, timeout)
+        if wait:
+            self._wait(timeout)
 
     def drive_arm(self, q1, q2, q3, timeout=-1, wait=False):
         """
@@ -333,69 +740,493 @@ class Reynard:
         :param wait: If wait is True, the function will wait until the timeout has expired before returning.
                         Default is False.
         """
-        asyncio.run_coroutine_threadsafe(self.aio_drive_arm(q1, q2, q3, timeout, wait), self._loop).result()
+        with self._state_lock:
+            self._drive_arm(q1, q2, q3, timeout)
+        if wait:
+            self._wait(timeout)
+
+    def set_setpoint(self, name, *args):
+        """
+        Set a setpoint that is applied at the start of the next simulation tick. Unlike the other commands, this
+        method does not take the state lock and returns immediately, so it can be called at a high rate from control
+        loops and communication threads. Only the last setpoint of each kind set before a tick is applied, and the
+        earlier ones are discarded. Setpoints that cannot be applied, such as arm positions that would collide with
+        an obstacle, are dropped. Setpoints are not applied while a log is being replayed. Velocity setpoints are
+        active for the whole tick they are applied in, and their ``timeout`` is measured from the start of that tick.
+
+        The available setpoints are:
+
+        - ``("drive_robot", vel_x, vel_y, timeout)``, ``timeout`` is optional
+        - ``("drive_arm", q1, q2, q3, timeout)``, ``timeout`` is optional
+        - ``("set_arm_position", q1, q2, q3)``
+
+        Setting ``set_arm_position`` replaces a pending ``drive_arm`` setpoint and the other way around.
+
+        :param name: The name of the setpoint
+        :type name: str
+        :param args: The arguments of the command with the same name
+        """
+        if name not in self._setpoint_commands:
+            raise ValueError(f"Invalid setpoint {name}")
+        with self._setpoint_lock:
+            if name == "drive_arm":
+                self._setpoints.pop("set_arm_position", None)
+            elif name == "set_arm_position":
+                self._setpoints.pop("drive_arm", None)
+            self._setpoints[name] = args
+
+    def execute_batch(self, commands):
+        """
+        Execute a list of commands atomically. All commands are executed in order with a single acquisition of the
+        lock, so the simulation loop and other clients do not observe the intermediate states. A command that raises
+        an exception does not prevent the remaining commands from executing.
+
+        Each command is a ``(name, args)`` tuple, where ``args`` is a tuple of positional arguments. The available
+        commands are:
+
+        - ``("teleport", (x, y))``
+        - ``("say", (message,))``
+        - ``("set_arm_position", (q1, q2, q3))``
+        - ``("move_tool_to", (x, y, theta))``, ``theta`` is optional, returns the new joint angles
+        - ``("drive_robot", (vel_x, vel_y, timeout))``, ``timeout`` is optional
+        - ``("drive_arm", (q1, q2, q3, timeout))``, ``timeout`` is optional
+        - ``("set_color", (r, g, b))``
+        - ``("state", ())`` returns the ``ReynardState`` at that point in the batch
+        - ``("execute_trajectory", (trajectory,))``
+        - ``("cancel_trajectory", ())``
+        - ``("trajectory_status", ())`` returns the trajectory status dictionary
+
+        Commands executed in a batch cannot wait for a drive timeout.
+
+        :param commands: The commands to execute
+        :type commands: list
+        :return: The result of each command, or the exception raised by the command
+        :rtype: list
+        """
+        with self._state_lock:
+            return self._execute_batch(commands)
+
+    def execute_trajectory(self, trajectory, wait=False):
+        """
+        Execute a waypoint trajectory for the base, the arm, or both. The simulation loop moves Reynard through the
+        waypoints starting from the current position, slowing down segments as needed to respect the velocity
+        limits. Any trajectory being executed is cancelled. Commands that move an axis controlled by the trajectory,
+        such as teleport or drive_robot for the base, cancel the trajectory.
+
+        Use ``trajectory_status`` to read the progress. When waiting, do not call from the event loop thread.
+
+        :param trajectory: The trajectory to execute
+        :type trajectory: Trajectory
+        :param wait: If True, wait until the trajectory is completed or cancelled. Default is False.
+        :type wait: bool
+        :return: The id of the trajectory
+        :rtype: int
+        """
+        with self._state_lock:
+            traj = self._execute_trajectory(trajectory)
+        if wait:
+            traj.done.wait()
+        return traj.id
+
+    def cancel_trajectory(self):
+        """
+        Stop the trajectory being executed. The axes controlled by the trajectory stop at their current position.
+        """
+        with self._state_lock:
+            self._cancel_trajectory()
+
+    @property
+    def trajectory_status(self):
+        """
+        Get the status of the last trajectory as a dictionary, or None if no trajectory has been executed. Contains
+        the trajectory ``id``, the ``state`` which is ``running``, ``completed``, ``cancelled`` or ``collision``
+        if it was stopped by an obstacle, the elapsed
+        ``time`` and total ``duration`` in seconds, the ``progress`` between 0 and 1, and the index of the
+        ``waypoint`` that the robot is moving towards. The waypoint is equal to the number of waypoints when the
+        trajectory is completed.
+        """
+        with self._state_lock:
+            return self._get_trajectory_status()
+
+    @property
+    def obstacles(self):
+        """
+        Get or set the ``ObstacleMap`` of obstacles that Reynard stops at, or None for no obstacles. The body and
+        arm are checked against the obstacles each tick along the straight line motion from the previous tick, and
+        motion that would touch an obstacle is stopped at the last free position, the position at the previous tick.
+        Commands that move Reynard instantly into an obstacle raise ``ValueError``. The obstacles are not shown in
+        the GUI.
+        """
+        return self._obstacles
+
+    @obstacles.setter
+    def obstacles(self, obstacles):
+        with self._state_lock:
+            self._obstacles = obstacles
+
+    def check_trajectory(self, trajectory):
+        """
+        Check if executing a trajectory from the current position would touch an obstacle, without moving Reynard.
+
+        :param trajectory: The trajectory to check
+        :type trajectory: Trajectory
+        :return: None if the trajectory is free of obstacles, otherwise the index of the waypoint that Reynard is
+                 moving towards when it would touch an obstacle
+        :rtype: int
+        """
+        with self._state_lock:
+            obstacles = self._obstacles
+            traj = TrajectoryExecution(0, trajectory, 0, self._pos, self._q, reynard_kinematics)
+        if obstacles is None:
+            return None
+        w = traj.waypoints
+        i = obstacles.check_path(w[:, 0:2], w[:, 2:5])
+        return max(i - 1, 0) if i is not None else None
+
+    def start_recording(self, path, index_interval=256):
+        """
+        Start recording the state snapshot of each simulation tick and every teleport, say, set_arm_position,
+        drive_robot, drive_arm, set_color and GUI message command to a binary log file. Commands are recorded with
+        their arguments as received, including commands that were rejected. The records are written to the file by a
+        background thread, so recording does not slow down the simulation loop. Read the file with ``StateLog`` or
+        play it back with ``replay``. Raises ``RuntimeError`` if already recording.
+
+        :param path: The path of the log file. An existing file is replaced.
+        :type path: str
+        :param index_interval: The number of records between index records. Default is 256.
+        :type index_interval: int
+        :return: The recorder writing the file
+        :rtype: StateRecorder
+        """
+        with self._state_lock:
+            if self._recorder is not None:
+                raise RuntimeError("Reynard is already recording")
+            recorder = StateRecorder(path, index_interval)
+            recorder.record_state(self._state)
+            self._recorder = recorder
+        return recorder
+
+    def stop_recording(self):
+        """
+        Stop recording and close the log file. Blocks until the remaining records are written. Does nothing if not
+        recording.
+        """
+        with self._state_lock:
+            recorder = self._recorder
+            self._recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    @property
+    def history(self):
+        """
+        Get the ``StateHistory`` containing the state of each recent simulation tick. The history has a fixed
+        capacity set when Reynard is created, so the memory used does not grow with the uptime. Use
+        ``history.view()`` to read a time window as a NumPy array without copying.
+        """
+        return self._history
+
+    @property
+    def recorder(self):
+        """
+        Get the ``StateRecorder`` of the current recording, or None if not recording.
+        """
+        return self._recorder
+
+    async def aio_replay(self, log, speed=1.0, start_time=None, end_time=None):
+        """
+        AIO version of replay. Play back a recorded log file.
+        Use with await in an async function.
+
+        :param log: The path of the log file, or an open ``StateLog``
+        :type log: str or StateLog
+        :param speed: The playback speed relative to the recorded time. Default is 1.
+        :type speed: float
+        :param start_time: The recorded time in seconds to start playing from. Default is None, the start of the log.
+        :type start_time: float
+        :param end_time: The recorded time in seconds to stop playing at. Default is None, the end of the log.
+        :type end_time: float
+        """
+        if not speed > 0:
+            raise ValueError("Replay speed must be greater than zero")
+        owned = not isinstance(log, StateLog)
+        if owned:
+            log = StateLog(log)
+        try:
+            async with self._state_lock:
+                self._begin_replay()
+        except BaseException:
+            if owned:
+                log.close()
+            raise
+        await self._aio_replay(log, owned, speed, start_time, end_time)
+
+    def _begin_replay(self):
+        if self._replaying:
+            raise RuntimeError("Reynard is already replaying a log")
+        self._cancel_trajectory()
+        self._replaying = True
+
+    async def _aio_replay(self, log, owned, speed, start_time, end_time):
+        # Play back an open log after _begin_replay, closing the log when finished if owned is True
+        try:
+            t0 = self._clock.now()
+            log_t0 = None
+            for t, name, data in log.records(start_time, end_time):
+                if log_t0 is None:
+                    log_t0 = t
+                delay = t0 + (t - log_t0) / speed - self._clock.now()
+                if delay > 0:
+                    await self._clock.sleep(delay)
+                else:
+                    await asyncio.sleep(0)
+                if name == "message":
+                    seqno = self._messages.append(data)
+                    self._new_message.send(None, message=data, seqno=seqno)
+                    continue
+                async with self._state_lock:
+                    if name == "state":
+                        self._apply_state(data)
+                    elif name == "say":
+                        self._say(data)
+        finally:
+            async with self._state_lock:
+                self._replaying = False
+                self._stop_motion("cancelled")
+                self._publish_state()
+            if owned:
+                log.close()
+
+    def replay(self, log, speed=1.0, start_time=None, end_time=None, wait=True):
+        """
+        Play back a log file recorded with ``start_recording``. The recorded state snapshots are applied at the
+        recorded times, scaled by the playback speed, and the say commands and GUI messages are sent again, so the
+        web GUI and all clients see the recorded motion. The other recorded commands are not executed again since
+        their effect is contained in the snapshots. The simulation is paused during the replay, and commands received
+        during the replay are overwritten by the next snapshot. Reynard stops at the last replayed state. If a recording
+        is running, nothing is recorded during the replay.
+
+        :param log: The path of the log file, or an open ``StateLog``
+        :type log: str or StateLog
+        :param speed: The playback speed relative to the recorded time. Default is 1.
+        :type speed: float
+        :param start_time: The recorded time in seconds to start playing from. Default is None, the start of the log.
+        :type start_time: float
+        :param end_time: The recorded time in seconds to stop playing at. Default is None, the end of the log.
+        :type end_time: float
+        :param wait: If True, wait until the replay is finished. Default is True.
+        :type wait: bool
+        :return: If ``wait`` is False, a ``concurrent.futures.Future`` that completes when the replay is finished,
+                 and holds the exception if the replay failed. Otherwise None.
+        :rtype: concurrent.futures.Future
+        """
+        # Errors in the arguments and the log file are raised here, even when not waiting for the replay
+        if not speed > 0:
+            raise ValueError("Replay speed must be greater than zero")
+        owned = not isinstance(log, StateLog)
+        if owned:
+            log = StateLog(log)
+        try:
+            with self._state_lock:
+                self._begin_replay()
+        except BaseException:
+            if owned:
+                log.close()
+            raise
+        future = asyncio.run_coroutine_threadsafe(self._aio_replay(log, owned, speed, start_time, end_time),
+                                                  self._loop)
+        if not wait:
+            return future
+        future.result()
+
+    @property
+    def replaying(self):
+        """
+        True while a log is being replayed.
+        """
+        return self._replaying
+
+    @property
+    def state(self):
+        """
+        Get the latest immutable snapshot of Reynard's state as a ``ReynardState``. All fields of the snapshot are
+        sampled at the same time. Use this property instead of reading the individual properties when a consistent
+        state is required.
+        """
+        return self._state
 
     @property
     def arm_position(self):
         """
-        Get the current position of Reynard's arm joints in degrees.
+        Get the current position of Reynard's arm joints in degrees. The returned array is read-only.
         """
-        return self._q
+        return self._state.arm_position
 
     @property
     def robot_position(self):
         """
-        Get the current position of Reynard's base.
+        Get the current position of Reynard's base. The returned array is read-only.
+        """
+        return self._state.robot_position
+
+    @property
+    def tool_pose(self):
+        """
+        Get the current pose of Reynard's tool as ``[x, y, theta]``, with the position of the tool tip in millimeters
+        and the angle of the tool in degrees. The returned array is read-only.
         """
-        return self._pos
+        return self._state.tool_pose
 
     @property
     def robot_velocity(self):
         """
-        Get the current velocity of Reynard's base.
+        Get the current velocity of Reynard's base. The returned array is read-only.
         """
-        return self._vel
+        return self._state.robot_velocity
 
     @property
     def arm_velocity(self):
         """
-        Get the current velocity of Reynard's arm joints.
+        Get the current velocity of Reynard's arm joints. The returned array is read-only.
         """
-        return self._q_vel
+        return self._state.arm_velocity
 
     @property
     def time(self):
         """
-        Get the current simulation time in seconds. The simulation time starts at 0 when the server is started.
+        Get the current simulation time in seconds. The simulation time starts at 0 when Reynard is created.
         """
-        return time.perf_counter()
+        return self._clock.now()
 
     @property
     def color(self):
         """
         Get or set the color of Reynard's body as an RGB tuple between 0 and 1. Use aio_set_color to set the color
-        when using AIO.
+        when using AIO. The returned array is read-only.
         """
-        return self._color
+        return self._state.color
 
     @color.setter
     def color(self, color):
-        asyncio.run_coroutine_threadsafe(self.aio_set_color(*color), self._loop).result()
+        with self._state_lock:
+            self._set_color(*color)
+
+    @property
+    def aio_lock(self):
+        """
+        Deprecated. The state of Reynard is protected by a thread lock instead of an ``asyncio.Lock``, so the
+        synchronous methods do not wait for the event loop. This alias of the thread lock can still be used with
+        ``async with`` to run several commands atomically, but the lock blocks the synchronous methods while it is
+        held, so it must not be held across slow awaits. Use ``aio_execute_batch`` instead.
+        """
+        warnings.warn("Reynard.aio_lock is deprecated, use aio_execute_batch to run commands atomically",
+                      DeprecationWarning, stacklevel=2)
+        return self._state_lock
+
+    @property
+    def clock(self):
+        """
+        Get the clock used for the simulation time.
+        """
+        return self._clock
+
+    @property
+    def loop_profile(self):
+        """
+        Get the ``LoopProfile`` used to create the event loop.
+        """
+        return self._loop_profile
+
+    @property
+    def loop_debug(self):
+        """
+        Get or set the asyncio debug mode of the running event loop. Debug mode can be enabled at runtime to
+        diagnose slow callbacks, and should be disabled again afterwards since it slows down the server.
+        """
+        return self._loop is not None and self._loop.get_debug()
+
+    @loop_debug.setter
+    def loop_debug(self, enabled):
+        self._loop.call_soon_threadsafe(self._loop.set_debug, bool(enabled))
+
+    @property
+    def loop_stats(self):
+        """
+        Get the timing statistics of the simulation loop as a dictionary. Contains the nominal ``rate`` in Hz,
+        the number of ``ticks``, the number of ``overruns`` and ``missed`` deadlines, and the ``mean_period``,
+        ``jitter`` and ``max_lateness`` in seconds.
+        """
+        return self._scheduler.stats()
+
+    @property
+    def metrics(self):
+        """
+        Get the ``MetricsRegistry`` containing the instrumentation metrics. Use ``metrics.collect()`` to read the
+        current values as a dictionary. The metrics are also available in the Prometheus text format at
+        ``GET /metrics``.
+        """
+        return self._metrics
+
+    @property
+    def profiler(self):
+        """
+        Get the ``SamplingProfiler`` used by the ``POST /api/debug/profile`` endpoint. The profiler samples all
+        threads of the process and can be started and stopped at any time.
+        """
+        return self._profiler
+
+    @property
+    def streamer(self):
+        """
+        Get the ``SocketIOStateStreamer`` that sends state frames to the web GUI. The thresholds and maximum rate
+        can be changed at runtime using the attributes of the streamer.
+        """
+        return self._streamer
+
+    @property
+    def stream_stats(self):
+        """
+        Get the web GUI streaming statistics as a dictionary. Contains the number of ``clients``, the number of
+        distinct ``frames`` generated, and the ``messages_sent`` and ``bytes_sent`` counting each recipient.
+        """
+        return self._streamer.stats()
+
+    @property
+    def state_tick(self):
+        """
+        Event sent by the simulation loop after each tick with the new ``ReynardState`` as the ``state`` keyword
+        argument. The receivers are called on the event loop thread without the state lock held, and must return
+        quickly since they delay the simulation loop. This property is a blinker signal. Use the connect method to
+        connect to the signal.
+        """
+        return self._state_tick
 
     @property
     def new_message(self):
         """
-        Event for new messages received from the API. Connect to this event to receive new messages. This property
-        is a blinker signal. Use the connect method to connect to the signal.
+        Event for new messages received from the API. Connect to this event to receive new messages. The receivers
+        are called with the ``message`` and its ``seqno`` in ``messages`` as keyword arguments. This property is a
+        blinker signal. Use the connect method to connect to the signal.
         """
         return self._new_message
 
+    @property
+    def messages(self):
+        """
+        Get the ``MessageLog`` containing the recent messages received from the API. Each consumer reads the log
+        with its own cursor, so reading does not remove the messages for the other consumers.
+        """
+        return self._messages
+
     def _register_api(self):
         async def api_get_messages(request):
-            messages = []
-            while not self._api_msg_queue.empty():
-                messages.append(await self._api_msg_queue.get())
-            return web.json_response(messages)
+            if "after" in request.query:
+                return rest.handle_messages(request, self._messages)
+            # Without a cursor, return the messages not returned by the previous request
+            messages = self._messages.read(self._api_msg_cursor)
+            if messages:
+                self._api_msg_cursor = messages[-1][0]
+            return web.json_response([m for _, m in messages])
 
         async def api_post_teleport(request):
             json = await request.json()
@@ -446,26 +1277,78 @@ class Reynard:
             return web.Response()
 
         async def api_get_state(request):
-            res = {
-                "time": self.time,
-                "x": self._pos[0],
-                "y": self._pos[1],
-                "q1": self._q[0],
-                "q2": self._q[1],
-                "q3": self._q[2],
-                "vel_x": self._vel[0],
-                "vel_y": self._vel[1],
-                "vel_q1": self._q_vel[0],
-                "vel_q2": self._q_vel[1],
-                "vel_q3": self._q_vel[2]
-            }
-            return web.json_response(res)
+            fields = rest.parse_state_fields(request)
+            return web.json_response(self._state.to_dict(fields))
+
+        async def api_post_batch(request):
+            return await rest.handle_batch(request, self)
+
+        async def api_post_trajectory(request):
+            json = await request.json()
+            try:
+                trajectory = rest.parse_trajectory(json)
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            wait = bool(json.get("wait", False))
+            trajectory_id = await self.aio_execute_trajectory(trajectory, wait)
+            return web.json_response({"id": trajectory_id})
+
+        async def api_get_trajectory(request):
+            return web.json_response(self.trajectory_status)
+
+        async def api_post_move_tool_to(request):
+            json = await request.json()
+            try:
+                q1, q2, q3 = (await self.aio_move_tool_to(json["x"], json["y"], json.get("theta"))).tolist()
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            return web.json_response({"q1": q1, "q2": q2, "q3": q3})
+
+        async def api_get_obstacles(request):
+            obstacles = self._obstacles
+            return web.json_response(obstacles.to_dict() if obstacles is not None else None)
+
+        async def api_put_obstacles(request):
+            self.obstacles = await rest.parse_obstacles(request)
+            return web.Response()
+
+        async def api_post_obstacles_check(request):
+            return await rest.handle_obstacles_check(request, self._obstacles)
+
+        async def api_post_trajectory_check(request):
+            json = await request.json()
+            try:
+                trajectory = rest.parse_trajectory(json)
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            waypoint = self.check_trajectory(trajectory)
+            return web.json_response({"collision": waypoint is not None, "waypoint": waypoint})
+
+        async def api_post_trajectory_cancel(request):
+            await self.aio_cancel_trajectory()
+            return web.Response()
+
+        async def api_post_debug_profile(request):
+            return await rest.handle_profile(request, self._profiler)
+
+        async def api_clock(request):
+            return await rest.handle_clock(request, self._clock)
+
+        async def api_get_history(request):
+            return await rest.handle_history(request, self._history)
+
+        async def api_get_state_ws(request):
+            return await rest.handle_state_websocket(request, self)
+
+        async def api_get_state_events(request):
+            return await rest.handle_state_events(request, self)
 
         async def api_get_color(request):
+            c = self._state.color.tolist()
             res = {
-                "r": self._color[0],
-                "g": self._color[1],
-                "b": self._color[2]
+                "r": c[0],
+                "g": c[1],
+                "b": c[2]
             }
             return web.json_response(res)
 
@@ -485,5 +1368,22 @@ class Reynard:
         self.app.router.add_post('/api/drive_arm', api_post_drive_arm)
         self.app.router.add_post('/api/color', api_post_color)
         self.app.router.add_get('/api/state', api_get_state)
+        self.app.router.add_get('/api/state/ws', api_get_state_ws)
+        self.app.router.add_get('/api/state/events', api_get_state_events)
+        self.app.router.add_get('/api/history', api_get_history)
         self.app.router.add_get('/api/color', api_get_color)
         self.app.router.add_post('/api/set_arm_position', api_set_arm_position)
+        self.app.router.add_post('/api/batch', api_post_batch)
+        self.app.router.add_post('/api/trajectory', api_post_trajectory)
+        self.app.router.add_get('/api/trajectory', api_get_trajectory)
+        self.app.router.add_post('/api/trajectory/cancel', api_post_trajectory_cancel)
+        self.app.router.add_post('/api/trajectory/check', api_post_trajectory_check)
+        self.app.router.add_get('/api/obstacles', api_get_obstacles)
+        self.app.router.add_put('/api/obstacles', api_put_obstacles)
+        self.app.router.add_post('/api/obstacles/check', api_post_obstacles_check)
+        self.app.router.add_post('/api/move_tool_to', api_post_move_tool_to)
+        self.app.router.add_post('/api/kinematics/forward', rest.handle_forward_kinematics)
+        self.app.router.add_post('/api/kinematics/inverse', rest.handle_inverse_kinematics)
+        self.app.router.add_post('/api/debug/profile', api_post_debug_profile)
+        self.app.router.add_get('/api/clock', api_clock)
+        self.app.router.add_post('/api/clock', api_clock)
@@ -2,19 +2,52 @@ import RobotRaconteur as RR
 import threading
 import numpy as np
 
+from .trajectory import Trajectory
+from .reynard import Reynard
+
 _reynard_robdef = """
 service experimental.reynard_the_robot
 
 stdver 0.10
 
 struct ReynardState
+    field uint64 seqno
+    field double time
+    field double[] robot_position
+    field double[] arm_position
+    field double[] robot_velocity
+    field double[] arm_velocity
+    field double[] tool_pose
+end
+
+struct TrajectoryStatus
+    field uint32 id
+    field string state
     field double time
+    field double duration
+    field int32 waypoint
+end
+
+struct StateHistory
+    field uint64[] seqno
+    field double[] time
     field double[] robot_position
     field double[] arm_position
     field double[] robot_velocity
     field double[] arm_velocity
 end
 
+struct TrajectoryChunk
+    field double[] times
+    field double[] robot_positions
+    field double[] arm_positions
+end
+
+struct Message
+    field uint64 seqno
+    field string message
+end
+
 object Reynard
 
     function void teleport(double x, double y)
@@ -25,6 +58,10 @@ object Reynard
 
     property double[] robot_position [readonly]
 
+    property double[] tool_pose [readonly]
+
+    function double[] move_tool_to(double x, double y, double theta)
+
     function void drive_robot(double vel_x, double vel_y, double timeout, bool wait)
 
     function void drive_arm(double q1, double q2, double q3, double timeout, bool wait)
@@ -33,16 +70,52 @@ object Reynard
 
     property double[] color
 
+    function uint32 execute_trajectory(double[] times, double[] robot_positions, double[] arm_positions, bool wait)
+
+    function void cancel_trajectory()
+
+    property TrajectoryStatus trajectory_status [readonly]
+
+    function StateHistory get_state_history(double start_time, double end_time)
+
+    function StateHistory{generator} read_state_history(double start_time, double end_time, uint32 max_samples)
+
+    function void{generator} upload_trajectory(bool wait, TrajectoryChunk{generator} chunks)
+
+    function Message{list} read_messages(uint64 after, uint32 max_count)
+
+    property uint64 last_message_seqno [readonly]
+
     wire ReynardState state [readonly]
 
+    wire double[] velocity_command [writeonly]
+
+    wire double[] arm_velocity_command [writeonly]
+
+    wire double[] arm_position_command [writeonly]
+
     event new_message(string message)
 end
 """
 
+# Velocity commands received on the command wires expire after this time in seconds, so Reynard stops if the client
+# stops sending or disconnects
+_velocity_command_timeout = 0.5
+
+# Maximum number of snapshots returned by get_state_history, keeping the response below the message size limit
+_max_history_samples = 50000
+
+
+def _check_reynard(reynard):
+    # The service uses the Reynard only API, such as state_tick, set_setpoint and the state history
+    if not isinstance(reynard, Reynard):
+        raise TypeError("The Robot Raconteur service requires a Reynard, fleet robots are not supported")
+
 
 class ReynardImpl:
 
-    def __init__(self, reynard, node=None):
+    def __init__(self, reynard, node=None, state_rate=None):
+        _check_reynard(reynard)
         if node is None:
             self._node = RR.RobotRaconteurNode.s
         else:
@@ -52,18 +125,41 @@ class ReynardImpl:
         self._lock = threading.Lock()
 
         self._reynard_state_type = self._node.GetStructureType("experimental.reynard_the_robot.ReynardState")
+        self._trajectory_status_type = self._node.GetStructureType("experimental.reynard_the_robot.TrajectoryStatus")
+        self._state_history_type = self._node.GetStructureType("experimental.reynard_the_robot.StateHistory")
+        self._message_type = self._node.GetStructureType("experimental.reynard_the_robot.Message")
 
         self.new_message = RR.EventHook()
 
         reynard.new_message.connect(self._new_message)
 
-        self._state_timer = None
+        self._state_period = 1.0 / state_rate if state_rate is not None else 0.0
+        self._next_publish = None
+        self._last_state = None
+        self._state_publish_total = reynard.metrics["reynard_robotraconteur_state_publish_total"]
+        self._state_skipped_total = reynard.metrics["reynard_robotraconteur_state_skipped_total"]
+
+        # The state wire value is a single structure whose arrays are updated in place before each publish
+        s = self._reynard_state_type()
+        s.robot_position = np.zeros((2,), dtype=np.float64)
+        s.arm_position = np.zeros((3,), dtype=np.float64)
+        s.robot_velocity = np.zeros((2,), dtype=np.float64)
+        s.arm_velocity = np.zeros((3,), dtype=np.float64)
+        s.tool_pose = np.zeros((3,), dtype=np.float64)
+        self._state_struct = s
 
     def RRServiceObjectInit(self, ctx, path):
-        self._state_timer = self._node.CreateTimer(0.05, self._timer_cb, False)
-        self._state_timer.Start()
+        # The state wire is published by the simulation loop after each tick
+        self._reynard.state_tick.connect(self._state_tick_cb)
+        # Values received on the command wires are applied at the next tick, the last value received wins
+        self.velocity_command.InValueChanged += self._velocity_command_cb
+        self.arm_velocity_command.InValueChanged += self._arm_velocity_command_cb
+        self.arm_position_command.InValueChanged += self._arm_position_command_cb
 
-    def _new_message(self, _, message):
+    def close(self):
+        self._reynard.state_tick.disconnect(self._state_tick_cb)
+
+    def _new_message(self, _, message, **kwargs):
         self.new_message.fire(message)
 
     def teleport(self, x, y):
@@ -90,6 +186,24 @@ class ReynardImpl:
     def robot_position(self):
         return np.array(self._reynard.robot_position, dtype=np.float64) * 1e-3
 
+    @property
+    def tool_pose(self):
+        return self._tool_pose_to_rr(self._reynard.tool_pose)
+
+    def move_tool_to(self, x, y, theta):
+        # A NaN angle reaches the position with any tool angle. Convert from m to mm and radians to degrees
+        theta_1 = None if np.isnan(theta) else np.rad2deg(theta)
+        try:
+            q = self._reynard.move_tool_to(x * 1e3, y * 1e3, theta_1)
+        except ValueError as e:
+            raise RR.InvalidArgumentException(str(e))
+        return np.deg2rad(q)
+
+    @staticmethod
+    def _tool_pose_to_rr(pose):
+        # Convert from mm to m and degrees to radians
+        return np.array([pose[0] * 1e-3, pose[1] * 1e-3, np.deg2rad(pose[2])], dtype=np.float64)
+
     def drive_robot(self, vel_x, vel_y, timeout, wait):
         vel_x_1 = vel_x * 1e3
         vel_y_1 = vel_y * 1e3
@@ -118,32 +232,215 @@ class ReynardImpl:
             raise RR.InvalidArgumentException("Invalid color value")
         self._reynard.color = c
 
-    def _timer_cb(self, evt):
-        s = self._reynard_state_type()
-        s.time = self._reynard.time
-        s.robot_position = np.array(self._reynard.robot_position, dtype=np.float64)
-        s.arm_position = np.array(self._reynard.arm_position, dtype=np.float64)
-        s.robot_velocity = np.array(self._reynard.robot_velocity, dtype=np.float64)
-        s.arm_velocity = np.array(self._reynard.arm_velocity, dtype=np.float64)
+    def execute_trajectory(self, times, robot_positions, arm_positions, wait):
+        # Empty position arrays are not controlled by the trajectory. Convert from m to mm and radians to degrees
+        robot_positions_1 = np.asarray(robot_positions).reshape((-1, 2)) * 1e3 if len(robot_positions) > 0 else None
+        arm_positions_1 = np.rad2deg(np.asarray(arm_positions)).reshape((-1, 3)) if len(arm_positions) > 0 else None
+        times_1 = times if len(times) > 0 else None
+        try:
+            traj = Trajectory(robot_positions_1, arm_positions_1, times_1)
+        except ValueError as e:
+            raise RR.InvalidArgumentException(str(e))
+        return self._reynard.execute_trajectory(traj, wait)
+
+    def cancel_trajectory(self):
+        self._reynard.cancel_trajectory()
+
+    @property
+    def trajectory_status(self):
+        status = self._reynard.trajectory_status
+        s = self._trajectory_status_type()
+        if status is None:
+            s.id = 0
+            s.state = "none"
+            return s
+        s.id = status["id"]
+        s.state = status["state"]
+        s.time = status["time"]
+        s.duration = status["duration"]
+        s.waypoint = status["waypoint"]
+        return s
+
+    def _history_window(self, start_time, end_time):
+        # NaN times leave the window open at that end
+        start_time_1 = None if np.isnan(start_time) else start_time
+        end_time_1 = None if np.isnan(end_time) else end_time
+        return self._reynard.history.window(start_time_1, end_time_1, max_count=_max_history_samples + 1)
+
+    def _history_to_rr(self, h, i0=0, i1=None):
+        # Pack rows i0 to i1 of the window into flat arrays. Convert from mm to m and degrees to radians
+        s = self._state_history_type()
+        s.seqno = h["seqno"][i0:i1]
+        s.time = h["time"][i0:i1]
+        s.robot_position = (h["robot_position"][i0:i1] * 1e-3).ravel()
+        s.arm_position = np.deg2rad(h["arm_position"][i0:i1]).ravel()
+        s.robot_velocity = (h["robot_velocity"][i0:i1] * 1e-3).ravel()
+        s.arm_velocity = np.deg2rad(h["arm_velocity"][i0:i1]).ravel()
+        return s
+
+    def get_state_history(self, start_time, end_time):
+        h = self._history_window(start_time, end_time)
+        if len(h["time"]) > _max_history_samples:
+            raise RR.InvalidArgumentException(f"More than {_max_history_samples} states in the time window, "
+                                              "use read_state_history")
+        return self._history_to_rr(h)
+
+    def read_state_history(self, start_time, end_time, max_samples):
+        if max_samples < 1:
+            raise RR.InvalidArgumentException("max_samples must be at least 1")
+        start_time_1 = None if np.isnan(start_time) else start_time
+        end_time_1 = None if np.isnan(end_time) else end_time
+        return _StateHistoryGenerator(self, self._reynard.history.window(start_time_1, end_time_1), max_samples)
+
+    def upload_trajectory(self, wait):
+        return _TrajectoryUploadGenerator(self._reynard, wait)
+
+    def read_messages(self, after, max_count):
+        # Clients keep the seqno of the last message read as the cursor, so messages fired while the client was not
+        # connected to the new_message event can be read later
+        if max_count < 1:
+            raise RR.InvalidArgumentException("max_count must be at least 1")
+        res = []
+        for seqno, message in self._reynard.messages.read(after, max_count):
+            m = self._message_type()
+            m.seqno = seqno
+            m.message = message
+            res.append(m)
+        return res
+
+    @property
+    def last_message_seqno(self):
+        return self._reynard.messages.last_seqno
+
+    def _velocity_command_cb(self, value, ts, ep):
+        # Convert from m/s to mm/s. Invalid values cannot be reported to the client and are ignored.
+        if len(value) != 2:
+            return
+        self._reynard.set_setpoint("drive_robot", value[0] * 1e3, value[1] * 1e3, _velocity_command_timeout)
+
+    def _arm_velocity_command_cb(self, value, ts, ep):
+        # Convert from radians/s to degrees/s
+        if len(value) != 3:
+            return
+        q = np.rad2deg(value)
+        self._reynard.set_setpoint("drive_arm", q[0], q[1], q[2], _velocity_command_timeout)
+
+    def _arm_position_command_cb(self, value, ts, ep):
+        # Convert from radians to degrees
+        if len(value) != 3:
+            return
+        q = np.rad2deg(value)
+        self._reynard.set_setpoint("set_arm_position", q[0], q[1], q[2])
+
+    def _state_tick_cb(self, _, state):
+        # Called on the event loop thread after each simulation tick. The snapshot is immutable, so the last published
+        # snapshot can be kept to detect changes without copying.
+        if self._next_publish is None:
+            self._next_publish = state.time
+        if state.time < self._next_publish:
+            return
+        # After a gap longer than the period, restart the schedule from this tick instead of publishing the
+        # following ticks back to back
+        next_publish = self._next_publish + self._state_period
+        self._next_publish = next_publish if next_publish > state.time else state.time + self._state_period
+        last = self._last_state
+        if last is not None and np.array_equal(last._data, state._data):
+            self._state_skipped_total.inc()
+            return
+        self._last_state = state
+
+        # Convert from mm to m and degrees to radians
+        s = self._state_struct
+        s.seqno = state.seqno
+        s.time = state.time
+        np.multiply(state.robot_position, 1e-3, out=s.robot_position)
+        np.deg2rad(state.arm_position, out=s.arm_position)
+        np.multiply(state.robot_velocity, 1e-3, out=s.robot_velocity)
+        np.deg2rad(state.arm_velocity, out=s.arm_velocity)
+        pose = state.tool_pose
+        np.multiply(pose[0:2], 1e-3, out=s.tool_pose[0:2])
+        s.tool_pose[2] = np.deg2rad(pose[2])
 
         self.state.OutValue = s
+        self._state_publish_total.inc()
+
+
+class _StateHistoryGenerator:
+    # Returns a copy of the history window taken when the generator was created in chunks of max_samples states
+
+    def __init__(self, impl, window, max_samples):
+        self._impl = impl
+        self._window = window
+        self._max_samples = max_samples
+        self._pos = 0
+
+    def Next(self):
+        n = len(self._window["time"])
+        if self._pos >= n:
+            raise RR.StopIterationException("")
+        i0 = self._pos
+        self._pos = min(i0 + self._max_samples, n)
+        return self._impl._history_to_rr(self._window, i0, self._pos)
+
+    def Close(self):
+        self._pos = len(self._window["time"])
+
+    def Abort(self):
+        self._pos = len(self._window["time"])
+
+
+class _TrajectoryUploadGenerator:
+    # Collects the waypoints sent in chunks and executes the trajectory when the client closes the generator
+
+    def __init__(self, reynard, wait):
+        self._reynard = reynard
+        self._wait = wait
+        self._times = []
+        self._robot_positions = []
+        self._arm_positions = []
+
+    def Next(self, chunk):
+        # Convert from m to mm and radians to degrees
+        self._times.append(np.asarray(chunk.times, dtype=np.float64))
+        self._robot_positions.append(np.asarray(chunk.robot_positions, dtype=np.float64) * 1e3)
+        self._arm_positions.append(np.rad2deg(np.asarray(chunk.arm_positions, dtype=np.float64)))
+
+    def Close(self):
+        # Empty position arrays are not controlled by the trajectory
+        times = np.concatenate(self._times + [np.zeros((0,))])
+        robot_positions = np.concatenate(self._robot_positions + [np.zeros((0,))])
+        arm_positions = np.concatenate(self._arm_positions + [np.zeros((0,))])
+        try:
+            traj = Trajectory(robot_positions.reshape((-1, 2)) if len(robot_positions) > 0 else None,
+                              arm_positions.reshape((-1, 3)) if len(arm_positions) > 0 else None,
+                              times if len(times) > 0 else None)
+        except ValueError as e:
+            raise RR.InvalidArgumentException(str(e))
+        self._reynard.execute_trajectory(traj, self._wait)
+
+    def Abort(self):
+        self._times = []
+        self._robot_positions = []
+        self._arm_positions = []
 
 
 class ReynardRobotRaconteurService:
-    def __init__(self, reynard, argv):
+    def __init__(self, reynard, argv, state_rate=None):
+        _check_reynard(reynard)
 
         self._node = RR.RobotRaconteurNode()
         self._node.Init()
 
         self._node.RegisterServiceType(_reynard_robdef)
 
-        self._obj = ReynardImpl(reynard, self._node)
+        self._obj = ReynardImpl(reynard, self._node, state_rate)
 
         self._node_setup = RR.ServerNodeSetup("experimental.reynard_the_robot", 29200, node=self._node, argv=argv)
 
         self._ctx = self._node.RegisterService("reynard", "experimental.reynard_the_robot.Reynard", self._obj)
 
     def close(self):
+        self._obj.close()
         self._node_setup.close()
 
     def print_info(self):
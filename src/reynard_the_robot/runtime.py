@@ -0,0 +1,113 @@
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class LoopProfile:
+    """
+    Settings for the asyncio event loop that runs Reynard. Use ``LoopProfile.production()`` for deployments and
+    ``LoopProfile.development()`` to enable the asyncio debug mode diagnostics, such as warnings for slow callbacks
+    and coroutines that are never awaited. The debug mode slows down every callback and coroutine, so it should not
+    be used in production.
+
+    :param debug: Enable the asyncio debug mode. Default is False.
+    :type debug: bool
+    :param use_uvloop: Use the uvloop event loop if the ``uvloop`` package is installed. Default is False.
+    :type use_uvloop: bool
+    :param slow_callback_duration: Callbacks that run longer than this time in seconds are logged in debug mode.
+                                   None to use the asyncio default. Default is None.
+    :type slow_callback_duration: float
+    """
+
+    def __init__(self, debug=False, use_uvloop=False, slow_callback_duration=None):
+        self.debug = debug
+        self.use_uvloop = use_uvloop
+        self.slow_callback_duration = slow_callback_duration
+
+    @classmethod
+    def production(cls):
+        """
+        Profile for deployments. Debug mode is disabled and uvloop is used if installed.
+
+        :rtype: LoopProfile
+        """
+        return cls(debug=False, use_uvloop=True)
+
+    @classmethod
+    def development(cls):
+        """
+        Profile for development. Debug mode is enabled and callbacks longer than 50 ms are logged.
+
+        :rtype: LoopProfile
+        """
+        return cls(debug=True, use_uvloop=False, slow_callback_duration=0.05)
+
+    @property
+    def uvloop_active(self):
+        """
+        True if loops created by this profile use uvloop.
+        """
+        return self.use_uvloop and uvloop is not None
+
+    def apply(self, loop):
+        """
+        Apply the debug settings of the profile to an existing event loop.
+
+        :param loop: The event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        loop.set_debug(self.debug)
+        if self.slow_callback_duration is not None:
+            loop.slow_callback_duration = self.slow_callback_duration
+
+    def new_event_loop(self):
+        """
+        Create a new event loop using the profile.
+
+        :rtype: asyncio.AbstractEventLoop
+        """
+        loop = uvloop.new_event_loop() if self.uvloop_active else asyncio.new_event_loop()
+        self.apply(loop)
+        return loop
+
+    def run(self, main):
+        """
+        Run a coroutine on a new event loop created using the profile and return the result, like ``asyncio.run``.
+        Use this to run AIO programs that use Reynard with the same loop settings as the threaded API.
+
+        :param main: The coroutine to run
+        :rtype: Any
+        """
+        loop = self.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(main)
+        finally:
+            try:
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+
+
+def get_loop_profile(profile):
+    """
+    Get a ``LoopProfile`` from a profile name, ``production`` or ``development``. A ``LoopProfile`` is returned
+    unchanged, and None returns the production profile.
+
+    :rtype: LoopProfile
+    """
+    if profile is None or profile == "production":
+        return LoopProfile.production()
+    if profile == "development":
+        return LoopProfile.development()
+    if isinstance(profile, LoopProfile):
+        return profile
+    raise ValueError(f"Unknown loop profile: {profile}")
@@ -0,0 +1,141 @@
+import asyncio
+import math
+
+from .clock import WallClock
+
+
+class FixedRateScheduler:
+    """
+    Deadline based fixed rate scheduler used to run the Reynard simulation loop. Tick deadlines are computed from
+    the start time of the scheduler instead of the end of the previous tick, so time spent doing work in the loop
+    does not cause the loop rate to drift. The scheduler measures the real time elapsed between ticks so the
+    simulation can integrate using the actual elapsed time instead of the nominal period.
+
+    Overruns occur when a tick starts later than one full period after its deadline. When an overrun occurs the
+    missed deadlines are skipped instead of running a burst of ticks to catch up.
+
+    If the clock is a ``VirtualClock``, the scheduler does not sleep. Instead, the clock is advanced to the next
+    deadline and control is yielded to other tasks, so the loop runs as fast as the CPU allows. If the virtual clock
+    is paused, the scheduler waits until the clock is stepped past the next deadline.
+
+    :param rate: The loop rate in Hz
+    :type rate: float
+    :param max_step: The maximum elapsed time in seconds reported for a single tick. Limits the size of the
+                     integration step if the process is suspended. Default is 1 second.
+    :type max_step: float
+    :param clock: The clock used to time the loop. Default is a new ``WallClock``.
+    :type clock: WallClock or VirtualClock
+    """
+
+    def __init__(self, rate, max_step=1.0, clock=None):
+        if rate <= 0:
+            raise ValueError("Scheduler rate must be greater than zero")
+        self._clock = clock if clock is not None else WallClock()
+        self._period = 1.0 / rate
+        self._max_step = max_step
+        self._next_deadline = None
+        self._last_time = None
+        self.reset_stats()
+
+    @property
+    def period(self):
+        """
+        The nominal loop period in seconds.
+        """
+        return self._period
+
+    @property
+    def rate(self):
+        """
+        The nominal loop rate in Hz.
+        """
+        return 1.0 / self._period
+
+    def start(self, now=None):
+        """
+        Start the scheduler. The first deadline is one period after the start time.
+
+        :param now: The start time. Defaults to the current time of the clock
+        :type now: float
+        """
+        if now is None:
+            now = self._clock.now()
+        self._last_time = now
+        self._next_deadline = now + self._period
+
+    async def wait_next(self):
+        """
+        Sleep until the next tick deadline.
+
+        :return: The time of the tick and the real time elapsed since the previous tick in seconds
+        :rtype: Tuple[float,float]
+        """
+        if self._next_deadline is None:
+            self.start()
+        if self._clock.virtual:
+            await self._clock.run_to(self._next_deadline)
+            await asyncio.sleep(0)
+        else:
+            delay = self._next_deadline - self._clock.now()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return self._tick(self._clock.now())
+
+    def _tick(self, now):
+        lateness = now - self._next_deadline
+        elapsed = now - self._last_time
+        self._last_time = now
+
+        self._ticks += 1
+        self._period_sum += elapsed
+        self._period_sq_sum += elapsed * elapsed
+        self._lateness_max = max(self._lateness_max, lateness)
+
+        if lateness > self._period:
+            # Skip the missed deadlines instead of bursting to catch up
+            self._overruns += 1
+            missed = math.floor(lateness / self._period)
+            self._missed += missed
+            self._next_deadline += (missed + 1) * self._period
+        else:
+            self._next_deadline += self._period
+
+        return now, min(elapsed, self._max_step)
+
+    def reset_stats(self):
+        """
+        Reset the loop timing statistics.
+        """
+        self._ticks = 0
+        self._overruns = 0
+        self._missed = 0
+        self._period_sum = 0.0
+        self._period_sq_sum = 0.0
+        self._lateness_max = 0.0
+
+    def stats(self):
+        """
+        Get the loop timing statistics as a dictionary. Times are in seconds.
+
+        - ``rate``: The nominal loop rate in Hz
+        - ``ticks``: The number of ticks executed
+        - ``overruns``: The number of ticks that started more than one period late
+        - ``missed``: The number of deadlines skipped due to overruns
+        - ``mean_period``: The mean measured period between ticks
+        - ``jitter``: The standard deviation of the measured period between ticks
+        - ``max_lateness``: The maximum time a tick started after its deadline
+
+        :rtype: dict
+        """
+        n = self._ticks
+        mean = self._period_sum / n if n > 0 else 0.0
+        var = self._period_sq_sum / n - mean * mean if n > 0 else 0.0
+        return {
+            "rate": self.rate,
+            "ticks": n,
+            "overruns": self._overruns,
+            "missed": self._missed,
+            "mean_period": mean,
+            "jitter": math.sqrt(max(var, 0.0)),
+            "max_lateness": self._lateness_max
+        }
@@ -0,0 +1,126 @@
+import numpy as np
+
+from .kinematics import forward_kinematics
+
+
+class ReynardState:
+    """
+    Immutable snapshot of the state of Reynard the Robot. A new snapshot is published each simulation tick and
+    after each command that changes the state. All fields of a snapshot are sampled at the same time, and the
+    snapshot is never modified after it is published, so it is safe to read from any thread without copying.
+
+    The array fields are read-only views into a single compact buffer.
+    """
+
+    __slots__ = ("_seqno", "_time", "_data", "_tool_pose")
+
+    fields = ("seqno", "time", "x", "y", "q1", "q2", "q3", "vel_x", "vel_y", "vel_q1", "vel_q2", "vel_q3",
+              "r", "g", "b", "tool_x", "tool_y", "tool_theta")
+
+    def __init__(self, seqno, time, robot_position, arm_position, robot_velocity, arm_velocity, color):
+        data = np.empty((13,), dtype=np.float64)
+        data[0:2] = robot_position
+        data[2:5] = arm_position
+        data[5:7] = robot_velocity
+        data[7:10] = arm_velocity
+        data[10:13] = color
+        data.flags.writeable = False
+        self._seqno = seqno
+        self._time = time
+        self._data = data
+        self._tool_pose = None
+
+    @property
+    def seqno(self):
+        """
+        The sequence number of the snapshot. Increases by one each time a new snapshot is published.
+        """
+        return self._seqno
+
+    @property
+    def time(self):
+        """
+        The simulation time of the snapshot in seconds.
+        """
+        return self._time
+
+    @property
+    def robot_position(self):
+        """
+        The position of Reynard's base in millimeters as ``[x, y]``.
+        """
+        return self._data[0:2]
+
+    @property
+    def arm_position(self):
+        """
+        The position of Reynard's arm joints in degrees as ``[q1, q2, q3]``.
+        """
+        return self._data[2:5]
+
+    @property
+    def robot_velocity(self):
+        """
+        The velocity of Reynard's base in millimeters per second as ``[vel_x, vel_y]``.
+        """
+        return self._data[5:7]
+
+    @property
+    def arm_velocity(self):
+        """
+        The velocity of Reynard's arm joints in degrees per second as ``[vel_q1, vel_q2, vel_q3]``.
+        """
+        return self._data[7:10]
+
+    @property
+    def color(self):
+        """
+        The color of Reynard's body as ``[r, g, b]`` between 0 and 1.
+        """
+        return self._data[10:13]
+
+    @property
+    def tool_pose(self):
+        """
+        The pose of Reynard's tool as ``[x, y, theta]``, with the position of the tool tip in millimeters and the
+        angle of the tool in degrees. Computed from the robot and arm positions when first read.
+        """
+        pose = self._tool_pose
+        if pose is None:
+            pose = forward_kinematics(self._data[2:5], self._data[0:2])
+            pose.flags.writeable = False
+            self._tool_pose = pose
+        return pose
+
+    def to_dict(self, fields=None):
+        """
+        Convert the snapshot to a dictionary of Python floats using the field names of the HTTP REST API.
+
+        :param fields: The names of the fields to include, in the order they should appear. Default is all fields.
+                       The available names are listed in ``ReynardState.fields``.
+        :type fields: list
+        :rtype: dict
+        """
+        d = self._data.tolist()
+        res = {
+            "seqno": self._seqno,
+            "time": self._time,
+            "x": d[0],
+            "y": d[1],
+            "q1": d[2],
+            "q2": d[3],
+            "q3": d[4],
+            "vel_x": d[5],
+            "vel_y": d[6],
+            "vel_q1": d[7],
+            "vel_q2": d[8],
+            "vel_q3": d[9],
+            "r": d[10],
+            "g": d[11],
+            "b": d[12]
+        }
+        if fields is None or "tool_x" in fields or "tool_y" in fields or "tool_theta" in fields:
+            res["tool_x"], res["tool_y"], res["tool_theta"] = self.tool_pose.tolist()
+        if fields is None:
+            return res
+        return {f: res[f] for f in fields}
@@ -0,0 +1,263 @@
+import json
+import struct
+from urllib.parse import parse_qs
+
+import numpy as np
+
+_FRAME_BASE = 0x1
+_FRAME_ARM = 0x2
+
+
+class _StreamClient:
+    __slots__ = ("binary", "period", "last_time", "last_seqno")
+
+    def __init__(self, binary, period):
+        self.binary = binary
+        self.period = period
+        self.last_time = -1e30
+        self.last_seqno = -1
+
+
+class SocketIOStateStreamer:
+    """
+    Streams Reynard's state to the socket.io GUI clients. Each simulation tick, at most one ``frame`` event is
+    sent to each client. Frames are delta compressed: the base position is only included if it has moved more than
+    ``position_threshold`` or the robot was teleported, and the arm joints are only included if a joint has moved
+    more than ``joint_threshold`` or the arm position was set.
+
+    Frames are JSON objects with the optional keys ``x``, ``y``, ``q1``, ``q2`` and ``q3``. Clients can request
+    packed binary frames by connecting with the query parameter ``binary=1``. A binary frame is a flags byte
+    (bit 0 for base, bit 1 for arm) followed by the included fields as little endian doubles.
+
+    Clients can request a maximum frame rate using the ``rate`` query parameter. The rate is limited to ``max_rate``
+    if set. Rate limited clients receive complete frames instead of deltas so that skipped frames are not lost.
+
+    :param socketio: The socket.io server
+    :type socketio: socketio.AsyncServer
+    :param position_threshold: The base motion in millimeters required to send a new frame. Default is 2.
+    :type position_threshold: float
+    :param joint_threshold: The joint motion in degrees required to send a new frame. Default is 2.
+    :type joint_threshold: float
+    :param max_rate: The maximum frame rate in Hz for each client. None for no limit. Default is None.
+    :type max_rate: float
+    """
+
+    _JSON_ROOM = "frames"
+    _BINARY_ROOM = "frames_binary"
+
+    def __init__(self, socketio, position_threshold=2.0, joint_threshold=2.0, max_rate=None):
+        self.position_threshold = position_threshold
+        self.joint_threshold = joint_threshold
+        self.max_rate = max_rate
+        self._socketio = socketio
+        self._clients = dict()
+        self._room_counts = {self._JSON_ROOM: 0, self._BINARY_ROOM: 0}
+        self._limited = dict()
+        self._last_pos = None
+        self._last_q = None
+        self._force_base = False
+        self._force_arm = False
+        self._pending_events = []
+        self._seqno = 0
+        self._frames = 0
+        self._messages_sent = 0
+        self._bytes_sent = 0
+
+    def _client_period(self, requested_rate):
+        rate = requested_rate
+        if self.max_rate is not None and (rate is None or rate > self.max_rate):
+            rate = self.max_rate
+        if rate is None or rate <= 0:
+            return 0.0
+        return 1.0 / rate
+
+    async def connect(self, sid, environ):
+        """
+        Register a new socket.io client and send it a complete frame.
+        """
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        binary = query.get("binary", ["0"])[0] in ("1", "true")
+        try:
+            rate = float(query["rate"][0]) if "rate" in query else None
+        except ValueError:
+            rate = None
+        client = _StreamClient(binary, self._client_period(rate))
+        self._clients[sid] = client
+        if client.period == 0:
+            room = self._BINARY_ROOM if binary else self._JSON_ROOM
+            self._room_counts[room] += 1
+            await self._socketio.enter_room(sid, room)
+        else:
+            self._limited[sid] = client
+        if self._last_pos is not None:
+            client.last_seqno = self._seqno
+            await self._send(self._encode(_FRAME_BASE | _FRAME_ARM, binary), 1, to=sid)
+
+    def disconnect(self, sid):
+        """
+        Remove a socket.io client.
+        """
+        client = self._clients.pop(sid, None)
+        if client is None:
+            return
+        if client.period == 0:
+            self._room_counts[self._BINARY_ROOM if client.binary else self._JSON_ROOM] -= 1
+        else:
+            del self._limited[sid]
+
+    def mark_base(self):
+        """
+        Force the base position to be included in the next frame.
+        """
+        self._force_base = True
+
+    def mark_arm(self):
+        """
+        Force the arm joint positions to be included in the next frame.
+        """
+        self._force_arm = True
+
+    def queue_event(self, event, data, coalesce=False):
+        """
+        Queue an event that is not part of the state frames to be sent to all clients on the next tick.
+
+        :param event: The name of the event
+        :type event: str
+        :param data: The event data
+        :param coalesce: If True, replace an event with the same name that has not been sent yet
+        :type coalesce: bool
+        """
+        if coalesce:
+            self._pending_events = [e for e in self._pending_events if e[0] != event]
+        self._pending_events.append((event, data))
+
+    def _encode(self, flags, binary):
+        p = self._last_pos
+        q = self._last_q
+        if binary:
+            values = []
+            if flags & _FRAME_BASE:
+                values.extend(p)
+            if flags & _FRAME_ARM:
+                values.extend(q)
+            return struct.pack(f"<B{len(values)}d", flags, *values)
+        frame = dict()
+        if flags & _FRAME_BASE:
+            frame["x"] = p[0]
+            frame["y"] = p[1]
+        if flags & _FRAME_ARM:
+            frame["q1"] = q[0]
+            frame["q2"] = q[1]
+            frame["q3"] = q[2]
+        return frame
+
+    async def _send(self, payload, count, **kwargs):
+        if count == 0:
+            return
+        await self._socketio.emit('frame', payload, **kwargs)
+        size = len(payload) if isinstance(payload, bytes) else len(json.dumps(payload))
+        self._messages_sent += count
+        self._bytes_sent += size * count
+
+    async def emit(self, event, data):
+        """
+        Emit an event that is not part of the state frames to all clients.
+        """
+        await self._socketio.emit(event, data)
+        count = len(self._clients)
+        self._messages_sent += count
+        self._bytes_sent += len(json.dumps(data)) * count
+
+    def prepare_tick(self, robot_position, arm_position):
+        """
+        Compute the frame for the current tick and take the queued events. Must be called while holding the lock
+        that protects the state, since commands mark the state and queue events from other threads. Returns the
+        pending tick to pass to ``send_tick``.
+
+        :param robot_position: The base position in millimeters
+        :type robot_position: numpy.ndarray
+        :param arm_position: The arm joint positions in degrees
+        :type arm_position: numpy.ndarray
+        """
+        flags = 0
+        if self._last_pos is None:
+            flags = _FRAME_BASE | _FRAME_ARM
+        else:
+            if self._force_base or np.linalg.norm(self._last_pos - robot_position) > self.position_threshold:
+                flags |= _FRAME_BASE
+            if self._force_arm or np.any(np.abs(self._last_q - arm_position) > self.joint_threshold):
+                flags |= _FRAME_ARM
+        self._force_base = False
+        self._force_arm = False
+        events = self._pending_events
+        self._pending_events = []
+
+        if flags:
+            self._last_pos = robot_position.tolist() if flags & _FRAME_BASE else self._last_pos
+            self._last_q = arm_position.tolist() if flags & _FRAME_ARM else self._last_q
+            self._seqno += 1
+            self._frames += 1
+        return flags, events
+
+    async def send_tick(self, t, pending):
+        """
+        Send the frames and events of a tick prepared using ``prepare_tick``. Called by the simulation loop after
+        the lock is released.
+
+        :param t: The current time in seconds
+        :type t: float
+        :param pending: The value returned by ``prepare_tick``
+        """
+        flags, events = pending
+
+        if not self._clients:
+            return
+
+        for event, data in events:
+            await self.emit(event, data)
+
+        if flags:
+            json_count = self._room_counts[self._JSON_ROOM]
+            binary_count = self._room_counts[self._BINARY_ROOM]
+            if json_count:
+                await self._send(self._encode(flags, False), json_count, room=self._JSON_ROOM)
+            if binary_count:
+                await self._send(self._encode(flags, True), binary_count, room=self._BINARY_ROOM)
+
+        for sid, c in list(self._limited.items()):
+            if c.last_seqno == self._seqno or t - c.last_time < c.period:
+                continue
+            c.last_time = t
+            c.last_seqno = self._seqno
+            await self._send(self._encode(_FRAME_BASE | _FRAME_ARM, c.binary), 1, to=sid)
+
+    async def tick(self, t, robot_position, arm_position):
+        """
+        Send frames for the current tick. Equivalent to ``prepare_tick`` followed by ``send_tick``.
+
+        :param t: The current time in seconds
+        :type t: float
+        :param robot_position: The base position in millimeters
+        :type robot_position: numpy.ndarray
+        :param arm_position: The arm joint positions in degrees
+        :type arm_position: numpy.ndarray
+        """
+        await self.send_tick(t, self.prepare_tick(robot_position, arm_position))
+
+    def stats(self):
+        """
+        Get the streaming statistics as a dictionary.
+
+        - ``clients``: The number of connected clients
+        - ``frames``: The number of distinct frames generated
+        - ``messages_sent``: The number of messages sent to clients, counting each recipient
+        - ``bytes_sent``: The approximate payload bytes sent to clients, counting each recipient
+
+        :rtype: dict
+        """
+        return {
+            "clients": len(self._clients),
+            "frames": self._frames,
+            "messages_sent": self._messages_sent,
+            "bytes_sent": self._bytes_sent
+        }
@@ -0,0 +1,154 @@
+import threading
+
+import numpy as np
+
+
+class Trajectory:
+    """
+    Waypoint trajectory for Reynard's base, arm, or both. The trajectory is executed by the simulation loop, which
+    moves linearly between the waypoints. Execution starts from the current position of the robot, so the first
+    waypoint does not need to be the current position.
+
+    Each waypoint may have a time in seconds from the start of the trajectory. A segment that would exceed the velocity
+    limits of Reynard is slowed down so the limits are respected, delaying the following waypoints. Times of zero, or
+    omitting the times, move through the waypoints as fast as the velocity limits allow.
+
+    :param robot_positions: The base waypoints in millimeters as an N x 2 array of ``[x, y]``, or None if the
+                            trajectory does not move the base. Default is None.
+    :type robot_positions: numpy.ndarray
+    :param arm_positions: The arm waypoints in degrees as an N x 3 array of ``[q1, q2, q3]``, or None if the trajectory
+                          does not move the arm. Default is None.
+    :type arm_positions: numpy.ndarray
+    :param times: The time of each waypoint in seconds from the start of the trajectory. The times must not decrease.
+                  Default is None.
+    :type times: numpy.ndarray
+    """
+
+    def __init__(self, robot_positions=None, arm_positions=None, times=None):
+        if robot_positions is None and arm_positions is None:
+            raise ValueError("Trajectory must contain robot positions, arm positions, or both")
+        count = None
+        if robot_positions is not None:
+            robot_positions = np.array(robot_positions, dtype=np.float64).reshape((-1, 2))
+            count = robot_positions.shape[0]
+        if arm_positions is not None:
+            arm_positions = np.array(arm_positions, dtype=np.float64).reshape((-1, 3))
+            if count is not None and arm_positions.shape[0] != count:
+                raise ValueError("Robot positions and arm positions must have the same number of waypoints")
+            count = arm_positions.shape[0]
+        if count == 0:
+            raise ValueError("Trajectory must contain at least one waypoint")
+        if times is None:
+            times = np.zeros((count,), dtype=np.float64)
+        else:
+            times = np.array(times, dtype=np.float64).reshape((-1,))
+            if times.shape[0] != count:
+                raise ValueError("Times must have one entry for each waypoint")
+            if np.any(times < 0) or np.any(np.diff(times) < 0):
+                raise ValueError("Times must not be negative or decrease")
+        for a in (robot_positions, arm_positions, times):
+            if a is not None:
+                if not np.all(np.isfinite(a)):
+                    raise ValueError("Trajectory values must be finite")
+                a.flags.writeable = False
+        self._robot_positions = robot_positions
+        self._arm_positions = arm_positions
+        self._times = times
+
+    def __len__(self):
+        return self._times.shape[0]
+
+    @property
+    def robot_positions(self):
+        """
+        The base waypoints in millimeters, or None if the trajectory does not move the base.
+        """
+        return self._robot_positions
+
+    @property
+    def arm_positions(self):
+        """
+        The arm waypoints in degrees, or None if the trajectory does not move the arm.
+        """
+        return self._arm_positions
+
+    @property
+    def times(self):
+        """
+        The requested time of each waypoint in seconds from the start of the trajectory.
+        """
+        return self._times
+
+
+class TrajectoryExecution:
+    # A trajectory being executed by the simulation loop. The waypoints are stored as N x 5 arrays of
+    # [x, y, q1, q2, q3] with the current position prepended, and the columns that are not controlled by the
+    # trajectory are ignored. Created and updated with the state lock held.
+
+    def __init__(self, trajectory_id, trajectory, start_time, robot_position, arm_position, kinematics):
+        self.id = trajectory_id
+        self.controls_base = trajectory.robot_positions is not None
+        self.controls_arm = trajectory.arm_positions is not None
+        self.state = "running"
+        self.start_time = start_time
+        self.done = threading.Event()
+
+        n = len(trajectory)
+        w = np.empty((n + 1, 5), dtype=np.float64)
+        w[0, 0:2] = robot_position
+        w[0, 2:5] = arm_position
+        w[1:, 0:2] = trajectory.robot_positions if self.controls_base else robot_position
+        w[1:, 2:5] = trajectory.arm_positions if self.controls_arm else arm_position
+        w[:, 0:2] = np.clip(w[:, 0:2], kinematics["bounds"][0], kinematics["bounds"][1])
+        w[:, 2:5] = np.clip(w[:, 2:5], kinematics["q_bounds"][0], kinematics["q_bounds"][1])
+
+        # Stretch each segment so no axis exceeds its velocity limit
+        vel_max = np.concatenate((kinematics["vel_max"], kinematics["q_vel_max"]))
+        required = np.max(np.abs(np.diff(w, axis=0)) / vel_max, axis=1)
+        requested = np.diff(np.concatenate(([0.0], trajectory.times)))
+        durations = np.maximum(requested, required)
+
+        self._waypoints = w
+        self._times = np.concatenate(([0.0], np.cumsum(durations)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._velocities = np.where(durations[:, None] > 0, np.diff(w, axis=0) / durations[:, None], 0.0)
+        self.duration = float(self._times[-1])
+        self._elapsed = 0.0
+        self._segment = 0
+
+    @property
+    def waypoints(self):
+        # The N + 1 x 5 waypoints including the starting position
+        return self._waypoints
+
+    def sample(self, t):
+        """
+        Get the position and velocity at time t as 5 element arrays. Returns True as the last value when the end of
+        the trajectory has been reached.
+        """
+        s = t - self.start_time
+        self._elapsed = min(max(s, 0.0), self.duration)
+        if s >= self.duration:
+            self._segment = len(self._times) - 1
+            return self._waypoints[-1], np.zeros((5,), dtype=np.float64), True
+        i = int(np.searchsorted(self._times, max(s, 0.0), side="right")) - 1
+        self._segment = i
+        p = self._waypoints[i] + self._velocities[i] * (max(s, 0.0) - self._times[i])
+        return p, self._velocities[i], False
+
+    def finish(self, state):
+        self.state = state
+        self.done.set()
+
+    def status(self):
+        """
+        Get the status as a dictionary.
+        """
+        return {
+            "id": self.id,
+            "state": self.state,
+            "time": self._elapsed,
+            "duration": self.duration,
+            "progress": self._elapsed / self.duration if self.duration > 0 else 1.0,
+            "waypoint": self._segment
+        }
@@ -1,4 +1,9 @@
-const socket = io();
+const robot_path_match = window.location.pathname.match(/\/robots\/(\d+)\//);
+const socket_query = Object.fromEntries(new URLSearchParams(window.location.search));
+if (robot_path_match) {
+    socket_query.robot = robot_path_match[1];
+}
+const socket = io({query: socket_query});
 
 
 let reynard_kinematics = {
@@ -66,6 +71,18 @@ class ReynardRobot {
       this.arm(data.q1, data.q2, data.q3);
     });
 
+    socket.on('frame', (data) => {
+      if (data instanceof ArrayBuffer) {
+        data = decodeBinaryFrame(data);
+      }
+      if ('x' in data) {
+        this.teleport(data.x, data.y);
+      }
+      if ('q1' in data) {
+        this.arm(data.q1, data.q2, data.q3);
+      }
+    });
+
     socket.on('say', (text) => {
       this.reynard_output.append(`<div class="output-line">${text}</div>`);
     });
@@ -127,6 +144,26 @@ class ReynardRobot {
   }
 }
 
+function decodeBinaryFrame(buffer)
+{
+    // Flags byte followed by little endian doubles. Bit 0 is base position, bit 1 is arm joints.
+    let view = new DataView(buffer);
+    let flags = view.getUint8(0);
+    let offset = 1;
+    let data = {};
+    if (flags & 1) {
+        data.x = view.getFloat64(offset, true);
+        data.y = view.getFloat64(offset + 8, true);
+        offset += 16;
+    }
+    if (flags & 2) {
+        data.q1 = view.getFloat64(offset, true);
+        data.q2 = view.getFloat64(offset + 8, true);
+        data.q3 = view.getFloat64(offset + 16, true);
+    }
+    return data;
+}
+
 async function loadSVGImage(group,url,position)
 {
     let promise = new Promise(resolve => {